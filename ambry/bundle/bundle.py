@@ -1445,26 +1445,26 @@ class BuildBundle(Bundle):
         spaces = set()
         grains = set()
 
-        def resolve(term):
-            places = list(self.library.search.search_identifiers(term))
+        # From the bundle metadata and the bundle name, resolved in one batch
+        terms = [t for t in (self.metadata.about.space, self.identity.bspace) if t]
 
-            if not places:
-                raise BuildError(
-                    "Failed to find space identifier '{}' in full text identifier search".format(space))
+        if terms:
+            all_places = self.library.search.search_identifiers_many(terms)
 
-            score, gvid, name = places[0]
+            for term in terms:
+                places = all_places[term]
 
-            return gvid
+                if not places:
+                    raise BuildError(
+                        "Failed to find space identifier '{}' in full text identifier search".format(term))
 
-        if self.metadata.about.space:  # From the bundle metadata
-            spaces.add(resolve(self.metadata.about.space))
+                score, gvid, name = places[0]
+
+                spaces.add(gvid)
 
         if self.metadata.about.grain:  # From the bundle metadata
             grains.add(self.metadata.about.grain)
 
-        if self.identity.bspace:  # And from the bundle name
-            spaces.add(resolve(self.identity.bspace))
-
         # From all of the partitions
         for p in self.partitions.all:
             if 'geo_coverage' in p.record.data:
@@ -1856,11 +1856,13 @@ class BuildBundle(Bundle):
         self.run_args = AttrDict(vars(args))
 
     def run_mp(self, method, arg_sets):
+        """Run a bundle method in child processes, once for each set of
+        arguments, returning a list of the method's return values."""
         from ..run import mp_run
         from multiprocessing import Pool, cpu_count
 
         if len(arg_sets) == 0:
-            return
+            return []
 
         # Argsets should be tuples, but for one ag functions, the
         # caller may pass in a scalar, which we have to convert.
@@ -1875,8 +1877,7 @@ class BuildBundle(Bundle):
         if n == 1:
             self.log(
                 "Requested MP run, but for only 1 process; running in process instead")
-            for args in arg_sets:
-                method(*args)
+            return [method(*args) for args in arg_sets]
         else:
             self.log("Multi processor run with {} processes".format(n))
 
@@ -1888,10 +1889,14 @@ class BuildBundle(Bundle):
 
             pool = Pool(n)
 
-            pool.map(
-                mp_run, [
-                    (self.bundle_dir, dict(
-                        self.run_args), method.__name__, args) for args in arg_sets])
+            try:
+                return pool.map(
+                    mp_run, [
+                        (self.bundle_dir, dict(
+                            self.run_args), method.__name__, args) for args in arg_sets])
+            finally:
+                pool.close()
+                pool.join()
 
     def _info(self, identity=None):
         """Return a nested, ordered dict  of information about the bundle."""
@@ -11,6 +11,15 @@ class LoaderBundle(BuildBundle):
         'xlsx': 'xls'
     }
 
+    # In a multi process build, delimited sources larger than this are split into byte ranges, which are loaded
+    # in parallel into the segments of the source's partition.
+    split_source_size = 500 * 1024 * 1024
+
+    # The schema is intuited from the first intuit_max_n rows of each source, or all of them if it is None. If
+    # intuit_sample is set, only a random sample of that many of those rows are classified.
+    intuit_max_n = 2000
+    intuit_sample = None
+
     def __init__(self, bundle_dir=None):
         import os
 
@@ -82,11 +91,8 @@ class LoaderBundle(BuildBundle):
 
         return [ self.mangle_column_name(i,n) for i,n in enumerate(header)]
 
-    def build_create_partition(self, source_name):
-        """Create or find a partition based on the source
-
-        Will also load the source metadata into the partition, as a dict, under the key name of the source name.
-        """
+    def build_source_table(self, source_name):
+        """Return the name of the table a source loads into"""
 
         source = self.metadata.sources[source_name]
 
@@ -101,12 +107,32 @@ class LoaderBundle(BuildBundle):
 
         assert bool(table)
 
+        return table
+
+    def build_create_partition(self, source_name, segment=None, update_record=True):
+        """Create or find a partition based on the source
+
+        Will also load the source metadata into the partition, as a dict, under the key name of the source name,
+        unless update_record is False. The child processes of build_mp() use that to find the partitions the
+        parent created without writing to the bundle database.
+        """
+
+        source = self.metadata.sources[source_name]
+
+        table = self.build_source_table(source_name)
+
         kwargs = dict(table=table)
 
         if source.grain:
             kwargs['grain'] = source.grain
 
-        p =  self.partitions.find_or_new(table=table)
+        if segment:
+            p = self.partitions.find_or_new(table=table, segment=segment)
+        else:
+            p =  self.partitions.find_or_new(table=table)
+
+        if not update_record:
+            return p
 
         with self.session:
             if not 'source_data' in p.record.data:
@@ -287,7 +313,7 @@ class LoaderBundle(BuildBundle):
 
                 rg = self.row_gen_for_source(source_name)
 
-                intuiter.iterate(rg, 2000)
+                intuiter.iterate(rg, self.intuit_max_n, sample=self.intuit_sample)
 
             self.schema.update_from_intuiter(table_name, intuiter)
 
@@ -379,14 +405,21 @@ class LoaderBundle(BuildBundle):
         """
         pass
 
-    def build_from_source(self, source_name):
+    def build_from_source(self, source_name, defer_updates=False):
+        """Load a source into its partition.
+
+        :param source_name: Name of the source to load
+        :param defer_updates: If True, don't write column lengths and cast error codes to the bundle. Instead,
+        return a tuple of the table name, the dict of max column lengths and the dict of cast error codes.
+        :return:
+        """
 
         source = self.metadata.sources[source_name]
 
         if source.is_loadable is False:
             return
 
-        p = self.build_create_partition(source_name)
+        p = self.build_create_partition(source_name, update_record=not defer_updates)
 
         self.log("Loading source '{}' into partition '{}'".format(source_name, str(p.identity.name)))
 
@@ -403,24 +436,183 @@ class LoaderBundle(BuildBundle):
                 self.error("Header column '{}' not in table {} for source {}"
                            .format(col, p.table.name, source_name))
 
-        with p.inserter() as ins:
-            for row in row_gen:
+        # If build_modify_row() hasn't been overridden, the rows don't have to be converted to dicts, and can
+        # go straight to the inserter's positional path.
+        modifies_rows = type(self).build_modify_row.im_func is not LoaderBundle.build_modify_row.im_func
+
+        with p.inserter(defer_updates=defer_updates) as ins:
+            if modifies_rows:
+                for row in row_gen:
+                    assert len(row) == len(header), '{} != {}'
+
+                    lr(str(p.identity.name))
+
+                    d = dict(zip(header, row))
+
+                    self.build_modify_row(row_gen, p, source, d)
+
+                    errors = ins.insert(d)
+
+                    if errors:
+                        self.error("Casting error for {}: {}".format(source_name,errors))
+            else:
+                def rows():
+                    for row in row_gen:
+                        assert len(row) == len(header), '{} != {}'
+
+                        lr(str(p.identity.name))
+
+                        yield row
+
+                for errors in ins.insert_many(rows(), header=header):
+                    self.error("Casting error for {}: {}".format(source_name, errors))
+
+        if defer_updates:
+            return p.table.name, ins.max_lengths, ins.codes
+
+    def build_from_source_range(self, source_name, start, end, first_line, segment):
+        """Load one byte range of a delimited source into a segment of the source's partition. Run in a child
+        process by build_mp(); returns the schema updates, like build_from_source(source_name, defer_updates=True)
+        """
+        from ..database.inserter import SegmentedInserter, PartitionSegmentInserterFactory
+
+        p = self.build_create_partition(source_name, segment=segment, update_record=False)
+        table_name = p.table.name
+
+        row_gen = self.row_gen_for_source(source_name)
+        header = row_gen.header
+
+        self.log("Loading source '{}' bytes {}-{} into partition '{}'"
+                 .format(source_name, start, end, str(p.identity.name)))
+
+        lr = self.init_log_rate(print_rate=5)
+
+        def rows():
+            for row in row_gen.iter_range(start, end, first_line):
                 assert len(row) == len(header), '{} != {}'
 
                 lr(str(p.identity.name))
 
-                d = dict(zip(header, row))
+                yield row
 
-                self.build_modify_row(row_gen, p, source, d)
+        factory = PartitionSegmentInserterFactory(self, first_segment=segment,
+                                                  inserter_kwargs=dict(defer_updates=True), table=table_name)
 
-                errors = ins.insert(d)
+        with SegmentedInserter(segment_size=None, segment_factory=factory) as ins:
+            for errors in ins.insert_many(rows(), header=header):
+                self.error("Casting error for {}: {}".format(source_name, errors))
 
-                if errors:
-                    self.error("Casting error for {}: {}".format(source_name,errors))
+        return table_name, ins.max_lengths, ins.codes
+
+    def build_from_sources_mp(self, source_names):
+        """Load a group of sources that share a partition. Run in a child process by build_mp(), so the
+        schema updates are returned to the parent rather than written to the bundle. """
+
+        return [ self.build_from_source(source_name, defer_updates=True) for source_name in source_names ]
+
+    def build_source_ranges(self, source_name, n):
+        """Return the byte ranges to split a source into for a multi process build, or None if the source
+        should be loaded whole"""
+        import os
+        from rowgen import DelimitedRowGenerator
+
+        row_gen = self.row_gen_for_source(source_name)
+
+        if not isinstance(row_gen, DelimitedRowGenerator):
+            return None
+
+        if os.path.getsize(row_gen.file_name) < self.split_source_size:
+            return None
+
+        ranges = row_gen.byte_ranges(n)
+
+        return ranges if len(ranges) > 1 else None
+
+    def build_mp(self):
+        """Load the sources in child processes, one process per partition. The partitions are created in the
+        parent, and the column lengths and cast error codes from the children are merged and written to the
+        bundle in the parent. """
+        from collections import OrderedDict, defaultdict
+        from multiprocessing import cpu_count
+        from ..database.inserter import CodeCastErrorHandler
+
+        n = int(self.run_args.get('multi'))
+
+        if n == 0:
+            n = cpu_count()
+
+        groups = OrderedDict()
+        range_args = []
+
+        source_names = [source_name for source_name in self.metadata.sources
+                        if self.metadata.sources[source_name].is_loadable is not False]
+
+        table_sources = defaultdict(int)
+
+        for source_name in source_names:
+            table_sources[self.build_source_table(source_name)] += 1
+
+        segments = defaultdict(int)  # Last segment number used for each table
+
+        for source_name in source_names:
+            table = self.build_source_table(source_name)
+
+            # Only split sources that are the only source for their table, so a table's rows are either all in
+            # its unsegmented partition, or all in segments
+            if n > 1 and table_sources[table] == 1:
+                ranges = self.build_source_ranges(source_name, n)
+            else:
+                ranges = None
+
+            if ranges:
+                # Large sources are split into byte ranges, each loaded into its own segment partition. The
+                # segments are numbered in file order, so the row order is deterministic.
+                for start, end, first_line in ranges:
+                    segments[table] += 1
+                    self.build_create_partition(source_name, segment=segments[table])
+                    range_args.append((source_name, start, end, first_line, segments[table]))
+            else:
+                p = self.build_create_partition(source_name)
+
+                groups.setdefault(p.identity.vid, []).append(source_name)
+
+        self.partitions.close()
+
+        results = self.run_mp(self.build_from_sources_mp, [ (source_names,) for source_names in groups.values() ])
+
+        if range_args:
+            results.append(self.run_mp(self.build_from_source_range, range_args))
+
+        lengths = defaultdict(dict)
+        codes = defaultdict(lambda: defaultdict(set))
+
+        for group in results:
+            for r in group:
+                if not r:
+                    continue
+
+                table_name, max_lengths, col_codes = r
+
+                for col_name, size in max_lengths.items():
+                    lengths[table_name][col_name] = max(size, lengths[table_name].get(col_name, 0))
+
+                for col_name, values in col_codes.items():
+                    codes[table_name][col_name] |= set(values)
+
+        for table_name, max_lengths in lengths.items():
+            self.schema.update_lengths(table_name, max_lengths)
+
+        for table_name, col_codes in codes.items():
+            CodeCastErrorHandler.add_codes(self, table_name, col_codes)
 
     def build(self):
-        for source_name in self.metadata.sources:
-            self.build_from_source(source_name)
+
+        if self.run_args.get('multi'):
+            self.build_mp()
+        else:
+            for source_name in self.metadata.sources:
+                self.build_from_source(source_name)
+
         return True
 
 class CsvBundle(LoaderBundle):
@@ -241,6 +241,124 @@ class DelimitedRowGenerator(RowGenerator):
                 self.line_number = i
                 yield row
 
+    def byte_ranges(self, n, quotechar = '"'):
+        """Split the file into at most n byte ranges that start and end on record boundaries, so the ranges
+        can be parsed independently. A newline inside a quoted field is not a record boundary.
+
+        Returns a list of (start, end, first_line) tuples, where first_line is the line number, as counted
+        by _yield_rows(), of the first record in the range. The file must use '\n' or '\r\n' line endings.
+
+        The split points are found from the parity of the quotes on each line, which a stray quote in an
+        unquoted field will throw off, so each one is checked with is_record_start(). If any check fails,
+        the whole file is returned as one range.
+        """
+        import os
+
+        size = os.path.getsize(self.file_name)
+        target = max(size / max(n, 1), 1)
+
+        ranges = []
+        start = start_line = 0
+        offset = line_number = 0
+        in_quote = False
+
+        with open(self.file_name, 'rb') as f:
+            for line in f:
+                offset += len(line)
+
+                # Doubled, escaped quotes don't change the parity
+                if line.count(quotechar) % 2:
+                    in_quote = not in_quote
+
+                if in_quote:
+                    continue
+
+                line_number += 1
+
+                if offset - start >= target and len(ranges) < n - 1:
+                    ranges.append((start, offset, start_line))
+                    start, start_line = offset, line_number
+
+        if offset > start:
+            ranges.append((start, offset, start_line))
+
+        with open(self.file_name, 'rb') as f:
+            if not all(self.is_record_start(f, start, quotechar) for start, _, _ in ranges[1:]):
+                return [(0, size, 0)]
+
+        return ranges
+
+    def is_record_start(self, f, offset, quotechar='"', n_lines=100):
+        """Check that a byte offset in an open file is the start of a record, by parsing the records that
+        follow it with the CSV reader. The records must end on the lines where the quote parity says they
+        do, and the first must be as wide as most of the others, which it won't be if the offset is inside
+        a quoted field. """
+        import csv
+
+        f.seek(offset)
+
+        ends = set()  # Numbers of the lines, from 1, that end a record, by the quote parity
+
+        def lines():
+            in_quote = False
+
+            for i, line in enumerate(f, 1):
+                if line.count(quotechar) % 2:
+                    in_quote = not in_quote
+
+                if not in_quote:
+                    ends.add(i)
+
+                yield line
+
+                # Stop on a record boundary, unless the quote never closes
+                if i >= n_lines and (not in_quote or i >= 10 * n_lines):
+                    break
+
+        reader = self.get_csv_reader(lines())
+        widths = []
+
+        try:
+            for row in reader:
+                if reader.line_num not in ends:
+                    return False
+
+                widths.append(len(row))
+
+        except csv.Error:
+            return False
+
+        rest = widths[1:]
+
+        return not rest or widths[0] == max(set(rest), key=rest.count)
+
+    def iter_range(self, start, end, first_line):
+        """Yield the data rows in a byte range returned by byte_ranges(). Rows before data_start_line and
+        after data_end_line are skipped, just as in a full iteration, so the rows from all of the ranges,
+        in order, are the same as the rows from iterating the whole file. """
+
+        def lines(f):
+            remaining = end - start
+            for line in f:
+                yield line
+                remaining -= len(line)
+                if remaining <= 0:
+                    break
+
+        with open(self.file_name, 'rb') as f:
+            f.seek(start)
+
+            for i, row in enumerate(self.get_csv_reader(lines(f))):
+                self.line_number = first_line + i
+
+                if self.line_number < self.data_start_line:
+                    continue
+
+                if self.data_end_line and self.line_number >= self.data_end_line:
+                    break
+
+                yield row
+
 class ExcelRowGenerator(RowGenerator):
 
     def __init__(self, file, data_start_line=None, data_end_line=None, header_lines=None,
@@ -35,9 +35,34 @@ class SegmentInserterFactory(object):
         raise NotImplemented()
 
 
+class PartitionSegmentInserterFactory(SegmentInserterFactory):
+
+    """Creates inserters for the segment partitions of a table. The local
+    segment numbers of a SegmentedInserter are offset by first_segment,
+    so several SegmentedInserters, in different processes, can write to
+    distinct segments of the same table."""
+
+    def __init__(self, bundle, first_segment=1, inserter_kwargs=None, **partition_kwargs):
+        self.bundle = bundle
+        self.first_segment = first_segment
+        self.inserter_kwargs = inserter_kwargs if inserter_kwargs else {}
+        self.partition_kwargs = partition_kwargs
+
+    def next_inserter(self, segment):
+
+        p = self.bundle.partitions.find_or_new(
+            segment=self.first_segment + segment - 1,
+            **self.partition_kwargs)
+
+        return p.inserter(**self.inserter_kwargs)
+
+
 class SegmentedInserter(InserterInterface):
 
     def __init__(self, segment_size=100000, segment_factory=None):
+        """Insert rows into a series of segments, starting a new segment
+        every segment_size rows. If segment_size is None, all of the rows
+        go to the first segment."""
         pass
 
         self.segment = 1
@@ -46,6 +71,9 @@ class SegmentedInserter(InserterInterface):
         self.segment_size = segment_size
         self.factory = segment_factory
 
+        self._max_lengths = {}
+        self._codes = {}
+
         self.inserter = self.factory.next_inserter(self.segment)
 
         self.inserter.__enter__()
@@ -56,22 +84,75 @@ class SegmentedInserter(InserterInterface):
 
     def __exit__(self, type_, value, traceback):
         self.inserter.__exit__(type_, value, traceback)
+        self._collect(self.inserter)
         return self
 
+    def _collect(self, inserter):
+        """Accumulate the max lengths and codes of a finished segment
+        inserter."""
+
+        for k, v in getattr(inserter, 'max_lengths', {}).items():
+            self._max_lengths[k] = max(v, self._max_lengths.get(k, 0))
+
+        for k, v in getattr(inserter, 'codes', {}).items():
+            self._codes[k] = self._codes.get(k, set()) | set(v)
+
+    def _next_segment(self):
+        self.segment += 1
+        self.inserter.__exit__(None, None, None)
+        self._collect(self.inserter)
+        self.inserter = self.factory.next_inserter(self.segment)
+        self.inserter.__enter__()
+
+        self.count = 0
+
     def insert(self, row, **kwargs):
 
         self.count += 1
 
-        if self.count > self.segment_size:
-            self.segment += 1
-            self.inserter.__exit__(None, None, None)
-            self.inserter = self.factory.next_inserter(self.segment)
-            self.inserter.__enter__()
-
-            self.count = 0
+        if self.segment_size and self.count > self.segment_size:
+            self._next_segment()
+            self.count = 1
 
         return self.inserter.insert(row)
 
+    def insert_many(self, rows, header=None):
+        """Insert an iterable of rows with the segment inserters'
+        insert_many(), splitting the rows across segments."""
+        from itertools import islice
+
+        if not self.segment_size:
+            return self.inserter.insert_many(rows, header=header)
+
+        errors = []
+        rows = iter(rows)
+
+        while True:
+
+            if self.count >= self.segment_size:
+                self._next_segment()
+
+            batch = list(islice(rows, self.segment_size - self.count))
+
+            if not batch:
+                break
+
+            self.count += len(batch)
+
+            errors.extend(self.inserter.insert_many(batch, header=header))
+
+        return errors
+
+    @property
+    def max_lengths(self):
+        """Max lengths of the sizable fields, over all finished segments."""
+        return dict(self._max_lengths)
+
+    @property
+    def codes(self):
+        """Cast error codes, over all finished segments."""
+        return dict(self._codes)
+
     def close(self):
         self.inserter.close()
 
@@ -191,7 +272,8 @@ class CodeCastErrorHandler(object):
         self.codes = defaultdict(set)
         self.inserter = inserter
 
-    def code_col_name(self, col_name):
+    @staticmethod
+    def code_col_name(col_name):
         return col_name + '_codes'
 
     def cast_error(self, row, cast_errors):
@@ -210,20 +292,27 @@ class CodeCastErrorHandler(object):
 
     def finish(self):
         """Add all of the codes to the codes table."""
+
+        # self.inserter.table is a sqlalchemy.sql.schema.Table, not an
+        # orm.Table
+        self.add_codes(self.inserter.bundle, self.inserter.table.name, self.codes)
+
+    @classmethod
+    def add_codes(cls, bundle, table_name, col_codes):
+        """Add codes, a dict of sets of values keyed by column name, to the
+        codes table. Used by finish(), and to merge codes collected in
+        other processes."""
         from ..dbexceptions import NotFoundError
-        schema = self.inserter.bundle.schema
 
-        with self.inserter.bundle.session:
+        with bundle.session:
 
-            # self.inserter.table is a sqlalchemy.sql.schema.Table, not an
-            # orm.Table
-            table = self.inserter.bundle.schema.table(self.inserter.table.name)
+            table = bundle.schema.table(table_name)
 
-            for col_name, codes in self.codes.items():
+            for col_name, codes in col_codes.items():
 
                 try:
                     # Try with the code column, if it exists.
-                    col = table.column(self.code_col_name(col_name))
+                    col = table.column(cls.code_col_name(col_name))
                 except NotFoundError:
                     # Fall back to the source column
                     col = table.column(col_name)
@@ -239,7 +328,7 @@ class ValueInserter(ValueWriter):
     def __init__(self, db, bundle, table,
                  cast_error_handler=None,
                  cache_size=50000, text_factory=None,
-                 replace=False, skip_none=True, update_size=True):
+                 replace=False, skip_none=True, update_size=True, defer_updates=False):
 
         super(
             ValueInserter,
@@ -278,11 +367,30 @@ class ValueInserter(ValueWriter):
 
         self.update_size = update_size
 
+        # If True, don't write the column lengths and cast error codes to the bundle on exit; the caller
+        # collects them from max_lengths and codes, for instance to merge them from another process.
+        self.defer_updates = defer_updates
+
         self.row_id = None
 
         if replace:
             self.statement = self.statement.prefix_with('OR REPLACE')
 
+        self.replace = replace
+
+        # Column order for the positional, executemany() path. Includes
+        # any code columns that exist in the table.
+        self.columns = [c.name for c in self.table.columns]
+
+        self._null_values = [self.null_row.get(c) for c in self.columns]
+
+        # Positions of the sizable fields in the positional rows, paired
+        # with their index in self._max_lengths
+        self._sizable_positions = [(i, self.columns.index(c))
+                                   for i, c in enumerate(self.sizable_fields) if c in self.columns]
+
+        self._positional_sql = None
+
     def insert(self, values):
         from sqlalchemy.engine.result import RowProxy
 
@@ -364,14 +472,245 @@ class ValueInserter(ValueWriter):
 
         return True
 
+    def positional_sql(self):
+        """Return the SQL for a positional INSERT into the table, in the
+        paramstyle of the DBAPI driver, or None if the driver uses named
+        parameters."""
+
+        if self._positional_sql is None:
+
+            dialect = self.db.engine.dialect
+            prep = dialect.identifier_preparer
+
+            n = len(self.columns)
+
+            if dialect.paramstyle == 'qmark':
+                markers = ['?'] * n
+            elif dialect.paramstyle in ('format', 'pyformat'):
+                markers = ['%s'] * n
+            elif dialect.paramstyle == 'numeric':
+                markers = [':{}'.format(i + 1) for i in range(n)]
+            else:
+                return None
+
+            self._positional_sql = "INSERT {}INTO {} ({}) VALUES ({})".format(
+                'OR REPLACE ' if self.replace else '',
+                prep.format_table(self.table),
+                ', '.join(prep.quote(c) for c in self.columns),
+                ', '.join(markers))
+
+        return self._positional_sql
+
+    def _cast_batch(self, rows, header=None):
+        """Cast a batch of rows and convert them to tuples in the order of
+        self.columns. Returns the tuples and a list of the cast errors that
+        were not handled by the cast error handler."""
+        from sqlalchemy.engine.result import RowProxy
+
+        out = []
+        errors = []
+
+        columns = self.columns
+        null_values = self._null_values
+        caster = self.caster
+        handler = self.cast_error_handler
+
+        if header is not None and caster and self.row_id is None:
+            # Positional rows go through the compiled list caster, which
+            # produces tuples in the order of self.header
+            list_caster = caster.list_caster(header)
+
+            in_order = (self.header == columns)
+
+            for values in rows:
+
+                t, cast_errors = list_caster(values)
+                failed = None
+
+                if cast_errors or not in_order:
+                    d = dict(zip(self.header, t))
+
+                    if cast_errors and handler:
+                        failed = set(cast_errors)  # Left null, as in insert()
+                        d = handler.cast_error(d, cast_errors)
+                        cast_errors = None
+
+                    if cast_errors:
+                        errors.append(cast_errors)
+
+                    t = tuple(d.get(c) for c in columns)
+
+                if self.skip_none:
+                    if failed:
+                        t = tuple(v if v is not None or c in failed else nv
+                                  for c, v, nv in zip(columns, t, null_values))
+                    else:
+                        t = tuple(v if v is not None else nv for v, nv in zip(t, null_values))
+
+                out.append(t)
+
+            return out, errors
+
+        for values in rows:
+
+            if header is not None:
+                values = dict(zip(header, values))
+            elif isinstance(values, RowProxy):
+                values = dict(values)
+
+            if caster:
+                d, cast_errors = caster(values)
+            else:
+                d = dict((k.lower().replace(' ', '_'), v) for k, v in values.items())
+                cast_errors = None
+
+            if self.row_id is not None:
+                if d.get('id') is None:
+                    d['id'] = self.row_id
+                    self.row_id += 1
+                else:
+                    self.row_id = max(self.row_id, d['id']) + 1
+
+            failed = None
+
+            if cast_errors and handler:
+                # The handler nulls the columns that failed. Like insert(), which fills the nulls before calling
+                # the handler, leave those columns null
+                failed = set(cast_errors)
+                d = handler.cast_error(d, cast_errors)
+                cast_errors = None
+
+            if cast_errors:
+                errors.append(cast_errors)
+
+            if self.skip_none:
+                out.append(tuple(d[c] if d.get(c) is not None or (failed and c in failed) else nv
+                                 for c, nv in zip(columns, null_values)))
+            else:
+                out.append(tuple(d.get(c) for c in columns))
+
+        return out, errors
+
+    def _update_batch_lengths(self, tuples):
+        """Update the max lengths of the sizable fields from a batch of
+        positional rows, one column at a time."""
+
+        for i, pos in self._sizable_positions:
+            try:
+                lengths = [len(str(t[pos])) for t in tuples if t[pos]]
+            except UnicodeEncodeError:
+                # Unicode is a PITA
+                lengths = []
+                for t in tuples:
+                    try:
+                        if t[pos]:
+                            lengths.append(len(str(t[pos])))
+                    except UnicodeEncodeError:
+                        pass
+
+            if lengths:
+                self._max_lengths[i] = max(max(lengths), self._max_lengths[i])
+
+    def _execute_many(self, tuples):
+        """Write a batch of positional rows with the DBAPI executemany()"""
+
+        sql = self.positional_sql()
+
+        if sql is None:
+            self.session.execute(self.statement, [dict(zip(self.columns, t)) for t in tuples])
+        else:
+            cursor = self.session.connection().connection.cursor()
+            try:
+                cursor.executemany(sql, tuples)
+            finally:
+                cursor.close()
+
+    def insert_many(self, rows, header=None):
+        """Insert an iterable of rows, a batch of cache_size rows at a time.
+
+        The rows may be dicts or RowProxys, or, if header is given,
+        sequences of values in the order of the header. The rows are cast
+        and converted to positional tuples, then written with the DBAPI
+        executemany(), bypassing the per-row work of insert().
+
+        Returns a list of the cast errors that were not handled by the
+        cast error handler.
+
+        """
+        from itertools import islice
+
+        errors = []
+
+        try:
+            # Write out anything that came in through insert()
+            if self.cache:
+                self.session.execute(self.statement, self.cache)
+                self.cache = []
+
+            rows = iter(rows)
+
+            while True:
+                batch = list(islice(rows, self.cache_size))
+
+                if not batch:
+                    break
+
+                tuples, batch_errors = self._cast_batch(batch, header)
+                errors.extend(batch_errors)
+
+                if self.update_size:
+                    self._update_batch_lengths(tuples)
+
+                self._execute_many(tuples)
+                self.commit_continue()
+
+            return errors
+
+        except (KeyboardInterrupt, SystemExit):
+            if self.bundle:
+                self.bundle.log(
+                    "Processing keyboard interrupt or system exist")
+            else:
+                print "Processing keyboard interrupt or system exist"
+            self.rollback()
+            raise
+        except Exception as e:
+            if self.bundle:
+                self.bundle.error("Insert exception: {}".format(e))
+            else:
+                print "ERROR: Exception during ValueInserter.insert_many: {}".format(e)
+            self.rollback()
+            raise
+
+    def insert_columns(self, columns):
+        """Insert columnar data, a dict of column names to equal length
+        sequences of values."""
+        from itertools import izip
+
+        header = columns.keys()
+
+        return self.insert_many(izip(*[columns[k] for k in header]), header=header)
+
     @property
     def max_lengths(self):
         return dict(zip(self.sizable_fields, self._max_lengths))
 
+    @property
+    def codes(self):
+        """The cast error codes collected by the cast error handler, a dict
+        of sets keyed by column name."""
+        if self.cast_error_handler and hasattr(self.cast_error_handler, 'codes'):
+            return dict(self.cast_error_handler.codes)
+        else:
+            return {}
+
     def __exit__(self, type_, value, traceback):
 
         super(ValueInserter, self).__exit__(type_, value, traceback)
 
+        if self.defer_updates:
+            return
+
         if self.update_size and self.bundle:
             self.bundle.schema.update_lengths(
                 self.table.name,
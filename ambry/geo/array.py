@@ -70,12 +70,27 @@ def add(s, v, m):
 
 
 def apply_copy(kernel, a, func=add, nodata=None, mult=True):
-    """For all cells in a, or all nonzero cells, apply the kernel to a new
-    output array."""
+    """For all cells in a, or all cells that are not nodata, apply the kernel
+    to a new output array.
+
+    With the default add() func and a floating point array, the result is
+    a convolution, which is computed for the whole array at once with
+    Kernel.convolve(). Other funcs are applied one cell at a time.
+
+    """
     from itertools import izip
 
     o = zeros_like(a)
 
+    if func is add and kernel.additive and issubdtype(o.dtype, floating):
+
+        if nodata is not None and nodata != 0:
+            a = where(a != nodata, a, 0)
+
+        o[...] = kernel.convolve(a)
+
+        return o
+
     #
     #  Generate indices,
     if nodata == 0:
@@ -90,6 +105,6 @@ def apply_copy(kernel, a, func=add, nodata=None, mult=True):
         z = ndindex(a.shape)
 
     for row, col in z:
-        kernel.apply(o, Point(col, row), func, a[row, col])
+        kernel.apply(o, Point(col, row), f=func, v=a[row, col])
 
     return o
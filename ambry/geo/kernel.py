@@ -36,6 +36,10 @@ class Kernel(object):
 
         self._dindices = None
 
+    # Kernels that apply() by adding the matrix to the array, so applying the kernel with add()
+    # at every cell of an array is a convolution, which convolve() does all at once.
+    additive = True
+
     def limit(self):
         """Make the matrix spot sort of round, by masking values in the
         corners."""
@@ -44,19 +48,16 @@ class Kernel(object):
         # This assumes that there is a radial gradient.
         row_max = self.matrix[self.center][0]
 
-        for (y_m, x_m), value in np.ndenumerate(self.matrix):
-            if self.matrix[y_m][x_m] > row_max:
-                self.matrix[y_m][x_m] = 0
+        self.matrix[self.matrix > row_max] = 0
 
     def round(self):
         """Make the matrix spot sort of round, using a radius."""
-        import math
-        # Get the max value for the edge of the enclosed circle.
-        # This assumes that there is a radial gradient.
 
-        for (x_m, y_m), value in np.ndenumerate(self.matrix):
-            if math.sqrt((x_m - self.center) ** 2 + (y_m - self.center) ** 2) > float(self.size) / 2.:
-                self.matrix[y_m][x_m] = 0
+        y, x = np.ogrid[0:self.matrix.shape[0], 0:self.matrix.shape[1]]
+
+        r = np.sqrt((x - self.center) ** 2 + (y - self.center) ** 2)
+
+        self.matrix[r > float(self.size) / 2.] = 0
 
     def norm(self):
         #self.matrix /= sum(self.matrix)
@@ -198,7 +199,7 @@ class Kernel(object):
 
         """
 
-        if v:
+        if v is not None:
             from functools import partial
             f = partial(f, v)
 
@@ -218,6 +219,41 @@ class Kernel(object):
                     str(point), str(
                         a.shape)))
 
+    def convolve(self, a):
+        """Return an array where each cell is the sum of the kernel matrix, centered on each
+        cell of a and multiplied by that cell's value. This is the same as apply()ing the kernel
+        with array.add() at every cell, into an array of zeros, but for the whole array at once.
+
+        Uses scipy.ndimage if it is installed, otherwise adds a shifted copy of the array for
+        each nonzero cell of the matrix.
+
+        """
+
+        a = np.asarray(a, dtype=float)
+        m = np.asarray(self.matrix, dtype=float)
+
+        try:
+            from scipy import ndimage
+
+            return ndimage.convolve(a, m, mode='constant', cval=0.0)
+        except ImportError:
+            pass
+
+        o = np.zeros_like(a)
+        y_max, x_max = a.shape
+
+        for i, j in zip(*np.nonzero(m)):
+            dy, dx = i - self.offset, j - self.offset
+
+            if abs(dy) >= y_max or abs(dx) >= x_max:
+                continue
+
+            # Cell (y, x) of a adds to cell (y + dy, x + dx) of the output
+            o[max(dy, 0):y_max + min(dy, 0), max(dx, 0):x_max + min(dx, 0)] += \
+                m[i, j] * a[max(-dy, 0):y_max - max(dy, 0), max(-dx, 0):x_max - max(dx, 0)]
+
+        return o
+
     def iterate(self, a, indices=None):
         """Iterate over kernel sized arrays of the input array.
 
@@ -327,15 +363,17 @@ class DistanceKernel(Kernel):
 
         row_max = size - self.center - 1  # Max value on a horix or vert edge
 
-        for (y_m, x_m), value in np.ndenumerate(self.matrix):
-            r = np.sqrt((y_m - self.center) ** 2 + (x_m - self.center) ** 2)
-            self.matrix[y_m, x_m] = r
+        y_m, x_m = np.ogrid[0:size, 0:size]
+
+        self.matrix[:, :] = np.sqrt((y_m - self.center) ** 2 + (x_m - self.center) ** 2)
 
 
 class MostCommonKernel(ConstantKernel):
 
     """Applies the most common value in the kernel area."""
 
+    additive = False
+
     def __init__(self, size=1):
         super(MostCommonKernel, self).__init__(size, 1)
 
@@ -21,6 +21,23 @@ from sqlalchemy import event
 
 libraries = {}
 
+
+def sqlite_user_version(path):
+    """Return the user_version from the header of a Sqlite database file, or
+    None if the file is not a Sqlite database"""
+    import struct
+
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(100)
+    except IOError:
+        return None
+
+    if len(header) < 100 or not header.startswith('SQLite format 3\x00'):
+        return None
+
+    return struct.unpack('>I', header[60:64])[0]
+
 def _new_library(config):
     from ckcache import new_cache
     from database import LibraryDb
@@ -138,6 +155,9 @@ class Library(object):
     # Names of exernally configurable values.
     configurable = ('warehouse_url')
 
+    # Threads for fetching bundles from remotes in sync_remotes()
+    sync_workers = 8
+
     def __init__(self, cache, database,
                  name=None, remotes=None,
                  source_dir = None,
@@ -191,6 +211,8 @@ class Library(object):
 
         self._search = None
 
+        self._doc_cache_instance = None
+
 
     def clone(self):
 
@@ -301,6 +323,8 @@ class Library(object):
 
         self.database.install_partition(bundle, partition, commit = commit)
 
+        self.mark_updated(vid=partition.identity.vid)
+
         if partition.ref:
            return False, False
 
@@ -1062,18 +1086,26 @@ class Library(object):
 
     def mark_updated(self, o=None, vid=None):
         """Mark an object as recently updated, for instance to clear
-        the doc_cache"""
+        the doc_cache entries that depend on it"""
 
-        self.doc_cache.remove(vid)
+        self.database.resolver_cache.invalidate(vid)
 
-    def sync_library(self, clean = False):
+        self.doc_cache.invalidate(vid)
+
+    def sync_library(self, clean = False, workers=8, batch_size=100):
         '''Rebuild the database from the bundles that are already installed
-        in the repository cache'''
+        in the repository cache
+
+        The cache directory is scanned by a pool of threads, and the files are
+        checked by reading the Sqlite header, so only the database files that
+        aren't already in the library are opened as bundles. The known files
+        are loaded with one query, and the bundles are installed batch_size at
+        a time, with the dataset, partition and file records for a batch in
+        one transaction.
+        '''
 
-        from ..orm import Dataset
+        from ..orm import Dataset, File
         from .files import Files
-        from database import ROOT_CONFIG_NAME_V
-        from ..dbexceptions import ConflictError
 
         assert Files.TYPE.BUNDLE == Dataset.LOCATION.LIBRARY
         assert Files.TYPE.PARTITION == Dataset.LOCATION.PARTITION
@@ -1081,126 +1113,219 @@ class Library(object):
         if clean:
             self.files.query.type(Dataset.LOCATION.REMOTE).delete()
 
+        self.logger.info("Rebuilding from dir {}".format(self.cache.cache_dir))
+
+        known_paths = set()
+        known_refs = {}
+
+        for path, ref, type_ in (self.database.session.query(File.path, File.ref, File.type_)
+                                 .filter(File.type_.in_([Files.TYPE.BUNDLE, Files.TYPE.PARTITION]))
+                                 .all()):
+            if path:
+                known_paths.add(os.path.realpath(path))
+
+            known_refs[(type_, ref)] = path
+
+        paths = [path for path in self._scan_cache_dbs(self.cache.cache_dir, workers)
+                 if os.path.realpath(path) not in known_paths]
+
+        self.logger.info("Found {} database files that are not installed".format(len(paths)))
+
         bundles = []
+        batch = []
 
-        self.logger.info("Rebuilding from dir {}".format(self.cache.cache_dir))
+        for path_ in paths:
 
-        for r, d, f in os.walk(self.cache.cache_dir, topdown=True):
+            b = None
+            try:
+                b = self._create_bundle(path_)
 
-            # Exclude all of the directories which have the same basename
-            # as a database file. These hold only partitions.
-            d[:] = [dr for dr in d if dr + ".db" not in f]
+                try:
+                    bident = b.identity
+                except Exception as e:
+                    self.logger.error("Failed to open bundle from "
+                                      "{}: {} ".format(path_, e))
+                    b.close()
+                    continue
+
+                # The path check above is wrong sometime when there
+                # are symlinks
+                extant = known_refs.get((Files.TYPE.BUNDLE, bident.vid))
+                if extant and os.path.exists(extant):
+                    b.close()
+                    continue
 
-            if '/meta/' in r:
+                if not bident.is_bundle:
+                    b.close()
+                    continue
+
+            except NotFoundError:
+                # Probably a partition, not a bundle.
+                if b:
+                    b.close()
                 continue
+            except Exception as e:
+                self.logger.error('Failed to process {} : {} '
+                                  .format(path_, e))
+                raise
 
-            for file_ in f:
+            batch.append(b)
 
-                if file_.endswith(".db"):
+            if len(batch) >= batch_size:
+                self._install_bundle_batch(batch, known_refs)
+                bundles += batch
+                batch = []
 
-                    path_ = os.path.join(r, file_)
+        if batch:
+            self._install_bundle_batch(batch, known_refs)
+            bundles += batch
 
-                    extant_bundle = (self.files.query.type(Files.TYPE.BUNDLE)
-                                     .path(path_).one_maybe)
-                    extant_partition = (self.files.query
-                                        .type(Files.TYPE.PARTITION)
-                                        .path(path_).one_maybe )
+        self.database.resolver_cache.invalidate()
 
-                    #if (extant_bundle or extant_partition):
-                    #    continue
+        for b in bundles:
+            self.doc_cache.invalidate(b.identity.vid)
 
-                    b = None
-                    try:
-                        b = self._create_bundle( path_)
+        return bundles
 
-                        try:
-                            bident = b.identity
-                        except Exception as e:
-                            self.logger.error("Failed to open bundle from "
-                                              "{}: {} ".format(path_, e))
-                            continue
+    def _scan_cache_dbs(self, root, workers=8):
+        """Return the paths to the database files in the cache that may be
+        bundles, skipping the directories of partitions and the files that
+        aren't Sqlite databases of a schema version we can read"""
+        from multiprocessing.pool import ThreadPool
+        from ..database.sqlite import SqliteDatabase
 
-                        # The path check above is wrong sometime when there
-                        # are symlinks
-                        if (self.files.query.type(Files.TYPE.BUNDLE)
-                                    .ref(bident.vid).one_maybe
-                            and self.get(bident.vid)):
-                            continue
+        def walk(top):
+            found = []
+            for r, d, f in os.walk(top, topdown=True):
 
-                        if b.identity.is_bundle:
-                            bundles.append(b)
+                # Exclude all of the directories which have the same basename
+                # as a database file. These hold only partitions.
+                d[:] = [dr for dr in d if dr + ".db" not in f]
 
-                    except NotFoundError:
-                        # Probably a partition, not a bundle.
-                        pass
-                    except Exception as e:
-                        self.logger.error('Failed to process {}, {} : {} '
-                                          .format(file_, path_, e))
-                        raise
-                    finally:
-                        if b:
-                            b.close()
+                if '/meta/' in r + '/':
+                    continue
 
-        bundles = sorted(bundles, key = lambda b: b.partitions.count)
+                found += [os.path.join(r, file_) for file_ in f if file_.endswith(".db")]
 
-        for bundle in bundles:
+            return found
+
+        try:
+            entries = os.listdir(root)
+        except OSError:
+            return []
+
+        paths = [os.path.join(root, e) for e in entries
+                 if e.endswith('.db') and os.path.isfile(os.path.join(root, e))]
+
+        tops = [os.path.join(root, e) for e in entries
+                if os.path.isdir(os.path.join(root, e)) and e + '.db' not in entries and e != 'meta']
+
+        pool = ThreadPool(workers)
+
+        try:
+            for found in pool.imap_unordered(walk, tops):
+                paths += found
+
+            versions = pool.map(sqlite_user_version, paths)
+
+        finally:
+            pool.close()
+            pool.join()
+
+        dbs = []
+
+        for path, version in zip(paths, versions):
+            if version is None:
+                self.logger.info("Skipping {}: not a Sqlite database".format(path))
+            elif version > SqliteDatabase.SCHEMA_VERSION:
+                self.logger.error("Skipping {}: schema version {} is newer than {}"
+                                  .format(path, version, SqliteDatabase.SCHEMA_VERSION))
+            else:
+                dbs.append(path)
+
+        return sorted(dbs)
+
+    def _install_bundle_batch(self, bundles, known_refs):
+        """Install the records for a batch of bundles in one transaction. If
+        the transaction fails, install them one at a time, so that one bad
+        bundle only loses its own records."""
+        from .files import Files
+
+        def install(bundle, commit):
 
             self.logger.info('Installing: {} '.format(bundle.identity.vname))
 
-            try:
+            self.database.install_bundle(bundle, commit=commit)
 
-                try:
-                    self.database.install_bundle(bundle, commit=True)
-                    installed = True
-                except ConflictError:
-                    installed = False
+            self.files.install_bundle_file(bundle, self.cache,
+                                           commit='collect', check=False)
 
-                try:
-                    self.files.install_bundle_file(bundle, self.cache,
-                                                   commit=True)
+            for p in bundle.partitions:
+                self.logger.info('            {} '
+                                 .format(p.identity.vname))
 
-                    for p in bundle.partitions:
-                        self.logger.info('            {} '
-                                         .format(p.identity.vname))
+                self.database.install_partition(bundle, p,
+                                                commit='collect')
 
-                        if installed:
-                            self.database.install_partition(bundle, p,
-                                                            commit='collect')
+                if (Files.TYPE.PARTITION, p.identity.vid) not in known_refs:
+                    self.files.install_partition_file(p, self.cache,
+                                                      commit='collect', check=False)
+
+        def insert():
+            self.files.insert_collection()
+            self.database.insert_partition_collection()
+            self.database.commit()
 
-                        self.files.install_partition_file(p, self.cache,
-                                                          commit='collect')
+        def reset():
+            self.database.rollback()
+            self.files._collection = []
+            self.database._partition_collection = []
 
+        try:
+            for bundle in bundles:
+                install(bundle, False)
 
-                    self.files.insert_collection()
+            insert()
 
-                    if installed:
-                        self.database.insert_partition_collection()
+        except Exception as e:
+            self.logger.error("Failed to sync batch; installing bundles one at a time: {}".format(e))
+            reset()
 
-                    self.database.commit()
-                    self.database.close()
+            for bundle in bundles:
+                try:
+                    install(bundle, True)
+                    insert()
                 except Exception as e:
                     self.logger.error("Failed to sync {}; {}"
                                       .format(bundle.identity.vname, e))
+                    reset()
 
+        finally:
+            self.database.close()
 
+            for bundle in bundles:
+                known_refs[(Files.TYPE.BUNDLE, bundle.identity.vid)] = bundle.database.path
                 bundle.close()
 
-            except Exception as e:
-                self.logger.error('Failed to install bundle {}: {}'
-                                  .format(bundle.identity.vname, e.message))
-                raise
-                continue
-
-        return bundles
-
     def sync_remotes(self, remotes=None, clean = False,
-                     last_only=True, vids=None):
+                     last_only=True, vids=None, workers=None):
         """Sync the local library with all of the remotes,
-        create static JSON, and  build the full-text search index"""
+        create static JSON, and  build the full-text search index
+
+        The bundle files are fetched by a pool of sync_workers threads, and
+        installed in this thread as they arrive, so there is only one writer
+        to the library database. The remote file record for a bundle is
+        written after the records for its partitions, in the same commit, so
+        the remote records are a checkpoint; an interrupted sync resumes with
+        the bundles that were not finished. Cache keys that are not valid
+        bundles are recorded in the library config, so they are not fetched
+        again.
+        """
         from ..orm import Dataset
-        from sqlalchemy.exc import IntegrityError
-        from ..dbexceptions import NotABundle
+        from ckcache.multi import AltReadCache
+        from multiprocessing.pool import ThreadPool
         import re
+        import json
         from collections import defaultdict
 
         if clean:
@@ -1212,20 +1337,34 @@ class Library(object):
         if not remotes:
             return
 
+        workers = workers or self.sync_workers
+
+        def fetch(cache_key):
+            try:
+                AltReadCache(self.cache, self.remote_stack).get(cache_key)
+                return cache_key, None
+            except Exception as e:
+                return cache_key, e
+
         for remote in remotes:
 
+            if clean:
+                self.database.set_config_value('sync_remotes', remote.repo_id, '[]')
+
             remote_list = remote.list().keys()
 
-            all_keys = [ f.path for f  in
+            all_keys = set( f.path for f  in
                          self.files.query.type(Dataset.LOCATION.REMOTE)
-                             .group(remote.repo_id).all ]
+                             .group(remote.repo_id).all )
+
+            bad = self.database.get_config_value('sync_remotes', remote.repo_id)
+            bad_keys = set(json.loads(bad.value) if bad and bad.value else [])
 
             last_keys = defaultdict(lambda : [0,''] )
 
             use_only = None
 
             if last_only:
-                use_only = []
                 for cache_key in remote_list:
                     # Key without the version
                     nv_key = re.sub(r'-\d+\.\d+\.\d+\.db', '', cache_key)
@@ -1234,12 +1373,13 @@ class Library(object):
                     if version > last_keys[nv_key][0]:
                         last_keys[nv_key] = [version, cache_key]
 
-                for version, cache_key in last_keys.values():
-                    use_only.append(cache_key)
+                use_only = set(cache_key for version, cache_key in last_keys.values())
+
+            keys = []
 
             for cache_key in remote_list:
 
-                if cache_key in all_keys:
+                if cache_key in all_keys or cache_key in bad_keys:
                     continue
 
                 if use_only and cache_key not in use_only:
@@ -1253,68 +1393,104 @@ class Library(object):
                     self.logger.info("Remote {} sync: {}"
                                      .format(remote.repo_id, cache_key))
 
-                b = self._get_bundle_by_cache_key(cache_key)
+                keys.append(cache_key)
 
-                if not b:
-                    self.logger.error("Failed to fetch bundle for {} "
-                                      .format(cache_key))
-                    continue
+            self.logger.info("Remote {}: {} of {} keys to sync"
+                             .format(remote.repo_id, len(keys), len(remote_list)))
 
-                vid =  str(b.identity.vid)
+            pool = ThreadPool(workers)
 
-                if vids and vid not in vids:
-                    continue
+            try:
+                for cache_key, e in pool.imap_unordered(fetch, keys):
 
-                try:
-                    path, installed = self.put_bundle(b, install_partitions=False, commit=True)
+                    if e:
+                        self.logger.error("Failed to fetch bundle for {}: {}"
+                                          .format(cache_key, e))
+                        continue
 
-                except NotABundle:
-                    self.logger.error("Cache key {} exists, "
-                                      "but isn't a valid bundle"
-                                      .format(cache_key))
-                    b.close()
-                    continue
-                except Exception as e:
-                    self.logger.error("Failed to put bundle {}: {}".format(cache_key, e))
-                    b.close()
-                    raise
-                    continue
+                    self._sync_remote_bundle(remote, cache_key, vids, bad_keys)
 
-                try:
-                    self.files.install_remote_bundle(b.identity, remote, {},
-                                                     commit=True)
-                except IntegrityError:
-                    b.close() # Just means we already have it installed
-                    continue
+                pool.close()
 
-                for p in b.partitions:
-                    if installed:
-                        self.database.install_partition(b, p, commit='collect')
+            finally:
+                pool.terminate()
+                pool.join()
 
-                    if self.files.install_remote_partition(p.identity, remote,
-                            {}, commit = 'collect'):
-                        self.logger.info("    + {}".format(p.identity.name))
-                    else:
-                        self.logger.info("    = {}".format(p.identity.name))
+                self.database.resolver_cache.invalidate()
 
+            self.search.commit()
 
+    def _sync_remote_bundle(self, remote, cache_key, vids, bad_keys):
+        """Install the records for one bundle that has been fetched into the
+        cache by sync_remotes()"""
+        from sqlalchemy.exc import IntegrityError
+        from ..dbexceptions import NotABundle
+        import json
 
-                try:
-                    self.files.insert_collection()
-                except IntegrityError as e:
-                    b.close() # Just means we already have it installed
-                    raise
-                    continue
+        b = self._get_bundle_by_cache_key(cache_key)
 
-                if installed:
-                    self.database.insert_partition_collection()
+        if not b:
+            self.logger.error("Failed to fetch bundle for {} "
+                              .format(cache_key))
+            return
 
+        vid =  str(b.identity.vid)
 
-                self.database.commit()
-                self.database.close()
-                b.close()
+        if vids and vid not in vids:
+            b.close()
+            return
 
-            self.search.commit()
+        try:
+            path, installed = self.put_bundle(b, install_partitions=False, commit=True)
+
+        except NotABundle:
+            self.logger.error("Cache key {} exists, "
+                              "but isn't a valid bundle"
+                              .format(cache_key))
+            b.close()
+
+            bad_keys.add(cache_key)
+            self.database.set_config_value('sync_remotes', remote.repo_id,
+                                           json.dumps(sorted(bad_keys)))
+            return
+
+        except Exception as e:
+            self.logger.error("Failed to put bundle {}: {}".format(cache_key, e))
+            b.close()
+            raise
+
+        for p in b.partitions:
+            if installed:
+                self.database.install_partition(b, p, commit='collect')
+
+            if self.files.install_remote_partition(p.identity, remote,
+                    {}, commit = 'collect'):
+                self.logger.info("    + {}".format(p.identity.name))
+            else:
+                self.logger.info("    = {}".format(p.identity.name))
+
+        # The bundle's remote record is the checkpoint, so it is inserted with
+        # the partition records, in one commit.
+        self.files.install_remote_bundle(b.identity, remote, {},
+                                         commit='collect')
+
+        try:
+            self.files.insert_collection()
+        except IntegrityError as e:
+            # Just means we already have it installed
+            self.logger.info("Skipping {}; already installed: {}".format(cache_key, e))
+            self.database.rollback()
+            self.files._collection = []
+            self.database._partition_collection = []
+            b.close()
+            return
+
+        if installed:
+            self.database.insert_partition_collection()
+
+        self.database.commit()
+        self.database.close()
+        b.close()
 
     def sync_source(self, clean=False):
         '''Rebuild the database from the bundles that are already installed
@@ -1324,7 +1500,11 @@ class Library(object):
         if clean:
             self.files.query.type(Dataset.LOCATION.SOURCE).delete()
 
+        synced = []
+
         for ident in self.source._dir_list().values():
+            synced.append(ident.vid)
+
             try:
 
                 path = ident.bundle_path
@@ -1337,6 +1517,13 @@ class Library(object):
 
         self.database.commit()
 
+        self.database.resolver_cache.invalidate()
+
+        self.doc_cache.invalidate(self.doc_cache.ALL)
+
+        for vid in synced:
+            self.doc_cache.invalidate(vid)
+
     def sync_source_dir(self, ident, path):
         from ..dbexceptions import ConflictError
         from sqlalchemy.exc import IntegrityError
@@ -1438,14 +1625,14 @@ class Library(object):
 
     @property
     def doc_cache(self):
-        """Return the documentation cache. """
+        """Return the documentation cache. There is one for the library, so all of its users
+        share the in-memory entries. """
         from ambry.library.doccache import DocCache
 
-        try:
-            return DocCache(self)
-        except ImportError:
-            raise
-            return None
+        if not self._doc_cache_instance:
+            self._doc_cache_instance = DocCache(self)
+
+        return self._doc_cache_instance
 
     @property
     def warehouse_cache(self):
@@ -34,6 +34,10 @@ class LibraryDb(object):
     # Database connection information
     Dbci = namedtuple('Dbc', 'dsn_template sql')
 
+    # Size and time to live, in seconds, of the cache of resolved references
+    resolver_cache_size = 1000
+    resolver_cache_ttl = 300
+
     DBCI = {
         'postgis': Dbci(dsn_template='postgresql+psycopg2://{user}:{password}@{server}{colon_port}/{name}', sql='support/configuration-pg.sql'),
         'postgres': Dbci(dsn_template='postgresql+psycopg2://{user}:{password}@{server}{colon_port}/{name}', sql='support/configuration-pg.sql'),  # Stored in the ambry module.
@@ -70,6 +74,9 @@ class LibraryDb(object):
 
         self._partition_collection = []
 
+        from .query import ResolverCache
+        self.resolver_cache = ResolverCache(self.resolver_cache_size, self.resolver_cache_ttl)
+
         if self.driver in ['postgres', 'postgis']:
             self._schema = 'library'
         else:
@@ -256,6 +263,8 @@ class LibraryDb(object):
 
         self.commit()
 
+        self.resolver_cache.invalidate()
+
     def create(self):
         """Create the database from the base SQL."""
 
@@ -566,6 +575,8 @@ class LibraryDb(object):
 
         import datetime
 
+        self.resolver_cache.invalidate(vid)
+
         self.set_config_value(
             'activity',
             'change',
@@ -666,7 +677,7 @@ class LibraryDb(object):
             # The Tables only get installed when the dataset is installed,
             # not for the partition
 
-        self._mark_update()
+        self._mark_update(vid=bundle.identity.vid)
 
         try:
             dvid = self.get(bundle.identity.vid)
@@ -679,7 +690,7 @@ class LibraryDb(object):
         #   raise ConflictError("Bundle {} already installed".format(bundle.identity.fqname))
 
         try:
-            dataset = self.install_dataset(bundle)
+            dataset = self.install_dataset(bundle, commit=commit)
         except Exception as e:
             raise
             from ..dbexceptions import DatabaseError
@@ -723,7 +734,7 @@ class LibraryDb(object):
                 self.rollback()
                 raise e
 
-    def install_dataset(self, bundle):
+    def install_dataset(self, bundle, commit=True):
         """Install only the most basic parts of the bundle, excluding the
         partitions and tables. Use install_bundle to install everything.
 
@@ -732,6 +743,8 @@ class LibraryDb(object):
         that the dataset does not already exist  before installing
         again.
 
+        If commit is false, the changes are flushed, but not committed.
+
         """
 
         from sqlalchemy.exc import OperationalError
@@ -773,6 +786,11 @@ class LibraryDb(object):
 
             s.query(Column).filter(Column.t_vid == table.vid).delete()
 
+        if not commit:
+            s.flush()
+            s.query(Table).filter(Table.d_vid == dataset.vid).delete()
+            return dataset
+
         s.commit()
 
         s.query(Table).filter(Table.d_vid == dataset.vid).delete()
@@ -919,6 +937,8 @@ class LibraryDb(object):
 
         self.commit()
 
+        self.resolver_cache.invalidate(dataset.vid)
+
     def delete_dataset_colstats(self, dvid):
         """Total hack to deal with not being able to get delete cascades to
         work for colstats.
@@ -988,6 +1008,8 @@ class LibraryDb(object):
 
         s.commit()
 
+        self.resolver_cache.invalidate(vid)
+
     ##
     # Get objects by reference, or resolve a reference
     ##
@@ -1133,7 +1155,7 @@ class LibraryDb(object):
     @property
     def resolver(self):
         from .query import Resolver
-        return Resolver(self.session)
+        return Resolver(self.session, cache=self.resolver_cache)
 
     def find(self, query_command):
         """Find a bundle or partition record by a QueryCommand or Identity.
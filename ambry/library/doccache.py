@@ -3,7 +3,7 @@
 # Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of the
 # Revised BSD License, included in this distribution as LICENSE.txt
 
-from collections import deque
+import threading
 
 
 class Times(object):
@@ -26,10 +26,156 @@ class Times(object):
         return str(self.__dict__)
 
 
+class BoundedCache(object):
+
+    """An in-memory cache, limited by the number of entries and their total size, that evicts the
+    least recently used ( policy='lru' ) or least frequently used ( policy='lfu' ) entries. Entries
+    can have a time to live, in seconds. Values are held pickled, so each get returns a new copy
+    that the caller can modify, and the size of an entry is the length of its pickle. If on_evict
+    is given, it is called with the key of each entry that is evicted or expires."""
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, policy='lru', on_evict=None):
+        from collections import OrderedDict
+
+        assert policy in ('lru', 'lfu')
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_evict = on_evict
+
+        self._entries = OrderedDict()  # key -> [pickled value, size, expires, hits]
+        self._lock = threading.RLock()
+
+        self.bytes = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key)[0]
+
+    def get(self, key):
+        """Return (True, value) for a live entry, or (False, None)"""
+        import time
+        import cPickle
+
+        with self._lock:
+            e = self._entries.get(key)
+
+            if e is None:
+                return False, None
+
+            if e[2] and e[2] < time.time():
+                self._expire(key)
+                return False, None
+
+            e[3] += 1
+
+            # Move to the end, the most recently used
+            del self._entries[key]
+            self._entries[key] = e
+
+            data = e[0]
+
+        return True, cPickle.loads(data)
+
+    def put(self, key, value, ttl=None):
+        import time
+        import cPickle
+
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._remove(key)
+
+            self._entries[key] = [data, len(data), time.time() + ttl if ttl else None, 0]
+            self.bytes += len(data)
+
+            self._evict()
+
+    def _remove(self, key):
+        e = self._entries.pop(key, None)
+
+        if e is not None:
+            self.bytes -= e[1]
+
+    def _expire(self, key):
+        self._remove(key)
+
+        if self.on_evict:
+            self.on_evict(key)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _evict(self):
+        import time
+
+        if len(self._entries) <= self.max_entries and self.bytes <= self.max_bytes:
+            return
+
+        # Expired entries go first
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if e[2] and e[2] < now]:
+            self._expire(key)
+            self.evictions += 1
+
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+
+            if self.policy == 'lfu':
+                key = min(self._entries.items(), key=lambda item: item[1][3])[0]
+            else:
+                key = next(iter(self._entries))
+
+            self._expire(key)
+            self.evictions += 1
+
+
 class DocCache(object):
 
-    def __init__(self, library, cache=None):
+    """Cache for the documents generated from library objects, for the web UI and API.
+
+    Documents are held in a BoundedCache in memory, and, if the library has a doc cache
+    configured, written through to it. Entries are grouped by kind, such as 'bundle' or
+    'library_info', for the TTLs in ``ttls`` and for the statistics. Entries with a TTL are
+    only held in memory. Concurrent misses for the same key wait for a single computation.
+
+    Each entry records the vids it was derived from, so invalidate() can remove just the
+    entries that depend on an object that changed. Entries that are derived from the whole
+    library depend on ALL. The dependencies of an entry are dropped when it is evicted from
+    memory. The written-through copy stays, and its dependencies are written through too, so
+    invalidate() can still remove it after it is evicted, or after a restart.
+
+    """
+
+    ALL = '*'
+
+    # Keys of the entries that are derived from the whole library
+    aggregate_keys = ('library_info', 'bundle_index', 'table_version_map')
+
+    # TTLs, in seconds, by kind. Kinds that aren't listed live until they are evicted or removed
+    ttls = {
+        'library_info': 60,
+        'bundle_index': 600,
+        'table_version_map': 600
+    }
+
+    def __init__(self, library, cache=None, max_entries=2000, max_bytes=128 * 1024 * 1024,
+                 policy='lru', ttls=None):
         import platform
+        from collections import defaultdict
 
         self.library = library
 
@@ -37,10 +183,23 @@ class DocCache(object):
             from ckcache.dictionary import DictCache
             self._cache = DictCache(self.library._doc_cache)
         else:
-            self._cache = {}
+            self._cache = None
+
+        self._memory = BoundedCache(max_entries=max_entries, max_bytes=max_bytes, policy=policy,
+                                    on_evict=self._evicted)
+
+        if ttls:
+            self.ttls = dict(self.ttls, **ttls)
+
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> Event, for computations in progress
+        self._deps = defaultdict(set)  # vid -> keys of the entries derived from it
+        self._key_deps = {}  # key -> vids, the reverse of _deps
+
+        # Aggregated Times, keyed by (kind, from_cache)
+        self._times = defaultdict(Times)
 
         self.all_bundles = None
-        self.times = deque([], maxlen=10000)
         # if True, assume the next quest to cache the key does not exist
         self.ignore_cache = False
 
@@ -48,6 +207,16 @@ class DocCache(object):
         # gvid keys
         self.prefix_upper = platform.system() == 'Darwin'
 
+    def for_library(self, library):
+        """Return a DocCache for another library that shares the entries, dependencies and
+        statistics of this one, so an invalidation through either applies to both."""
+        import copy
+
+        dc = copy.copy(self)
+        dc.library = library
+
+        return dc
+
     def _munge_key(self, *args, **kwargs):
 
         import string
@@ -93,59 +262,261 @@ class DocCache(object):
 
         start = time.time()
 
+        kind = kwargs.pop('_kind', None) or kwargs.get('_key') or kwargs.get('_key_prefix') or 'object'
+        deps = kwargs.pop('_deps', None) or [str(arg) for arg in args]
+
         key, args, kwargs = self._munge_key(*args, **kwargs)
 
-        if key not in self._cache or kwargs.get('force') or self.ignore_cache:
-            self._cache[key] = f(*args, **kwargs)
-            from_cache = False
-        else:
-            from_cache = True
+        self._add_deps(key, deps)
 
-        end = time.time()
+        ttl = self.ttls.get(kind)
 
-        self.times.append(
-            Times(
-                start_time=start,
-                end_time=end,
-                key=key,
-                from_cache=from_cache,
-                count=1,
-                time=end -
-                start))
+        refresh = kwargs.get('force') or self.ignore_cache
 
-        return self._cache[key]
+        while True:
+            if not refresh:
+                found, value = self._get(key, ttl)
 
-    def clean(self):
+                if found:
+                    self._record(kind, True, start)
+                    return value
+
+            with self._lock:
+                event = self._inflight.get(key)
+
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+
+            # Another thread is computing the value, so wait for it, then get it from the cache.
+            # If that thread failed, the loop will compute the value here.
+            event.wait()
+            refresh = False
 
         try:
-            self._cache.clean()
+            value = f(*args, **kwargs)
+            self._put(key, value, ttl, deps)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+            event.set()
+
+        self._record(kind, False, start)
+
+        return value
+
+    def _get(self, key, ttl):
+
+        found, value = self._memory.get(key)
+
+        if found:
+            return True, value
+
+        if self._cache is not None and ttl is None and key in self._cache:
+            value = self._cache[key]
+            self._memory.put(key, value)
+            return True, value
+
+        return False, None
+
+    def _put(self, key, value, ttl, deps=()):
+
+        self._memory.put(key, value, ttl)
+
+        if self._cache is not None and ttl is None:
+            self._cache[key] = value
+            self._persist_deps(key, deps)
+
+    def _deps_key(self, vid):
+        """Key of the persisted list of the keys of the entries derived from a vid"""
+        return self._munge_key(_key='deps_' + str(vid), _key_prefix='deps')[0]
+
+    def _persist_deps(self, key, deps):
+
+        with self._lock:
+            for vid in deps:
+                if vid:
+                    dk = self._deps_key(vid)
+                    keys = self._cache[dk] if dk in self._cache else []
+
+                    if key not in keys:
+                        self._cache[dk] = keys + [key]
+
+    def _add_deps(self, key, deps):
+
+        with self._lock:
+            for vid in deps:
+                if vid:
+                    self._deps[vid].add(key)
+                    self._key_deps.setdefault(key, set()).add(vid)
+
+    def _drop_deps(self, key):
+
+        with self._lock:
+            for vid in self._key_deps.pop(key, ()):
+                keys = self._deps.get(vid)
+
+                if keys is not None:
+                    keys.discard(key)
+
+                    if not keys:
+                        del self._deps[vid]
+
+    def _evicted(self, key):
+        """Called by the BoundedCache when an entry is evicted or expires"""
+
+        self._drop_deps(key)
+
+    @staticmethod
+    def _dataset_vid(vid):
+        """Return the vid of the dataset for an object number, or None if it isn't one"""
+        from ..identity import ObjectNumber
+
+        try:
+            on = ObjectNumber.parse(str(vid))
+        except Exception:
+            return None
+
+        try:
+            return str(on.as_dataset)
         except AttributeError:
-            assert isinstance(self._cache, dict)
-            self._cache = {}
+            return str(on)
+
+    def _with_dataset(self, vid):
+        """Dependencies for an object that is part of a dataset, such as a table or partition"""
+        return [vid, self._dataset_vid(vid)]
+
+    def invalidate(self, vid=None):
+        """Remove the entries that were derived from the object with the given vid, or its
+        dataset, and the entries derived from the whole library. With no vid, remove everything.
+
+        Returns the keys that were removed.
+
+        """
+
+        if vid is None:
+            self.clean()
+            return None
+
+        vids = set([str(vid), self._dataset_vid(vid), self.ALL]) - set([None])
+
+        with self._lock:
+            keys = set()
+            for v in vids:
+                keys |= self._deps.pop(v, set())
+
+            # Persisted entries that have been evicted, or not loaded in this process, aren't in _deps
+            if self._cache is not None:
+                for v in vids:
+                    dk = self._deps_key(v)
+
+                    if dk in self._cache:
+                        keys |= set(self._cache[dk])
+                        del self._cache[dk]
+
+        for v in vids - set([self.ALL]):
+            for key_prefix in (None, 'ds', 'bs'):
+                if key_prefix:
+                    keys.add(self._munge_key(v, _key_prefix=key_prefix)[0])
+                else:
+                    keys.add(self._munge_key(v)[0])
+
+        for k in self.aggregate_keys:
+            keys.add(self._munge_key(_key=k)[0])
+
+        for key in keys:
+            self._remove_key(key)
+
+        return keys
+
+    def _record(self, kind, from_cache, start):
+        import time
+
+        end = time.time()
+
+        with self._lock:
+            t = self._times[(kind, from_cache)]
+            t.key = kind
+            t.from_cache = from_cache
+            t.count += 1
+            t.time += end - start
+            t.start_time = t.start_time or start
+            t.end_time = end
+
+    def clean(self):
+
+        self._memory.clear()
+
+        with self._lock:
+            self._deps.clear()
+            self._key_deps.clear()
+
+        if self._cache is not None:
+            self._cache.clean()
 
     def remove(self, *args, **kwargs):
 
         key, args, kwargs = self._munge_key(*args, **kwargs)
 
-        if key in self._cache:
+        self._remove_key(key)
+
+    def _remove_key(self, key):
+
+        self._memory.remove(key)
+        self._drop_deps(key)
+
+        if self._cache is not None and key in self._cache:
             del self._cache[key]
 
     def compiled_times(self):
-        """Compile all of the time entries from cache calls to one per key."""
-        from collections import defaultdict
+        """Return the time entries from cache calls, aggregated to one per kind of entry and
+        whether it came from the cache or the function."""
 
-        times = defaultdict(Times)
+        with self._lock:
+            times = [Times(**t.__dict__) for t in self._times.values()]
 
-        for t in self.times:
-            print t.__dict__
-            k = t.key + '_' + ('cached' if t.from_cache else 'func')
-            ct = times[k]
-            ct.key = k
+        for t in times:
+            t.key = t.key + '_' + ('cached' if t.from_cache else 'func')
 
-            ct.time += t.time
-            ct.count += t.count
+        return sorted(times, key=lambda x: x.time, reverse=True)
 
-        return sorted(times.values(), key=lambda x: x.time, reverse=True)
+    def report(self):
+        """Return the hit rate and mean latencies for each kind of entry, along with the
+        size of the in-memory cache."""
+        from collections import defaultdict
+
+        kinds = defaultdict(lambda: dict(hits=0, misses=0, hit_time=0.0, miss_time=0.0))
+
+        with self._lock:
+            for (kind, from_cache), t in self._times.items():
+                k = kinds[kind]
+                if from_cache:
+                    k['hits'], k['hit_time'] = t.count, t.time
+                else:
+                    k['misses'], k['miss_time'] = t.count, t.time
+
+        def summarize(k):
+            total = k['hits'] + k['misses']
+            return dict(
+                hits=k['hits'],
+                misses=k['misses'],
+                hit_rate=float(k['hits']) / total if total else None,
+                mean_hit_ms=1000 * k['hit_time'] / k['hits'] if k['hits'] else None,
+                mean_miss_ms=1000 * k['miss_time'] / k['misses'] if k['misses'] else None)
+
+        all_ = dict(hits=0, misses=0, hit_time=0.0, miss_time=0.0)
+        for k in kinds.values():
+            for n, v in k.items():
+                all_[n] += v
+
+        return dict(
+            kinds={kind: summarize(k) for kind, k in kinds.items()},
+            total=summarize(all_),
+            entries=len(self._memory),
+            bytes=self._memory.bytes,
+            evictions=self._memory.evictions
+        )
 
     def library_info(self):
         pass
@@ -157,13 +528,15 @@ class DocCache(object):
     def library_info(self):
         return self.cache(
             lambda: self.library.summary_dict,
-            _key='library_info')
+            _key='library_info',
+            _deps=[self.ALL])
 
     def bundle_index(self):
 
         return self.cache(
             lambda: self.library.versioned_datasets(),
-            _key='bundle_index')
+            _key='bundle_index',
+            _deps=[self.ALL])
 
     def table_index(self):
         pass
@@ -178,34 +551,39 @@ class DocCache(object):
         return self.cache(
             lambda vid: self.library.dataset(vid).dict,
             vid,
-            _key_prefix='ds')
+            _key_prefix='ds',
+            _kind='dataset')
 
     def bundle_summary(self, vid):
         return self.cache(
             lambda vid: self.library.bundle(vid).summary_dict,
             vid,
-            _key_prefix='bs')
+            _key_prefix='bs',
+            _kind='bundle_summary')
 
     def bundle(self, vid):
-        return self.cache(lambda vid: self.library.bundle(vid).dict, vid)
+        return self.cache(lambda vid: self.library.bundle(vid).dict, vid, _kind='bundle')
 
     def bundle_schema(self, vid):
         pass
 
     def partition(self, vid):
 
-        return self.cache(lambda vid: self.library.partition(vid).dict, vid)
+        return self.cache(lambda vid: self.library.partition(vid).dict, vid, _kind='partition',
+                          _deps=self._with_dataset(vid))
 
     def table(self, vid):
         return self.cache(
             lambda vid: self.library.table(vid).nonull_col_dict,
-            vid)
+            vid,
+            _kind='table',
+            _deps=self._with_dataset(vid))
 
     def table_schema(self, vid):
         pass
 
     def warehouse(self, vid):
-        return self.cache(lambda vid: self.library.warehouse(vid).dict, vid)
+        return self.cache(lambda vid: self.library.warehouse(vid).dict, vid, _kind='warehouse')
 
     def manifest(self, vid):
 
@@ -213,7 +591,7 @@ class DocCache(object):
             f, m = self.library.manifest(vid)
             return m.dict
 
-        self.cache(f, vid)
+        self.cache(f, vid, _kind='manifest')
 
     def table_version_map(self):
         """Map unversioned table ids to vids."""
@@ -231,7 +609,7 @@ class DocCache(object):
 
             return tm
 
-        return self.cache(f, _key='table_version_map')
+        return self.cache(f, _key='table_version_map', _deps=[self.ALL])
 
     ##
     # Manifests
@@ -207,19 +207,23 @@ class Files(object):
                 s.rollback()
                 raise
 
-        self.db._mark_update()
+        self.db._mark_update(vid=f.ref)
 
     def install_bundle_file(
             self,
             bundle,
             cache,
             commit=True,
-            state='installed'):
-        """Mark a bundle file as having been installed in the library."""
+            state='installed',
+            check=True):
+        """Mark a bundle file as having been installed in the library.
+
+        If check is false, the caller has already checked that the file is
+        not installed."""
 
         ident = bundle.identity
 
-        if self.query.group(cache.repo_id).type(Files.TYPE.BUNDLE).ref(ident.vid).one_maybe:
+        if check and self.query.group(cache.repo_id).type(Files.TYPE.BUNDLE).ref(ident.vid).one_maybe:
             return False
 
         return self.new_file(
@@ -238,12 +242,16 @@ class Files(object):
             partition,
             cache,
             commit=True,
-            state='installed'):
-        """Mark a partition file as having been installed in the library."""
+            state='installed',
+            check=True):
+        """Mark a partition file as having been installed in the library.
+
+        If check is false, the caller has already checked that the file is
+        not installed."""
 
         ident = partition.identity
 
-        if self.query.group(cache.repo_id).type(Files.TYPE.PARTITION).ref(ident.vid).one_maybe:
+        if check and self.query.group(cache.repo_id).type(Files.TYPE.PARTITION).ref(ident.vid).one_maybe:
             return False
 
         return self.new_file(
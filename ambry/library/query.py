@@ -277,14 +277,150 @@ class QueryCommand(object):
         return str(self._dict)
 
 
+def _dataset_id(ref):
+    """Return the dataset id, without a revision, for an object number string,
+    or None if the string isn't an object number."""
+    from ..identity import ObjectNumber
+
+    try:
+        on = ObjectNumber.parse(str(ref))
+    except Exception:
+        return None
+
+    if on is None:
+        return None
+
+    ds = on if isinstance(on, DatasetNumber) else on.dataset
+
+    return str(ds.rev(None))
+
+
+def _copy_identity(ident):
+    """Deep copy an identity, sharing the ORM File records, which can't be
+    copied."""
+    from copy import deepcopy
+
+    if not ident:
+        return ident
+
+    memo = {}
+
+    for i in [ident] + (ident.partitions.values() if ident.partitions else []):
+        for f in i.files or []:
+            memo[id(f)] = f
+
+    return deepcopy(ident, memo)
+
+
+class ResolverCache(object):
+
+    """LRU cache, with a time to live, for the results of
+    Resolver.resolve_ref_one(), keyed on the reference and location.
+
+    Entries are dropped with invalidate(). With a vid, only the entries that
+    could have changed are dropped: the ones for that dataset, the ones for
+    names, which may now resolve to a different version, and the ones that
+    didn't resolve.
+
+    """
+
+    def __init__(self, maxsize=1000, maxtime=300):
+        from collections import OrderedDict
+        import threading
+
+        self.maxsize = maxsize
+        self.maxtime = maxtime
+
+        self._cache = OrderedDict()  # key -> (expire_time, dataset id, (ip, ident))
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(ref, location):
+
+        if isinstance(location, (list, tuple, set)):
+            location = tuple(sorted(location))
+
+        return str(ref), location
+
+    def get(self, key):
+        """Return a copy of the (ip, ident) result for a key, or None."""
+        from time import time
+
+        with self._lock:
+            try:
+                expire_time, _, result = self._cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expire_time < time():
+                self.misses += 1
+                return None
+
+            self._cache[key] = expire_time, _, result  # Move to the end, most recently used
+            self.hits += 1
+
+        ip, ident = result
+
+        return ip, _copy_identity(ident)
+
+    def put(self, key, result):
+        """Store a copy of an (ip, ident) result."""
+        from time import time
+
+        ip, ident = result
+
+        if ident:
+            d_id = _dataset_id(ident.vid)
+        elif ip and ip.on:
+            d_id = _dataset_id(ip.on)
+        else:
+            d_id = None
+
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = time() + self.maxtime, d_id, (ip, _copy_identity(ident))
+
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, vid=None):
+        """Drop the entries that may be changed by an update to vid, or all of
+        the entries, if vid is None."""
+
+        d_id = _dataset_id(vid) if vid else None
+
+        with self._lock:
+            if not d_id:
+                self._cache.clear()
+                return
+
+            for key, (_, e_d_id, (ip, ident)) in self._cache.items():
+                if not ident or e_d_id == d_id or not (ip and ip.on):
+                    del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._cache))
+
+
 class Resolver(object):
 
     """Find a reference to a dataset or partition based on a string, which may
     be a name or object number."""
 
-    def __init__(self, session):
+    def __init__(self, session, cache=None):
 
         self.session = session  # a Sqlalchemy connection
+        self.cache = cache  # a ResolverCache
 
     def _resolve_ref_orm(self, ref):
         from ..identity import Locations
@@ -387,6 +523,21 @@ class Resolver(object):
 
     def resolve_ref_one(self, ref, location=None):
         """Return the "best" result for an object specification."""
+
+        if self.cache is None:
+            return self._resolve_ref_one(ref, location)
+
+        key = self.cache.key(ref, location)
+
+        result = self.cache.get(key)
+
+        if result is None:
+            result = self._resolve_ref_one(ref, location)
+            self.cache.put(key, result)
+
+        return result
+
+    def _resolve_ref_one(self, ref, location=None):
         import semantic_version
         from collections import OrderedDict
 
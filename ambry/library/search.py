@@ -56,13 +56,22 @@ class Search(object):
         self._dataset_index = None
         self._partition_index = None
         self._identifier_index = None
+        self._identifier_lookup = None
+
+        self.i_lookup_file = os.path.join(os.path.dirname(self.i_index_dir), 'identifiers.idx')
 
         self._dataset_writer = None
         self._partition_writer = None
 
+        # Digests of the documents for each dataset when it was last indexed by index_library()
+        self.watermark_file = os.path.join(os.path.dirname(self.d_index_dir), 'watermarks.json')
+
     def reset(self):
         from shutil import rmtree
 
+        if os.path.exists(self.watermark_file):
+            os.remove(self.watermark_file)
+
         if os.path.exists(self.d_index_dir):
             rmtree(self.d_index_dir)
 
@@ -168,23 +177,198 @@ class Search(object):
 
     def index_datasets(self):
 
-        ds_vids = [ds.vid for ds in self.library.datasets()]
+        self.index_library()
+
+    def index_library(self, force=False, procs=None, limitmb=128):
+        """Incrementally index all of the datasets and partitions in the library.
+
+        The documents are built from the library database, with a few bulk queries, rather than by
+        opening each bundle. A digest of the documents for each dataset is saved as a watermark,
+        so only the datasets that are new or have changed since the last run are written to the
+        indexes, with Whoosh's multiprocessing writer if procs is more than 1. Datasets that have
+        been removed from the library are removed from the indexes.
+
+        Returns the vids of the datasets that were indexed.
+
+        """
+        import json
+        from multiprocessing import cpu_count
+
+        self.commit()  # Can only have one writer on an index
+
+        if procs is None:
+            procs = min(cpu_count(), 4)
+
+        watermarks = {}
+
+        if not force and os.path.exists(self.watermark_file):
+            with open(self.watermark_file) as f:
+                watermarks = json.load(f)
+
+        d_docs, p_docs = self._library_docs()
+
+        digests = {vid: self._docs_digest(d_docs[vid], p_docs.get(vid, [])) for vid in d_docs}
+
+        changed = sorted(vid for vid, digest in digests.items() if watermarks.get(vid) != digest)
+        removed = sorted(vid for vid in watermarks if vid not in d_docs)
+
+        if not changed and not removed:
+            return []
+
+        def writer(index):
+            if procs > 1:
+                return index.writer(procs=procs, limitmb=limitmb)
+            else:
+                return index.writer(limitmb=limitmb)
+
+        d_writer = writer(self.dataset_index)
+        p_writer = writer(self.partition_index)
+
+        try:
+            for vid in removed:
+                d_writer.delete_by_term('vid', unicode(vid))
+                p_writer.delete_by_term('bvid', unicode(vid))
+
+            for vid in changed:
+                # update_document() would delete on bvid, which is shared by the partitions of a
+                # dataset, so the partitions are replaced explicitly.
+                d_writer.update_document(**d_docs[vid])
+
+                p_writer.delete_by_term('bvid', unicode(vid))
+
+                for d in p_docs.get(vid, []):
+                    p_writer.add_document(**d)
+
+        except:
+            d_writer.cancel()
+            p_writer.cancel()
+            raise
+
+        d_writer.commit()
+        p_writer.commit()
+
+        with open(self.watermark_file, 'w') as f:
+            json.dump(digests, f)
+
+        self.all_datasets.update(changed)
+        self.all_datasets.difference_update(removed)
+        self.all_partitions.update(d['vid'] for vid in changed for d in p_docs.get(vid, []))
+
+        return changed
+
+    @staticmethod
+    def _docs_digest(d_doc, p_docs):
+        import hashlib
+
+        h = hashlib.md5()
 
-        for vid in ds_vids:
+        for d in [d_doc] + sorted(p_docs, key=lambda d: d['vid']):
+            for k in sorted(d):
+                h.update(k)
+                h.update(d[k].encode('utf8'))
 
-            if vid in self.all_datasets:
+        return h.hexdigest()
+
+    def _library_docs(self):
+        """Build the dataset and partition documents for all of the datasets in the library from
+        the library database. Returns a dict of dataset documents, keyed by vid, and a dict of
+        lists of partition documents, keyed by the dataset vid."""
+        from collections import defaultdict
+        from ..orm import Dataset, Partition, Table, Column, Config, ColumnStat
+        from .database import ROOT_CONFIG_NAME_V
+
+        s = self.library.database.session
+
+        def u(v):
+            return unicode(v) if v is not None else u''
+
+        config_keys = ['about.title', 'about.summary', 'documentation.main',
+                       'coverage.grain', 'coverage.geo', 'coverage.time']
+
+        config = defaultdict(dict)
+
+        for d_vid, key, value in (s.query(Config.d_vid, Config.key, Config.value)
+                                  .filter(Config.group == 'config', Config.key.in_(config_keys))):
+            config[d_vid][key] = value
+
+        # Columns lines for the dataset docs, and the schema and title for the partition docs
+        ds_columns = defaultdict(list)
+        t_schema = defaultdict(list)
+        t_description = {}
+
+        for row in (s.query(Table.d_vid, Table.vid, Table.name, Table.description, Column.id_,
+                            Column.vid, Column.name, Column.altname, Column.description)
+                    .join(Column, Column.t_vid == Table.vid)
+                    .order_by(Table.vid, Column.sequence_id)):
+
+            d_vid, t_vid, t_name, t_desc, c_id, c_vid, c_name, c_altname, c_desc = row
+
+            ds_columns[d_vid].append(u' '.join(u(x) for x in (t_name, c_name, c_desc)))
+            t_schema[t_vid].append(u' '.join(u(x) for x in (c_id, c_vid, c_name, c_altname, c_desc)))
+            t_description[t_vid] = t_desc
+
+        d_docs = {}
+
+        for vid, id_, name, vname, source in (s.query(Dataset.vid, Dataset.id_, Dataset.name,
+                                                      Dataset.vname, Dataset.source)
+                                              .filter(Dataset.vid != ROOT_CONFIG_NAME_V)):
+            c = config[vid]
+
+            doc = u'\n'.join([u(c.get('about.title')), u(c.get('about.summary')), u(id_), u(vid), u(source),
+                              u(name), u(vname), u(c.get('documentation.main')),
+                              u'\n'.join(ds_columns[vid])])
+
+            coverage = u' '.join(u(x) for key in ('coverage.grain', 'coverage.geo', 'coverage.time')
+                                 for x in (c.get(key) or []))
+
+            d_docs[vid] = dict(
+                vid=u(vid),
+                title=u(name) + u' ' + u(c.get('about.title')),
+                names=u' '.join([u(vid), u(id_), u(name), u(vname)]),
+                source=u(source),
+                doc=doc,
+                coverage=coverage
+            )
+
+        values = defaultdict(list)
+
+        for p_vid, uvalues in (s.query(ColumnStat.p_vid, ColumnStat.uvalues)
+                               .filter(ColumnStat.uvalues != None)
+                               .order_by(ColumnStat.id)):
+            if uvalues:
+                values[p_vid].append(u' '.join(u(x) for x in uvalues) + u'\n')
+
+        p_docs = defaultdict(list)
+
+        for vid, id_, name, vname, d_vid, t_vid, data in (s.query(Partition.vid, Partition.id_, Partition.name,
+                                                                  Partition.vname, Partition.d_vid,
+                                                                  Partition.t_vid, Partition.data)):
+            if d_vid not in d_docs:
                 continue
 
-            bundle = self.library.bundle(vid)
+            data = data or {}
 
-            self.index_dataset(bundle)
+            schema = u'\n'.join(t_schema[t_vid])
+            p_values = u''.join(values[vid])
 
-            for p in bundle.partitions:
-                self.index_partition(p)
+            coverage = (
+                u'\n'.join(u(x) for x in data.get('geo_coverage', [])) + u'\n' +
+                u'\n'.join(u(x) for x in data.get('geo_grain', [])) + u'\n' +
+                u'\n'.join(u(x) for x in data.get('time_coverage', []))
+            )
 
-            bundle.close()
+            p_docs[d_vid].append(dict(
+                vid=u(vid),
+                bvid=u(d_vid),
+                names=u' '.join([u(vid), u(id_), u(name), u(vname)]),
+                title=u(t_description.get(t_vid)),
+                schema=schema,
+                coverage=coverage,
+                values=p_values,
+                doc=coverage + u'\n' + p_values + u'\n' + schema
+            ))
 
-        self.commit()
+        return d_docs, p_docs
 
     @property
     def datasets(self):
@@ -448,7 +632,62 @@ class Search(object):
 
         writer.commit()
 
+        self.build_identifier_lookup()
+
+    @property
+    def identifier_lookup(self):
+        """The memory mapped IdentifierLookup, or None if it hasn't been built"""
+
+        if not self._identifier_lookup and os.path.exists(self.i_lookup_file):
+            try:
+                self._identifier_lookup = IdentifierLookup(self.i_lookup_file)
+            except ValueError:  # Written by an older version; index_identifiers() will rewrite it
+                return None
+
+        return self._identifier_lookup
+
+    def build_identifier_lookup(self):
+        """Write the IdentifierLookup file from the documents in the identifier index"""
+
+        if self._identifier_lookup:
+            self._identifier_lookup.close()
+            self._identifier_lookup = None
+
+        IdentifierLookup.write(self.i_lookup_file, ((x['identifier'], x['name']) for x in self.identifiers))
+
     def search_identifiers(self, search_phrase, limit=10):
+        """Yield (score, identifier, name) for the identifiers whose names best match the search
+        phrase. Uses the identifier lookup if it exists, falling back to a full text search
+        of the identifier index if the lookup has no matches."""
+
+        if self.identifier_lookup:
+            results = self.identifier_lookup.search(search_phrase, limit=limit)
+
+            if results:
+                for r in results:
+                    yield r
+
+                return
+
+        for r in self._search_identifier_index(search_phrase, limit=limit):
+            yield r
+
+    def search_identifiers_many(self, search_phrases, limit=10):
+        """Like search_identifiers(), for a collection of search phrases at once. Returns a dict of
+        lists of results, keyed by search phrase."""
+
+        if self.identifier_lookup:
+            results = self.identifier_lookup.search_many(search_phrases, limit=limit)
+        else:
+            results = {}
+
+        for phrase in search_phrases:
+            if not results.get(phrase):
+                results[phrase] = list(self._search_identifier_index(phrase, limit=limit))
+
+        return results
+
+    def _search_identifier_index(self, search_phrase, limit=10):
 
         from whoosh.qparser import QueryParser
         from whoosh import scoring
@@ -521,6 +760,163 @@ class Search(object):
         return m
 
 
+class IdentifierLookup(object):
+
+    """A compact, memory mapped lookup from place names to identifiers, for resolving geographic
+    names without a full text query.
+
+    The file holds a sorted table of keys, one for each suffix of the words of each normalized
+    name, so a term matches a name if it is one of the name's keys, or the leading words of one.
+    Lookups bisect the table in the mapped file, so opening the lookup doesn't require reading it.
+
+    Layout: MAGIC, the number of records and the number of names as uint32s, the average number
+    of words in a name as a double, n+1 uint32 record offsets, then the records, each 'key, word
+    position, identifier, name' in UTF-8, separated by SEP.
+
+    """
+
+    MAGIC = 'AMBRYIDL2\n'
+    SEP = '\x1f'
+
+    def __init__(self, path):
+        import mmap
+        import struct
+
+        self.path = path
+
+        self._f = open(path, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(self.MAGIC)] != self.MAGIC:
+            self.close()
+            raise ValueError("Not an identifier lookup file: {}".format(path))
+
+        self._n, self._n_names, self._avg_words = struct.unpack_from('<IId', self._mm, len(self.MAGIC))
+        self._offsets = len(self.MAGIC) + struct.calcsize('<IId')
+        self._data = self._offsets + 4 * (self._n + 1)
+
+    def __len__(self):
+        return self._n
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+    @staticmethod
+    def normalize(name):
+        """Lowercase, and reduce to words separated by single spaces"""
+        import re
+
+        return u' '.join(re.findall(r'\w+', unicode(name).lower(), re.UNICODE))
+
+    @classmethod
+    def write(cls, path, identifiers):
+        """Write a lookup file for an iterable of (identifier, name) pairs."""
+        import struct
+
+        records = []
+        n_names = 0
+        n_words = 0
+
+        for identifier, name in identifiers:
+            words = cls.normalize(name).split()
+            n_names += 1
+            n_words += len(words)
+            fields = [unicode(identifier).encode('utf8'), unicode(name).encode('utf8')]
+
+            for pos in range(len(words)):
+                key = u' '.join(words[pos:]).encode('utf8')
+                records.append(cls.SEP.join([key, str(pos)] + fields))
+
+        records.sort()
+
+        offsets = [0]
+        for r in records:
+            offsets.append(offsets[-1] + len(r))
+
+        tmp = path + '.tmp'
+
+        with open(tmp, 'wb') as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack('<IId', len(records), n_names, float(n_words) / max(n_names, 1)))
+            f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+
+            for r in records:
+                f.write(r)
+
+        os.rename(tmp, path)
+
+    def _record(self, i):
+        import struct
+
+        start, end = struct.unpack_from('<II', self._mm, self._offsets + 4 * i)
+
+        return self._mm[self._data + start:self._data + end]
+
+    def _bisect(self, key):
+        """Index of the first record that is not less than key"""
+        lo, hi = 0, self._n
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._record(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def search(self, term, limit=10):
+        """Return a list of (score, identifier, name) for the names that contain the words of the
+        term, best first. The score is the one the identifier index search uses: matches early in
+        the name and short terms score higher, plus the BM25 score of the term in the name."""
+        import math
+
+        term = self.normalize(term)
+
+        if not term:
+            return []
+
+        key = term.encode('utf8')
+
+        matches = {}
+
+        for i in xrange(self._bisect(key), self._n):
+            r_key, pos, identifier, name = self._record(i).split(self.SEP)
+
+            if not r_key.startswith(key):
+                break
+
+            if len(r_key) > len(key) and r_key[len(key)] != ' ':
+                continue  # The term ends part way through a word
+
+            pos = int(pos)
+
+            if pos < matches.get(identifier, (pos + 1,))[0]:
+                matches[identifier] = (pos, name.decode('utf8'))
+
+        # BM25, as whoosh.scoring.BM25F computes it, with B=0.75, K1=1.2, and words as the tokens
+        idf = math.log(float(self._n_names) / (len(matches) + 1)) + 1
+
+        results = []
+
+        for identifier, (pos, name) in matches.items():
+            length = len(self.normalize(name).split())
+            bm25 = idf * 2.2 / (1 + 1.2 * (0.25 + 0.75 * length / self._avg_words))
+
+            score = 2.0 / (pos + 1) + 1.0 / (len(term) / 4 + 1) + bm25
+
+            results.append((score, identifier.decode('utf8'), name))
+
+        return sorted(results, key=lambda x: (-x[0], x[2]))[:limit]
+
+    def search_many(self, terms, limit=10):
+        """Search for a collection of terms. Returns a dict of lists of results, keyed by term"""
+
+        return {term: self.search(term, limit=limit) for term in set(terms)}
+
+
 class SearchTermParser(object):
 
     TERM = 0
@@ -27,6 +27,9 @@ class SqlitePartition(PartitionBase):
     _id_class = SqlitePartitionIdentity
     _db_class = PartitionDb
 
+    # If True, finalize() collects the stats, coverage and sample in one pass over the table.
+    fused_finalize = True
+
     def __init__(self, bundle, record, memory=False, **kwargs):
 
         super(SqlitePartition, self).__init__(bundle, record)
@@ -150,15 +153,131 @@ class SqlitePartition(PartitionBase):
 
         return self
 
-    def finalize(self, force=False):
+    def finalize(self, force=False, fused=None):
+        """Compute the stats, coverage and sample for the partition, and record the partition file.
+
+        :param force: Finalize even if the partition is already finalized
+        :param fused: If True, collect all of the values in one pass over the table, with finalize_fused().
+        Defaults to the fused_finalize class attribute.
+        """
+
+        if fused is None:
+            fused = self.fused_finalize
 
         if force or (not self.is_finalized and self.database.exists()):
-            self.write_basic_stats()
-            self.write_file()
-            self.write_full_stats()
-            self.compile_geo_coverage()
-            self.compile_time_coverage()
-            self.build_sample()
+            if fused and self.get_table():
+                self.finalize_fused()
+            else:
+                self.write_basic_stats()
+                self.write_file()
+                self.write_full_stats()
+                self.compile_geo_coverage()
+                self.compile_time_coverage()
+                self.build_sample()
+
+    def finalize_fused(self, chunk_size=10000):
+        """Finalize with one cursor pass over the primary table, collecting the row count, the distinct geoids
+        and years, the sample and the column stats together, while the file hash is computed in a thread.
+        The key range comes from MIN() and MAX() on the primary key, which use the index. """
+        import threading
+        from ..util import md5_for_file
+        from ..dbexceptions import ConfigurationError
+
+        t = self.get_table()
+
+        if not t.primary_key:
+            raise ConfigurationError(
+                "Table {} does not have a primary key; can't compute stats".format(
+                    t.name))
+
+        pk = t.primary_key.name
+        table_name, col_vids, collectors = self._stats_collectors()
+
+        # Closing checkpoints the WAL, so the file is complete before it is hashed. Reading it afterwards
+        # doesn't alter it.
+        self.database.close()
+
+        file_hash = {}
+
+        def hash_file():
+            file_hash['md5'] = md5_for_file(self.database.path)
+
+        hash_thread = threading.Thread(target=hash_file)
+        hash_thread.start()
+
+        try:
+            conn = self.database.connection
+
+            min_key, max_key = conn.execute(
+                'SELECT MIN("{pk}"), MAX("{pk}") FROM "{t}"'.format(pk=pk, t=table_name)).fetchone()
+
+            # Like build_sample(), but the skip is estimated from the key range, since the count isn't known
+            # until the end of the scan.
+            if isinstance(min_key, (int, long)) and isinstance(max_key, (int, long)):
+                skip = (max_key - min_key + 1) / 20
+            else:
+                skip = 0
+
+            result = conn.execute('SELECT * FROM "{}"'.format(table_name))
+
+            keys = result.keys()
+            pk_i = keys.index(pk)
+            stat_cols = [(keys.index(cs.name), cs) for cs in collectors]
+            geo_cols = [i for i, k in enumerate(keys) if 'gvid' in k]
+            year_cols = [i for i, k in enumerate(keys) if 'year' in k]
+
+            count = 0
+            gvids = set()
+            years = set()
+            first_rows = []
+            sample = []
+
+            while True:
+                rows = result.fetchmany(chunk_size)
+
+                if not rows:
+                    break
+
+                count += len(rows)
+
+                columns = zip(*rows)
+
+                for i, cs in stat_cols:
+                    cs.update(columns[i])
+
+                for i in geo_cols:
+                    gvids.update(columns[i])
+
+                for i in year_cols:
+                    years.update(columns[i])
+
+                if len(first_rows) < 20:
+                    first_rows.extend(row.values() for row in rows[:20 - len(first_rows)])
+
+                if skip and len(sample) < 20:
+                    for row in rows:
+                        if row[pk_i] % skip == 0:
+                            sample.append(row.values())
+
+                            if len(sample) == 20:
+                                break
+
+            result.close()
+
+        finally:
+            hash_thread.join()
+
+        self.write_basic_stats(count=count, min_key=min_key, max_key=max_key)
+        self.write_file(hash_=file_hash.get('md5'))
+
+        if count:
+            self.close()
+            self.bundle.close()
+            self._write_stats(col_vids, collectors)
+
+        self.compile_geo_coverage(gvids=gvids)
+        self.compile_time_coverage(years=years)
+        self.build_sample(sample=sample if skip and count > 100 else first_rows)
 
     def guess_lom(self, col, stats):
         """
@@ -176,7 +295,7 @@ class SqlitePartition(PartitionBase):
         if col.type_is_text:
             return 'nom'
 
-    def write_full_stats(self):
+    def write_full_stats(self, chunk_size=10000):
         """Write stats to the stats table.
 
         Dataset Id
@@ -190,67 +309,84 @@ class SqlitePartition(PartitionBase):
         JSON of top 50 Unique values
         JSON of Histogram of 100 values, for Int and Real
 
+        The table is read in chunks of chunk_size rows, and the statistics are
+        accumulated with the streaming estimators in ambry.util.colstats, so
+        memory use is bounded regardless of the number of rows.
+
         :return:
 
         """
-        import pandas as pd
-        import numpy as np
-        import json
 
-        df = self.pandas
+        table_name, col_vids, collectors = self._stats_collectors()
 
-        if df is None:
+        n = self.collect_stats(table_name, collectors, chunk_size)
+
+        if not n:
             return  # Usually b/c there are no records in the table.
 
         self.close()
         self.bundle.close()
 
+        self._write_stats(col_vids, collectors)
+
+    def _stats_collectors(self):
+        """Return the table name, a map of column names to vids, and a ColumnStats collector for each column
+        of the partition's table"""
+        from ..util.colstats import ColumnStats
+        from ..orm import Column
+
+        numeric_types = (Column.DATATYPE_INTEGER, Column.DATATYPE_INTEGER64, Column.DATATYPE_REAL,
+                         Column.DATATYPE_FLOAT, Column.DATATYPE_NUMERIC)
+
         with self.bundle.session:
             table = self.record.table
-            p = self.bundle.partitions.get(self.vid)
 
-            all_cols = [c.name for c in table.columns]
+            col_vids = {c.name: c.vid for c in table.columns}
 
-            for row in df.describe().T.reset_index().to_dict(orient='records'):
-                col_name = row['index']
+            collectors = [ColumnStats(c.name,
+                                      numeric=c.datatype in numeric_types,
+                                      text=c.type_is_text(),
+                                      key=bool(c.is_primary_key))
+                          for c in table.columns]
 
-                if col_name == 'id':
-                    continue
+            return table.name, col_vids, collectors
 
-                col = table.column(col_name)
+    def _write_stats(self, col_vids, collectors):
 
-                row['nuniques'] = df[col_name].dropna().nunique()
+        with self.bundle.session:
+            p = self.bundle.partitions.get(self.vid)
 
-                h = np.histogram(df[col_name])
+            for cs in collectors:
+                p.add_stat(col_vids[cs.name], cs.dict)
 
-                row['hist'] = dict(values=zip(h[1], h[0]))
+    def collect_stats(self, table_name, collectors, chunk_size=10000):
+        """Read a table in chunks, adding each column of a chunk to its
+        ColumnStats collector. Returns the number of rows. """
 
-                del row['index']
+        sql = 'SELECT {} FROM "{}"'.format(','.join('"{}"'.format(cs.name) for cs in collectors), table_name)
 
-                p.add_stat(col.vid, row)
+        result = self.database.connection.execute(sql)
 
-                all_cols.remove(col_name)
+        n = 0
 
-            for col_name in all_cols:
-                row = {}
-                col = table.column(col_name)
+        while True:
+            rows = result.fetchmany(chunk_size)
 
-                row['count'] = len(df[col_name])
+            if not rows:
+                break
 
-                row['nuniques'] = df[col_name].dropna().nunique()
+            n += len(rows)
 
-                if col.type_is_text():
+            for cs, values in zip(collectors, zip(*rows)):
+                cs.update(values)
 
-                    row['uvalues'] = df[col_name].value_counts().sort(
-                        inplace=False,
-                        ascending=False)[
-                        :100].to_dict()
+        result.close()
 
-                p.add_stat(col.vid, row)
+        return n
 
-    def write_basic_stats(self):
+    def write_basic_stats(self, count=None, min_key=None, max_key=None):
         """Record in the partition entry basic statistics for the partition's
-        primary table."""
+        primary table. If count is given, the values are used rather than queried. """
         from ..partitions import Partitions
 
         t = self.get_table()
@@ -266,18 +402,24 @@ class SqlitePartition(PartitionBase):
                 "Table {} does not have a primary key; can't compute stats".format(
                     t.name))
 
-        partition_s = self.database.session
+        if count is not None:
+            self.record.count = count
+            self.record.min_key = min_key
+            self.record.max_key = max_key
 
-        self.record.count = partition_s.execute(
-            "SELECT COUNT(*) FROM {}".format(self.table.name)).scalar()
-        self.record.min_key = partition_s.execute(
-            "SELECT MIN({}) FROM {}".format(
-                t.primary_key.name,
-                self.table.name)).scalar()
-        self.record.max_key = partition_s.execute(
-            "SELECT MAX({}) FROM {}".format(
-                t.primary_key.name,
-                self.table.name)).scalar()
+        else:
+            partition_s = self.database.session
+
+            self.record.count = partition_s.execute(
+                "SELECT COUNT(*) FROM {}".format(self.table.name)).scalar()
+            self.record.min_key = partition_s.execute(
+                "SELECT MIN({}) FROM {}".format(
+                    t.primary_key.name,
+                    self.table.name)).scalar()
+            self.record.max_key = partition_s.execute(
+                "SELECT MAX({}) FROM {}".format(
+                    t.primary_key.name,
+                    self.table.name)).scalar()
 
         with self.bundle.session as bundle_s:
 
@@ -287,28 +429,37 @@ class SqlitePartition(PartitionBase):
 
         self.set_state(Partitions.STATE.FINALIZED)
 
-    def compile_geo_coverage(self):
+    def compile_geo_coverage(self, gvids=None):
         """Compile GVIDs for the geographic coverage and grain of the
-        partition."""
+        partition.
+
+        :param gvids: The distinct values of the table's gvid columns. If None, they are queried from the table.
+        """
 
         from geoid import civick
         from geoid.util import simplify
 
-        p_s = self.database.session
+        if gvids is None:
+            p_s = self.database.session
 
-        geo_cols = []
-        table_name = self.table.name
-        for c in self.table.columns:
-            if 'gvid' in c.name:
-                geo_cols.append(c.name)
+            geo_cols = []
+            table_name = self.table.name
+            for c in self.table.columns:
+                if 'gvid' in c.name:
+                    geo_cols.append(c.name)
+
+            gvids = set()
+
+            for gc in geo_cols:
+                for row in p_s.execute("SELECT DISTINCT {} FROM {}".format(gc, table_name)):
+                    gvids.add(row[0])
 
         geoids = set()
 
-        for gc in geo_cols:
-            for row in p_s.execute("SELECT DISTINCT {} FROM {}".format(gc, table_name)):
-                gvid = civick.GVid.parse(row[0])
-                if gvid:
-                    geoids.add(gvid)
+        for v in gvids:
+            gvid = civick.GVid.parse(v)
+            if gvid:
+                geoids.add(gvid)
 
         # If there is source data ( from the sources metadata in the build set in the loader in build_create_partition)
         # then use the time and space values as additional geo and time
@@ -328,13 +479,22 @@ class SqlitePartition(PartitionBase):
         if self.identity.space:  # And from the partition name
             extra_spaces.append(('pname', self.identity.space))
 
+        unresolved = []
+
         for source_name, space in extra_spaces:
             try:
                 g = civick.GVid.parse(space)
             except KeyError:
+                unresolved.append((source_name, space))
+
+        if unresolved:
+            # Resolve all of the names in one batch, rather than a full text query for each
+            all_places = self.bundle.library.search.search_identifiers_many(
+                set(space for _, space in unresolved))
 
-                places = list(
-                    self.bundle.library.search.search_identifiers(space))
+            for source_name, space in unresolved:
+
+                places = all_places[space]
 
                 if not places:
                     from ..dbexceptions import BuildError
@@ -373,22 +533,29 @@ class SqlitePartition(PartitionBase):
         s.merge(self.record)
         s.commit()
 
-    def compile_time_coverage(self):
+    def compile_time_coverage(self, years=None):
+        """Compile the years of the time coverage of the partition.
+
+        :param years: The distinct values of the table's year columns. If None, they are queried from the table.
+        """
         from ambry.util.datestimes import expand_to_years
 
-        date_cols = []
-        years = set()
-        table_name = self.table.name
-        for c in self.table.columns:
-            if 'year' in c.name:
-                date_cols.append(c.name)
+        if years is None:
+            date_cols = []
+            years = set()
+            table_name = self.table.name
+            for c in self.table.columns:
+                if 'year' in c.name:
+                    date_cols.append(c.name)
 
-        p_s = self.database.session
+            p_s = self.database.session
 
-        # From the table
-        for dc in date_cols:
-            for row in p_s.execute("SELECT DISTINCT {} FROM {}".format(dc, table_name)):
-                years.add(row[0])
+            # From the table
+            for dc in date_cols:
+                for row in p_s.execute("SELECT DISTINCT {} FROM {}".format(dc, table_name)):
+                    years.add(row[0])
+        else:
+            years = set(years)
 
         # From the source
         # If there was a time value in the source that this partition was created from, then
@@ -410,27 +577,32 @@ class SqlitePartition(PartitionBase):
         s.merge(self.record)
         s.commit()
 
-    def build_sample(self):
+    def build_sample(self, sample=None):
+        """Store a sample of 20 rows in the partition record.
 
-        name = self.table.name
+        :param sample: A list of the values of the sample rows. If None, they are selected from the table.
+        """
 
-        count = int(
-            self.database.connection.execute(
-                'SELECT count(*) FROM "{}"'.format(name)).fetchone()[0])
+        if sample is None:
+            name = self.table.name
 
-        skip = count / 20
+            count = int(
+                self.database.connection.execute(
+                    'SELECT count(*) FROM "{}"'.format(name)).fetchone()[0])
 
-        if count > 100:
-            sql = 'SELECT * FROM "{}" WHERE id % {} = 0 LIMIT 20'.format(
-                name,
-                skip)
-        else:
-            sql = 'SELECT * FROM "{}" LIMIT 20'.format(name)
+            skip = count / 20
+
+            if count > 100:
+                sql = 'SELECT * FROM "{}" WHERE id % {} = 0 LIMIT 20'.format(
+                    name,
+                    skip)
+            else:
+                sql = 'SELECT * FROM "{}" LIMIT 20'.format(name)
 
-        sample = []
+            sample = []
 
-        for j, row in enumerate(self.database.connection.execute(sql)):
-            sample.append(row.values())
+            for j, row in enumerate(self.database.connection.execute(sql)):
+                sample.append(row.values())
 
         self.record.data['sample'] = sample
 
@@ -438,9 +610,9 @@ class SqlitePartition(PartitionBase):
         s.merge(self.record)
         s.commit()
 
-    def write_file(self):
+    def write_file(self, hash_=None):
         """Create a file entry in the bundle for the partition, storing the md5
-        checksum and size."""
+        checksum and size. If hash_ is given, it is used instead of hashing the file. """
 
         import os
         from ..orm import File
@@ -456,7 +628,7 @@ class SqlitePartition(PartitionBase):
                  ref=self.identity.vid,
                  state='built',
                  type_='P',
-                 hash=md5_for_file(self.database.path),
+                 hash=hash_ if hash_ else md5_for_file(self.database.path),
                  size=statinfo.st_size)
 
         with self.bundle.session as s:
@@ -513,7 +513,7 @@ def mp_run(mp_run_args):
             # connection created by the parent; you get horrible breakages in
             # random places.
             b.close()
-            method(*args)
+            return method(*args)
         except:
             b.close()
             raise
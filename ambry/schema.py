@@ -1489,7 +1489,7 @@ class {name}(Base):
         self.write_schema()
 
     def update_from_iterator(self, table_name, iterator, header=None,
-                             max_n = None,logger = None):
+                             max_n = None, sample = None, logger = None):
         """
 
         :param table_name:
@@ -1497,6 +1497,7 @@ class {name}(Base):
         :param header: If list, a list of columns names. If an OrderedDict, the keys are the column
         names, and the values are column descriptions.
         :param max_n:
+        :param sample: If set, intuit the types from a random sample of this many rows
         :param logger:
         :return:
         """
@@ -1514,7 +1515,7 @@ class {name}(Base):
 
 
         intuit = Intuiter(header=header, logger = logger)
-        intuit.iterate(iterator, max_n=max_n)
+        intuit.iterate(iterator, max_n=max_n, sample=sample)
 
         self.update_from_intuiter(table_name, intuit, descriptions = descriptions)
 
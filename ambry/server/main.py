@@ -24,10 +24,12 @@ global_logger.setLevel(logging.DEBUG)
 # 'library' argument.
 class LibraryPlugin(object):
 
-    def __init__(self, library_creator, keyword='library'):
+    def __init__(self, library_creator, keyword='library', close=True):
 
         self.library_creator = library_creator
         self.keyword = keyword
+        # If False, the library is kept between requests, and only the database session is closed
+        self.close = close
 
     def setup(self, app):
         pass
@@ -59,7 +61,13 @@ class LibraryPlugin(object):
             except Exception:
                 raise
             finally:
-                local.library.close()
+                if self.close:
+                    local.library.close()
+                else:
+                    for bundle in local.library.bundles.values():
+                        bundle.close()
+
+                    local.library.database.close_session()
 
             return rv
 
@@ -128,6 +136,8 @@ class AllJSONPlugin(object):
             return callback
 
         def wrapper(*a, **ka):
+            from types import GeneratorType
+
             rv = callback(*a, **ka)
 
             if isinstance(rv, HTTPResponse):
@@ -136,6 +146,9 @@ class AllJSONPlugin(object):
             if isinstance(rv, basestring):
                 return rv
 
+            if isinstance(rv, GeneratorType):  # Streaming response
+                return rv
+
             # Attempt to serialize, raises exception on failure
             try:
                 json_response = dumps(rv)
@@ -257,12 +270,23 @@ def _table_csv_parts(library, b, pid, table_name=None):
     else:
         table = b.schema.table(table_name)
 
-    count = p.query("SELECT count(*) FROM {}".format(table.name)).fetchone()
-
-    if count:
-        count = count[0]
+    # The segments are split on the primary key, so the key range is a good enough
+    # estimate of the count, and doesn't require scanning the table.
+    if table.name == p.table.name and p.record.count:
+        count = p.record.count
     else:
-        raise exc.BadRequest("Failed to get count of number of rows")
+        key_range = _table_key_range(p, table)
+
+        if key_range:
+            _, min_key, max_key = key_range
+            count = max_key - min_key + 1
+        else:
+            count = p.query("SELECT count(*) FROM {}".format(table.name)).fetchone()
+
+            if count:
+                count = count[0]
+            else:
+                raise exc.BadRequest("Failed to get count of number of rows")
 
     part_count, rem = divmod(count, TARGET_ROW_COUNT)
 
@@ -362,18 +386,98 @@ def _send_csv_if(did, pid, table_name, library):
     return _send_csv(library, did, pid, table_name, i, n, where, sep)
 
 
+CSV_CHUNK_ROWS = 5000
+
+
+def _table_key_range(p, table):
+    """Return the name of the primary key of a partition table and its minimum and maximum
+    values, or None if the table doesn't have an integer primary key. For the partition's main
+    table, the values stored on the partition record are used."""
+
+    pk = table.primary_key
+
+    if not pk:
+        return None
+
+    if table.name == p.table.name and p.record.min_key is not None and p.record.max_key is not None:
+        min_key, max_key = p.record.min_key, p.record.max_key
+    else:
+        min_key, max_key = p.query('SELECT MIN("{pk}"), MAX("{pk}") FROM "{t}"'
+                                   .format(pk=pk.name, t=table.name)).fetchone()
+
+    if not isinstance(min_key, (int, long)) or not isinstance(max_key, (int, long)):
+        return None
+
+    return pk.name, min_key, max_key
+
+
+def _keyset_rows(conn, table_name, pk, lo, hi, where, params):
+    """Yield the rows with lo <= pk < hi, a chunk at a time, each chunk starting after the last
+    key of the previous one, so no query has to skip over rows with an OFFSET"""
+
+    clauses = []
+
+    if lo is not None:
+        clauses.append('"{}" >= :_lo'.format(pk))
+
+    if hi is not None:
+        clauses.append('"{}" < :_hi'.format(pk))
+
+    if where:
+        clauses.append('({})'.format(where))
+
+    params = dict(params, _lo=lo, _hi=hi, _limit=CSV_CHUNK_ROWS)
+
+    last = None
+
+    while True:
+
+        q = 'SELECT * FROM "{}"'.format(table_name)
+
+        c = clauses + (['"{}" > :_last'.format(pk)] if last is not None else [])
+
+        if c:
+            q += ' WHERE ' + ' AND '.join(c)
+
+        q += ' ORDER BY "{}" LIMIT :_limit'.format(pk)
+
+        cur = conn.execute(q, dict(params, _last=last))
+
+        pk_i = [d[0] for d in cur.description].index(pk)
+
+        rows = cur.fetchall()
+
+        for row in rows:
+            yield row
+
+        if len(rows) < CSV_CHUNK_ROWS:
+            break
+
+        last = rows[-1][pk_i]
+
+
 def _send_csv(library, did, pid, table_name, i, n, where, sep=','):
-    """Send a CSV file to the client."""
+    """Send a segment of a partition table to the client as CSV.
+
+    The rows are streamed, CSV_CHUNK_ROWS at a time, with chunked transfer. If the table has an
+    integer primary key, segment i of n is the i'th of n equal ranges of the key, and the rows
+    are read with keyset pagination on the key; otherwise, the segment is selected with
+    LIMIT and OFFSET. If the gzip query parameter is given, the stream is gzip compressed.
+
+    """
     import unicodecsv
-    import csv
     from StringIO import StringIO
-    from sqlalchemy import text
+    import sqlite3
 
     # p_orm is a database entry, not a partition
     p = library.get(pid).partition
 
     if not table_name:
-        table_name = p.table.name
+        table = p.table
+    else:
+        table = p.bundle.schema.table(table_name)
+
+    table_name = table.name
 
     if i > n:
         raise exc.BadRequest(
@@ -382,47 +486,97 @@ def _send_csv(library, did, pid, table_name, i, n, where, sep=','):
     if i < 1:
         raise exc.BadRequest("Segment number starts at 1")
 
-    count = p.query("SELECT count(*) FROM {}".format(table_name)).fetchone()
+    params = dict(request.query.items()) if where else {}
 
-    if count:
-        count = count[0]
-    else:
-        raise exc.BadRequest("Failed to get count of number of rows")
+    key_range = _table_key_range(p, table)
+
+    if key_range:
+        pk, min_key, max_key = key_range
+
+        span = max_key - min_key + 1
+
+        # The first and last segments are open, in case the stored key range is out of date
+        lo = min_key + span * (i - 1) // n if i > 1 else None
+        hi = min_key + span * i // n if i < n else None
 
-    base_seg_size, rem = divmod(count, int(n))
+        offset = limit = None
 
-    if i == n:
-        seg_size = base_seg_size + rem
     else:
-        seg_size = base_seg_size
+        count = p.query("SELECT count(*) FROM {}".format(table_name)).fetchone()
 
-    out = StringIO()
-    #writer = unicodecsv.writer(out, delimiter=sep, escapechar='\\',quoting=csv.QUOTE_NONNUMERIC)
-    writer = unicodecsv.writer(out, delimiter=sep)
+        if count:
+            count = count[0]
+        else:
+            raise exc.BadRequest("Failed to get count of number of rows")
 
-    if request.query.header:
-        writer.writerow(tuple([c.name for c in p.table.columns]))
+        base_seg_size, rem = divmod(count, int(n))
 
-    if where:
-        q = "SELECT * FROM {} WHERE {} LIMIT {} OFFSET {} ".format(
-            table_name, where, seg_size, base_seg_size * (i - 1))
+        limit = base_seg_size + rem if i == n else base_seg_size
+        offset = base_seg_size * (i - 1)
 
-        params = dict(request.query.items())
-    else:
-        q = "SELECT * FROM {} LIMIT {} OFFSET {} ".format(table_name,
-                                                          seg_size,
-                                                          base_seg_size * (i - 1))
-        params = {}
+    header = [c.name for c in table.columns] if request.query.header else None
+    gzip = request.query.gzip and request.query.gzip != 'F'
+
+    # The library, and the partition database with it, is closed when this function returns,
+    # so the rows are read from a new connection.
+    path = p.database.path
 
-    for row in p.query(text(q), params):
-        writer.writerow(tuple(row))
+    def rows(conn):
+        if key_range:
+            return _keyset_rows(conn, table_name, pk, lo, hi, where, params)
+
+        q = 'SELECT * FROM "{}"'.format(table_name)
+
+        if where:
+            q += ' WHERE {}'.format(where)
+
+        return conn.execute(q + ' LIMIT {} OFFSET {}'.format(limit, offset), params)
+
+    def csv_chunks():
+
+        conn = sqlite3.connect(path)
+
+        try:
+            out = StringIO()
+            writer = unicodecsv.writer(out, delimiter=sep)
+
+            if header:
+                writer.writerow(header)
+
+            for j, row in enumerate(rows(conn), 1):
+                writer.writerow(tuple(row))
+
+                if j % CSV_CHUNK_ROWS == 0:
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+
+            yield out.getvalue()
+
+        finally:
+            conn.close()
+
+    def gzipped(chunks):
+        import zlib
+
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        for chunk in chunks:
+            data = z.compress(chunk)
+            if data:
+                yield data
+
+        yield z.flush()
 
     response.content_type = 'text/csv'
 
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+
     response.headers[
         "content-disposition"] = "attachment; filename='{}-{}-{}-{}.csv'".format(p.identity.vname, table_name, i, n)
 
-    return out.getvalue()
+    return gzipped(csv_chunks()) if gzip else csv_chunks()
 
 
 @get('/')
@@ -932,6 +1086,7 @@ def get_partition_csv(did, pid, library):
         n: The total number of segments to break the CSV into
         i: Which segment to retrieve
         header:If existent and not 'F', include the header on the first line.
+        gzip: If existent and not 'F', gzip the stream.
 
     """
 
@@ -1051,6 +1206,142 @@ class StoppableWSGIRefServer(ServerAdapter):
 
 server_names['stoppable'] = StoppableWSGIRefServer
 
+# The running ThreadPoolWSGIRefServer, for the /ready endpoint
+pool_server = None
+
+
+class ThreadPoolWSGIRefServer(ServerAdapter):
+
+    """A WSGIRef server that handles requests on a pool of worker threads.
+
+    Accepted connections wait in a queue of at most queue_size for a worker. When the queue
+    is full, new connections get a 503 response with a Retry-After header, rather than waiting
+    behind slow requests, like large downloads.
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080, workers=8, queue_size=64, **options):
+        super(ThreadPoolWSGIRefServer, self).__init__(host, port, **options)
+        self.workers = workers
+        self.queue_size = queue_size
+
+    def run(self, handler):  # pragma: no cover
+        import threading
+        import Queue
+        from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+        global pool_server
+
+        queue = Queue.Queue(self.queue_size)
+
+        class PoolWSGIServer(WSGIServer):
+
+            request_queue_size = max(self.queue_size, 5)  # listen() backlog
+
+            def process_request(self, request, client_address):
+                try:
+                    queue.put_nowait((request, client_address))
+                except Queue.Full:
+                    try:
+                        request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                                        'Retry-After: 1\r\nContent-Length: 0\r\n\r\n')
+                    finally:
+                        self.shutdown_request(request)
+
+            def work(self):
+                while True:
+                    request, client_address = queue.get()
+
+                    try:
+                        self.finish_request(request, client_address)
+                    except Exception:
+                        self.handle_error(request, client_address)
+                    finally:
+                        self.shutdown_request(request)
+                        queue.task_done()
+
+        handler_class = WSGIRequestHandler
+
+        if self.quiet:
+            class QuietHandler(WSGIRequestHandler):
+
+                def log_request(*args, **kw):
+                    pass  # @NoSelf
+
+            handler_class = QuietHandler
+
+        srv = make_server(self.host, self.port, handler, server_class=PoolWSGIServer,
+                          handler_class=handler_class)
+
+        for i in range(self.workers):
+            t = threading.Thread(target=srv.work, name='ambry-server-worker-{}'.format(i))
+            t.daemon = True
+            t.start()
+
+        srv.queue = queue
+        srv.workers = self.workers
+        pool_server = srv
+
+        try:
+            srv.serve_forever()
+        finally:
+            pool_server = None
+            srv.server_close()
+
+server_names['threadpool'] = ThreadPoolWSGIRefServer
+
+
+@get('/ready')
+def get_ready():
+    """Readiness check. Returns 503 if the server can't accept more requests."""
+
+    if pool_server is None:
+        return dict(ready=True)
+
+    queued = pool_server.queue.qsize()
+    ready = not pool_server.queue.full()
+
+    if not ready:
+        response.status = 503
+
+    return dict(
+        ready=ready,
+        workers=pool_server.workers,
+        queued=queued,
+        queue_size=pool_server.queue.maxsize)
+
+
+def _thread_library_creator(config):
+    """Return a function that returns a library for the current thread, so each worker thread
+    has its own library, with its own database connections.
+
+    The libraries share one resolver cache and one doc cache, so an update through any worker
+    invalidates the cached results for all of them."""
+    import threading
+    from ambry.library import _new_library
+
+    tl = threading.local()
+    lock = threading.Lock()
+    shared = {}
+
+    def lf():
+        if getattr(tl, 'library', None) is None:
+            l = _new_library(config)
+
+            with lock:
+                if not shared:
+                    shared['resolver_cache'] = l.database.resolver_cache
+                    shared['doc_cache'] = l.doc_cache
+                else:
+                    l.database.resolver_cache = shared['resolver_cache']
+                    l._doc_cache_instance = shared['doc_cache'].for_library(l)
+
+            tl.library = l
+
+        return tl.library
+
+    return lf
+
 
 def test_run(config):
     """Run method to be called from unit tests."""
@@ -1112,19 +1403,20 @@ def local_debug_run(config):
     return run(host=host, port=port, reloader=True, server='stoppable')
 
 
-def production_run(config, reloader=False):
-
-    lf = lambda: new_library(config, True)
+def production_run(config, reloader=False, workers=8, queue_size=64):
+    """Run the server with a pool of worker threads, each with its own library."""
 
-    l = lf()
+    l = new_library(config, True)
     l.database.create()
 
     global_logger.info(
-        "starting production server for library '{}' on http://{}:{}".format(l.name, l.host, l.port))
+        "starting production server for library '{}' on http://{}:{} with {} workers"
+        .format(l.name, l.host, l.port, workers))
 
-    install(LibraryPlugin(lf))
+    install(LibraryPlugin(_thread_library_creator(config), close=False))
 
-    return run(host=l.host, port=l.port, reloader=reloader)
+    return run(host=l.host, port=l.port, reloader=reloader, server='threadpool',
+               workers=workers, queue_size=queue_size)
 
 if __name__ == '__main__':
     local_debug_run()
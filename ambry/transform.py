@@ -442,6 +442,7 @@ class CasterTransformBuilder(object):
     def __init__(self, env=None):
         self.types = []
         self._compiled = None
+        self._compiled_lists = {}
         self.custom_types = {}
 
         self.dict_code = None
@@ -452,53 +453,60 @@ class CasterTransformBuilder(object):
     def add_type(self, t):
         self.custom_types[t.__name__] = t
 
-    def makeListTransform(self):
+    def makeListTransform(self, header=None):
+        """Generate the code for a function that casts a sequence of values
+        to a tuple in the order of the caster's columns.
+
+        :param header: Names for the positions of the values in the
+        input rows. If None, the rows are in the order of the columns.
+        Columns that are not in the header get None.
+
+        """
         import uuid
         import datetime
+
         f_name = "row_transform_" + str(uuid.uuid4()).replace('-', '')
 
-        raise NotImplementedError("Needs to be fixed")
+        if header is None:
+            header = [name for name, type_ in self.types]
 
-        o = """
-def {}(row):
+        positions = {k.lower(): i for i, k in enumerate(header) if k}
 
-    raise NotImplementedError()
+        c = []
 
-    stripped_num = lambda x: x.strip() if isinstance(x, basestring) else x
-    is_not_nothing = lambda x: True if x!='' and x != None else False
-    
-    try:
-        return [
-""".format(f_name)
+        o = """def {}(row):
+    return (""".format(f_name)
 
         for i, (name, type_) in enumerate(self.types):
-            if i != 0:
-                o += ',\n'
 
-            if type_ == float or type_ == int:
-                o += "{type}(row[{i}]) if is_not_nothing(stripped_num(row[{i}])) else None".format(
-                    type=type_.__name__,
-                    i=i)
+            j = positions.get(name.lower())
+
+            if type_ == str:
+                type_ = unicode
+
+            if type_ == datetime.date:
+                cast = "parse_date('{name}', {{v}})".format(name=name)
+            elif type_ == datetime.time:
+                cast = "parse_time('{name}', {{v}})".format(name=name)
+            elif type_ == datetime.datetime:
+                cast = "parse_datetime('{name}', {{v}})".format(name=name)
+            elif type_ == int:
+                cast = "parse_int('{name}', {{v}})".format(name=name)
             else:
-                o += "{type}(row[{i}].strip()) if is_not_nothing(row[{i}]) else None".format(
-                    type=type_.__name__,
-                    i=i)
+                cast = "parse_type({type},'{name}', {{v}})".format(type=type_.__name__, name=name)
 
-        names = ','.join(["('{}',{})".format(name, type_.__name__)
-                         for name, type_ in self.types])
+            if j is None:
+                o += "None,\n"
+                c.append("('{name}', None, None)".format(name=name))
+            else:
+                o += cast.format(v="row[{}]".format(j)) + ",\n"
+                c.append("('{name}', {j}, lambda v: {cast})".format(name=name, j=j, cast=cast.format(v='v')))
 
-        o += """
-        ]
-    except ValueError as e:
-        for i,(name,type_) in  enumerate( [{names}] ):
-            try:
-                type_(row[i].strip()) if row[i] else None
-            except ValueError:
-                raise ValueError("Failed to convert value '{{}}' in field '{{}}' to '{{}}'".format(row[i], name,type_.__name__))
-        raise
-""".format(names=names)
+        o += """)"""
+
+        cf = "caster_funcs=[" + ','.join(c) + "]"
 
-        return f_name, o
+        return f_name, o, cf
 
     def makeDictTransform(self):
         import uuid
@@ -585,6 +593,74 @@ def {}(row):
 
         return self._compiled
 
+    def compile_list(self, header=None):
+        """Compile, and cache, a list transform for rows with the given
+        header. Returns the transform function and a list of (name,
+        position, caster) tuples for the columns."""
+
+        key = tuple(header) if header is not None else None
+
+        if key not in self._compiled_lists:
+
+            lfn, lf, lcf = self.makeListTransform(header)
+
+            exec(lf)
+            lf = locals()[lfn]
+
+            exec(lcf)
+            lcf = locals()['caster_funcs']
+
+            self._compiled_lists[key] = (lf, lcf)
+
+        return self._compiled_lists[key]
+
+    def _call_list(self, f, row, codify_cast_errors):
+        """Call a compiled list transform to cast all of the values in a
+        row. Returns a tuple of values in column order, and a dict of the
+        cast errors.
+
+        If there are casting errors, through an exception, unless
+        codify_cast_errors, in which case the value with the casting
+        error is set to None and is reported in the cast errors, keyed by
+        column name.
+
+        """
+
+        try:
+            return f[0](row), {}
+        except CastingError:
+
+            if not codify_cast_errors:
+                raise
+
+            do = []
+            cast_errors = {}
+
+            for name, j, cf in f[1]:
+                if j is None:
+                    do.append(None)
+                    continue
+
+                try:
+                    do.append(cf(row[j]))
+                except CastingError:
+                    cast_errors[name] = row[j]
+                    do.append(None)
+
+            return tuple(do), cast_errors
+
+    def list_caster(self, header=None, codify_cast_errors=True):
+        """Return a function that casts a sequence of values, in the order
+        of header, to a tuple in the order of the columns, returning the
+        tuple and a dict of cast errors."""
+
+        f = self.compile_list(header)
+
+        for k, v in self.custom_types.items():
+            globals()[k] = v
+
+        return lambda row: self._call_list(f, row, codify_cast_errors)
+
     def _call_dict(self, f, row, codify_cast_errors):
         """Call the caster to cast all of the values in a row.
 
@@ -630,5 +706,8 @@ def {}(row):
         if isinstance(row, (dict, RowProxy)):
             return self._call_dict(f, row, codify_cast_errors)
 
+        elif isinstance(row, (list, tuple)):
+            return self.list_caster(codify_cast_errors=codify_cast_errors)(row)
+
         else:
             raise Exception("Unknown row type: {} ".format(type(row)))
@@ -0,0 +1,356 @@
+"""Streaming, memory-bounded column statistics.
+
+Each of the accumulators takes values a chunk at a time, and holds a
+bounded amount of state regardless of the number of values, so the
+statistics for a table can be computed in one pass over a cursor.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of the
+Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import math
+
+
+class Moments(object):
+
+    """Running count, mean, standard deviation, min and max, merged a chunk
+    at a time with Chan's parallel variance formula."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, a):
+        """Add a NumPy array of floats."""
+
+        n = len(a)
+
+        if not n:
+            return
+
+        mean = a.mean()
+        m2 = ((a - mean) ** 2).sum()
+
+        delta = mean - self.mean
+        total = self.n + n
+
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+        mn, mx = a.min(), a.max()
+
+        self.min = mn if self.min is None else min(self.min, mn)
+        self.max = mx if self.max is None else max(self.max, mx)
+
+    @property
+    def std(self):
+        """Sample standard deviation, like pandas' describe()"""
+        if self.n < 2:
+            return None
+
+        return math.sqrt(self.m2 / (self.n - 1))
+
+
+class KLLSketch(object):
+
+    """KLL quantile sketch. Items are kept in a hierarchy of compactors; a
+    full compactor sorts its items and promotes every other one to the
+    next level, where each item stands for twice as many values.
+
+    Until the first compaction, the sketch holds all of the values, and
+    the quantiles and histograms are exact.
+
+    """
+
+    def __init__(self, k=2000, seed=None):
+        import numpy as np
+
+        self.k = k
+        self.c = 2.0 / 3.0
+        self.compactors = [np.empty(0)]
+        self.n = 0
+        self._rand = np.random.RandomState(seed)
+
+    def capacity(self, h):
+        depth = len(self.compactors) - h - 1
+        return max(int(math.ceil(self.k * self.c ** depth)), 2)
+
+    def update(self, a):
+        """Add a NumPy array of floats."""
+        import numpy as np
+
+        if not len(a):
+            return
+
+        self.compactors[0] = np.concatenate((self.compactors[0], a))
+        self.n += len(a)
+
+        h = 0
+        while h < len(self.compactors):
+            if len(self.compactors[h]) >= self.capacity(h):
+
+                if h + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+
+                items = np.sort(self.compactors[h])
+
+                # Keep the odd item at this level
+                if len(items) % 2:
+                    keep, items = items[-1:], items[:-1]
+                else:
+                    keep = np.empty(0)
+
+                offset = self._rand.randint(0, 2)
+
+                self.compactors[h + 1] = np.concatenate((self.compactors[h + 1], items[offset::2]))
+                self.compactors[h] = keep
+
+            h += 1
+
+    @property
+    def is_exact(self):
+        return len(self.compactors) == 1
+
+    def weighted_items(self):
+        """Return arrays of the items and their weights."""
+        import numpy as np
+
+        values = np.concatenate(self.compactors)
+        weights = np.concatenate([np.ones(len(c)) * 2 ** h for h, c in enumerate(self.compactors)])
+
+        return values, weights
+
+    def quantile(self, q):
+        import numpy as np
+
+        if not self.n:
+            return None
+
+        if self.is_exact:
+            return np.percentile(self.compactors[0], q * 100)
+
+        values, weights = self.weighted_items()
+        order = np.argsort(values)
+        values, cum = values[order], np.cumsum(weights[order])
+
+        return values[min(np.searchsorted(cum, q * cum[-1]), len(values) - 1)]
+
+    def histogram(self, bins=10, range_=None):
+        """Histogram of the values, like np.histogram(), with the counts
+        estimated from the item weights once the sketch has compacted."""
+        import numpy as np
+
+        values, weights = self.weighted_items()
+
+        if self.is_exact:
+            return np.histogram(values, bins=bins)
+
+        counts, edges = np.histogram(values, bins=bins, range=range_, weights=weights)
+
+        return np.round(counts).astype(int), edges
+
+
+def _splitmix64(x):
+    """Mix a NumPy array of uint64 hashes."""
+    import numpy as np
+
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+class DistinctCounter(object):
+
+    """Count distinct values, exactly with a set until there are more than
+    max_exact of them, then approximately with a HyperLogLog of 2^p
+    registers."""
+
+    def __init__(self, max_exact=10000, p=14):
+        self.max_exact = max_exact
+        self.p = p
+        self._set = set()
+        self._registers = None
+
+    def update(self, values):
+
+        if self._set is not None:
+            self._set.update(values)
+
+            if len(self._set) > self.max_exact:
+                import numpy as np
+
+                self._registers = np.zeros(2 ** self.p, dtype=np.uint8)
+                self._hll_update(list(self._set))
+                self._set = None
+        else:
+            self._hll_update(values)
+
+    def _hll_update(self, values):
+        import numpy as np
+
+        if not len(values):
+            return
+
+        p = np.uint64(self.p)
+
+        h = _splitmix64(np.fromiter((hash(v) for v in values), dtype=np.int64, count=len(values))
+                        .view(np.uint64))
+
+        idx = (h >> (np.uint64(64) - p)).astype(np.int64)
+
+        # Rank of the first set bit in the next 32 bits after the index bits.
+        w = ((h << p) >> np.uint64(32)).astype(np.float64)
+
+        rho = np.where(w > 0, 32 - np.floor(np.log2(np.maximum(w, 1))), 33).astype(np.uint8)
+
+        np.maximum.at(self._registers, idx, rho)
+
+    @property
+    def count(self):
+        import numpy as np
+
+        if self._set is not None:
+            return len(self._set)
+
+        m = float(len(self._registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+
+        e = alpha * m * m / np.sum(2.0 ** -self._registers.astype(np.float64))
+
+        zeros = int(np.sum(self._registers == 0))
+
+        if e <= 2.5 * m and zeros:
+            e = m * math.log(m / zeros)
+
+        return int(round(e))
+
+
+class TopK(object):
+
+    """Space-saving heavy hitters, updated a chunk at a time. Counts are exact
+    until there are more than capacity distinct values; after that, values
+    that enter the summary are credited with the largest count that was
+    evicted, so counts are over-estimates by at most that amount."""
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.floor = 0
+
+    def update(self, values):
+        from collections import Counter
+        from operator import itemgetter
+
+        for v, c in Counter(values).iteritems():
+            self.counts[v] = self.counts.get(v, self.floor) + c
+
+        if len(self.counts) > self.capacity:
+            items = sorted(self.counts.iteritems(), key=itemgetter(1), reverse=True)
+
+            self.floor = max(self.floor, items[self.capacity][1])
+            self.counts = dict(items[:self.capacity])
+
+    def top(self, n):
+        from operator import itemgetter
+        import heapq
+
+        return dict(heapq.nlargest(n, self.counts.iteritems(), key=itemgetter(1)))
+
+
+class ColumnStats(object):
+
+    """Accumulate the statistics for one column, for Partition.add_stat()
+
+    Numeric columns get the values of pandas' describe(), the number of
+    unique values and a 10 bin histogram. Other columns get the count and
+    number of uniques, and text columns also get the 100 most common
+    values.
+
+    """
+
+    def __init__(self, name, numeric=False, text=False, key=False):
+        self.name = name
+        self.numeric = numeric
+        self.text = text
+        self.key = key
+
+        self.n = 0
+        self.non_null = 0
+
+        self.distinct = DistinctCounter()
+        self.moments = Moments() if numeric else None
+        self.sketch = KLLSketch() if numeric else None
+        self.top_k = TopK() if text else None
+
+    def update(self, values):
+        """Add a chunk of values."""
+
+        self.n += len(values)
+
+        non_null = [v for v in values if v is not None]
+        self.non_null += len(non_null)
+
+        if self.key:  # Unique by definition.
+            return
+
+        self.distinct.update(non_null)
+
+        if self.numeric:
+            a = self._floats(non_null)
+            self.moments.update(a)
+            self.sketch.update(a)
+
+        if self.text:
+            self.top_k.update(non_null)
+
+    @staticmethod
+    def _floats(values):
+        """Convert to a float array, dropping values that aren't numbers."""
+        import numpy as np
+
+        try:
+            return np.array(values, dtype=float)
+        except (ValueError, TypeError):
+            return np.array([v for v in values if isinstance(v, (int, long, float))], dtype=float)
+
+    @property
+    def dict(self):
+
+        if self.key:
+            return dict(count=self.n, nuniques=self.non_null)
+
+        if not self.numeric:
+            d = dict(count=self.n, nuniques=self.distinct.count)
+
+            if self.text:
+                d['uvalues'] = self.top_k.top(100)
+
+            return d
+
+        m = self.moments
+
+        d = dict(count=m.n, nuniques=self.distinct.count)
+
+        if not m.n:
+            return d
+
+        h = self.sketch.histogram(10, (m.min, m.max))
+
+        d.update(
+            mean=float(m.mean),
+            std=m.std,
+            min=float(m.min),
+            p25=float(self.sketch.quantile(.25)),
+            p50=float(self.sketch.quantile(.50)),
+            p75=float(self.sketch.quantile(.75)),
+            max=float(m.max),
+            hist=dict(values=zip([float(x) for x in h[1]], [int(x) for x in h[0]]))
+        )
+
+        return d
@@ -231,3 +231,54 @@ class MetadataFlo(object):
             return False
 
         self.close()
+
+
+class HashingFlo(object):
+
+    """A wrapper for a writable file like object that computes the md5 and size of the data
+    as it is written, so the file doesn't have to be read back to hash it."""
+
+    def __init__(self, o):
+        import hashlib
+
+        self.o = o
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def write(self, d):
+        self._md5.update(d)
+        self.size += len(d)
+        self.o.write(d)
+
+    def writelines(self, lines):
+        for d in lines:
+            self.write(d)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        return self.o.flush()
+
+    def close(self):
+        return self.o.close()
+
+    @property
+    def closed(self):
+        return self.o.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        if hasattr(self.o, '__exit__'):
+            return self.o.__exit__(type_, value, traceback)
+
+        if type_:
+            return False
+
+        self.close()
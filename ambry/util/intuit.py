@@ -102,6 +102,51 @@ tests = [
 ]
 
 
+def date_type(v):
+    """Parse a string with dateutil, and return datetime.date, datetime.time
+    or datetime.datetime for the parts of the value that the parser set, or
+    None if it can't be parsed."""
+    from dateutil import parser
+
+    epoch = datetime.datetime.fromtimestamp(0)
+
+    try:
+        maybe_dt = parser.parse(v, default=epoch)
+    except (TypeError, ValueError):
+        return None
+
+    # Check which parts of the default the parser didn't change to find
+    # the real type
+    # HACK The time check will be wrong for the time of
+    # the start of the epoch, 16:00.
+    if maybe_dt.time() == epoch.time():
+        return datetime.date
+    elif maybe_dt.date() == epoch.date():
+        return datetime.time
+    else:
+        return datetime.datetime
+
+
+def reservoir_sample(iterable, k, seed=None):
+    """Return a uniform random sample of k items from an iterable of
+    unknown length, in the order they appeared in the iterable."""
+    import random
+
+    rand = random.Random(seed)
+
+    reservoir = []
+
+    for i, item in enumerate(iterable):
+        if i < k:
+            reservoir.append((i, item))
+        else:
+            j = rand.randint(0, i)
+            if j < k:
+                reservoir[j] = (i, item)
+
+    return [item for i, item in sorted(reservoir, key=lambda x: x[0])]
+
+
 class Column(object):
 
     name = None
@@ -118,6 +163,7 @@ class Column(object):
         self.type_counts[datetime.time] = 0
         self.type_counts[None] = 0
         self.strings = deque(maxlen=1000)
+        self._string_set = set()
         self.count = 0
         self.length = 0
         self.date_successes = 0
@@ -126,8 +172,19 @@ class Column(object):
     def inc_type_count(self, t):
         self.type_counts[t] += 1
 
+    def add_string(self, v):
+        """Add a value to the bounded list of example strings, if it isn't
+        already there."""
+
+        if v not in self._string_set:
+
+            if len(self.strings) == self.strings.maxlen:
+                self._string_set.discard(self.strings[0])
+
+            self.strings.append(v)
+            self._string_set.add(v)
+
     def test(self, v):
-        from dateutil import parser
 
         self.length = max(self.length, len(str(v)))
         self.count += 1
@@ -156,35 +213,131 @@ class Column(object):
                 type_ = test
 
                 if test == str:
-                    if v not in self.strings:
-
-                        self.strings.append(v)
+                    self.add_string(v)
 
                     if (self.count < 1000 or self.date_successes != 0) and any((c in '-/:T') for c in v):
-                        try:
-                            maybe_dt = parser.parse(
-                                v, default=datetime.datetime.fromtimestamp(0))
-                        except (TypeError, ValueError):
-                            maybe_dt = None
-
-                        if maybe_dt:
-                            # Check which parts of the default the parser didn't change to find
-                            # the real type
-                            # HACK The time check will be wrong for the time of
-                            # the start of the epoch, 16:00.
-                            if maybe_dt.time() == datetime.datetime.fromtimestamp(0).time():
-                                type_ = datetime.date
-                            elif maybe_dt.date() == datetime.datetime.fromtimestamp(0).date():
-                                type_ = datetime.time
-                            else:
-                                type_ = datetime.datetime
+                        dt_type = date_type(v)
 
+                        if dt_type:
+                            type_ = dt_type
                             self.date_successes += 1
 
                 self.type_counts[type_] += 1
 
                 return type_
 
+    def test_many(self, values):
+        """Test a batch of values, with the same effect on the counts as
+        calling test() on each of them, in order.
+
+        The values are reduced to their unique stripped strings, which are
+        classified as numbers with one NumPy conversion, so each distinct
+        value is parsed, and tested for a date, only once.
+
+        If any value can't be tested, the column is left as it was before
+        the call, and the exception is raised, so the caller can test the
+        values one at a time.
+
+        """
+
+        state = (dict(self.type_counts), deque(self.strings, maxlen=self.strings.maxlen),
+                 set(self._string_set), self.count, self.length, self.date_successes)
+
+        try:
+            self._test_many(values)
+        except Exception:
+            (self.type_counts, self.strings, self._string_set, self.count, self.length,
+             self.date_successes) = state
+            raise
+
+    def _test_many(self, values):
+        import numpy as np
+
+        if not len(values):
+            return
+
+        strs = [str(v) for v in values]
+
+        start_count = self.count
+        self.length = max(self.length, max(len(v) for v in strs))
+        self.count += len(strs)
+
+        # None and blank values both become '', which is counted as None
+        stripped = np.array([v.strip() if ov is not None else '' for v, ov in zip(strs, values)], dtype=object)
+
+        uniques, first_idx, inverse = np.unique(stripped, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse)
+
+        is_blank = (uniques == '')
+
+        # Numbers. An array conversion is all-or-nothing, so on failure, convert each unique value.
+        nums = np.zeros(len(uniques))
+        is_num = ~is_blank
+
+        try:
+            nums[is_num] = uniques[is_num].astype(float)
+        except (ValueError, TypeError):
+            for i in np.flatnonzero(is_num):
+                try:
+                    nums[i] = float(uniques[i])
+                except (ValueError, TypeError):
+                    is_num[i] = False
+
+        with np.errstate(invalid='ignore'):
+            is_int = is_num & np.isfinite(nums) & (nums == np.floor(nums))
+
+        is_float = is_num & ~is_int
+        is_str = ~is_blank & ~is_num
+
+        self.type_counts[None] += int(counts[is_blank].sum())
+        self.type_counts[int] += int(counts[is_int].sum())
+        self.type_counts[float] += int(counts[is_float].sum())
+
+        # Strings, in the order they first appeared
+        str_idx = sorted(np.flatnonzero(is_str), key=lambda i: first_idx[i])
+
+        for i in str_idx:
+            self.add_string(uniques[i])
+
+        # Dates. test() only tries to parse a date in the first 1000 values, or after a date has been parsed, so
+        # the date types apply only if there were already dates, or if the first parseable value
+        # is in the first 1000.
+        candidates = [i for i in str_idx if any((c in '-/:T') for c in uniques[i])]
+
+        dt_types = {}
+
+        if self.date_successes == 0:
+            for i in candidates:
+                if start_count + first_idx[i] + 1 >= 1000:
+                    break
+
+                dt_types[i] = date_type(uniques[i])
+
+                if dt_types[i]:
+                    break
+
+            active = any(dt_types.values())
+        else:
+            active = True
+
+        candidate_set = set(candidates)
+
+        for i in str_idx:
+            type_ = None
+
+            if active and i in candidate_set:
+                if i not in dt_types:
+                    dt_types[i] = date_type(uniques[i])
+
+                type_ = dt_types[i]
+
+            if type_:
+                self.date_successes += int(counts[i])
+            else:
+                type_ = str
+
+            self.type_counts[type_] += int(counts[i])
+
     def resolved_type(self):
         """Return the type for the columns, and a flag to indicate that the
         column has codes."""
@@ -229,26 +382,69 @@ class Intuiter(object):
         from collections import OrderedDict
         self._columns = OrderedDict()
 
-    def iterate(self, row_gen, max_n=None):
+    def iterate(self, row_gen, max_n=None, sample=None, chunk_size=10000):
+        """Intuit the column types from the rows of a row generator.
+
+        The rows are read in chunks of chunk_size rows, and each column of a
+        chunk is classified at once with Column.test_many()
+
+        :param row_gen: A RowGenerator
+        :param max_n: If set, read only the first max_n rows
+        :param sample: If set, classify only a reservoir sample of this
+        many rows, so the classification time is bounded for very large
+        sources. All of the rows are still read. Column lengths are then
+        only for the sampled rows.
+        :param chunk_size: Number of rows to classify at once.
+
+        """
+        from itertools import islice
 
         header = row_gen.get_header()
         unmangled_header = row_gen.unmangled_header
 
-        for n, row in enumerate(row_gen):
+        if not unmangled_header:
+            unmangled_header = header
 
-            if max_n and n > max_n:
-                return
+        rows = iter(row_gen)
 
-            try:
-                for col, desc, value in zip(header, unmangled_header, row):
-                    if not col in self._columns:
-                        self._columns[col] = Column()
+        if max_n:
+            rows = islice(rows, max_n + 1)
+
+        if sample:
+            rows = iter(reservoir_sample(rows, sample))
 
-                    self._columns[col].test(value)
-                    self._columns[col].description = desc
+        while True:
+            chunk = list(islice(rows, chunk_size))
 
-            except Exception as e:
-                print 'Failed to add row: {}: {}'.format(row, e)
+            if not chunk:
+                break
+
+            self.test_rows(header, unmangled_header, chunk)
+
+    def test_rows(self, header, descriptions, rows):
+        """Classify the columns of a batch of rows. If a column can't be
+        classified as a batch, its values are tested one at a time, so only
+        the values that fail are lost."""
+
+        for i, (col, desc) in enumerate(zip(header, descriptions)):
+
+            if not col in self._columns:
+                self._columns[col] = Column()
+
+            column = self._columns[col]
+            column.description = desc
+
+            # Like zip(), ignore the columns that are past the end of short rows.
+            values = [row[i] for row in rows if len(row) > i]
+
+            try:
+                column.test_many(values)
+            except Exception:
+                for v in values:
+                    try:
+                        column.test(v)
+                    except Exception as e:
+                        print 'Failed to add value to column {}: {}: {}'.format(col, repr(v), e)
 
     @property
     def columns(self):
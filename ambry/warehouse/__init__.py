@@ -4,6 +4,7 @@ from ..library.database import LibraryDb
 from ckcache import new_cache, Cache
 from ..database import new_database
 import os
+import re
 from ..util import Constant, memoize
 from ambry.util import init_log_rate
 from ..library.files import Files
@@ -131,6 +132,18 @@ class Warehouse(object):
     drop_view_sql = 'DROP VIEW  IF EXISTS "{name}"'
     create_view_sql = 'CREATE VIEW "{name}" AS {sql}'
 
+    # Threads for fetching partitions, loading them and refreshing materialized views. Loading and
+    # refreshing are serial by default, since Sqlite can only have one writer.
+    download_workers = 4
+    load_workers = 1
+    mview_workers = 1
+
+    # Processes for extract_all(). Extracts only read from the warehouse, so they can run in parallel.
+    extract_workers = 4
+
+    # Schema of the warehouse tables, for qualified references
+    table_schema = 'main'
+
     def __init__(self,
                  database,
                  wlibrary=None,  # Warehouse library
@@ -614,20 +627,46 @@ class Warehouse(object):
 
         return commands
 
-    def execute_commands(self, commands):
+    def execute_commands(self, commands, download_workers=None, load_workers=None):
         """Execute a set of installation commands, which are usually from a
-        digested manifest."""
-        from ..dbexceptions import NotFoundError, ConfigurationError
+        digested manifest.
+
+        Runs of consecutive install commands are installed together with install_partitions(),
+        so the downloads and loads overlap, and runs of mview commands are refreshed together in
+        dependency order with install_material_views(). Any other command waits for the
+        installs and mviews before it.
+
+        """
 
         installed_partitions = []
         installed_tables = []
 
+        installs = []
+        mviews = []
+
+        def flush(command):
+            if command != 'install' and installs:
+                partitions, tables = self.install_partitions(
+                    installs, download_workers=download_workers, load_workers=load_workers)
+
+                installed_partitions.extend(partitions)
+                installed_tables.extend(tables)
+
+                del installs[:]
+
+            if command != 'mview' and mviews:
+                self.install_material_views(mviews)
+
+                del mviews[:]
+
         # First pass
         for command_set in commands:
 
             command_set = list(command_set)
             command = command_set.pop(0)
 
+            flush(command)
+
             if command == 'install':
 
                 dataset, tables, where = command_set
@@ -635,18 +674,8 @@ class Warehouse(object):
                 if where and len(tables) == 1:
                     tables = [(tables[0], "WHERE (" + where + ")")]
 
-                try:
-                    tables, p = self.install_partition(
-                        dataset.partition.vid, tables)
-                except NotFoundError as e:
-                    self.logger.error(
-                        "Failed to install partition {}: {}".format(
-                            dataset.partition,
-                            e))
-                    continue
+                installs.append((dataset.partition.vid, tables))
 
-                installed_tables += tables
-                installed_partitions.append(p)
             elif command == 'about':
 
                 title, summary = command_set
@@ -666,8 +695,7 @@ class Warehouse(object):
                 self.create_index(name, table, columns)
 
             elif command == 'mview':
-                name, sql, data, force = command_set
-                self.install_material_view(name, sql, force, data)
+                mviews.append(tuple(command_set))
 
             elif command == 'view':
 
@@ -679,6 +707,8 @@ class Warehouse(object):
                 extract_path, m_uid, d = command_set
                 self.wlibrary.files.install_extract(extract_path, m_uid, d)
 
+        flush(None)
+
         return installed_partitions, installed_tables
 
     def install_manifest(self, manifest, force=None, reset=False):
@@ -737,6 +767,36 @@ class Warehouse(object):
         """Install a partition and the tables in the partition."""
 
         from sqlalchemy.exc import OperationalError
+
+        p, loads = self._prepare_partition(p_vid, tables)
+
+        installed_tables = []
+
+        for source_table_name, dest_table_name, alias, where in loads:
+            try:
+                # Copy the data to the destination table
+                itn = self.load_local(
+                    p,
+                    source_table_name,
+                    dest_table_name,
+                    where)
+
+                installed_tables.append(self._register_table(p, source_table_name, dest_table_name, alias, itn))
+
+            except OperationalError as e:
+                self.logger.error(
+                    "Failed to install table '{}': {}".format(
+                        source_table_name,
+                        e))
+                raise
+
+        self.library.database.mark_partition_installed(p_vid)
+
+        return installed_tables, p
+
+    def _prepare_partition(self, p_vid, tables=None):
+        """Get the partition, record it in the library and create its tables, returning the partition
+        and a list of the (source_table_name, dest_table_name, alias, where) tables to load."""
         from sqlalchemy import inspect
 
         dataset = self.elibrary.resolve(p_vid)
@@ -749,7 +809,7 @@ class Warehouse(object):
 
         self.library.database.install_partition(b, p)
 
-        installed_tables = []
+        loads = []
 
         tables_in_partition = inspect(p.database.engine).get_table_names()
 
@@ -772,63 +832,156 @@ class Warehouse(object):
             else:
                 where = None
 
+            loads.append((source_table_name, dest_table_name, alias, where))
+
+        return p, loads
+
+    def _register_table(self, p, source_table_name, dest_table_name, alias, itn):
+        """Record a loaded table in the warehouse library."""
+
+        t_vid = p.get_table(source_table_name).vid
+        w_table = self.library.table(t_vid)
+
+        # Create a table entry for the name of the table with the partition in it,
+        # and link it to the main table record.
+        proto_vid = w_table.vid
+        self.install_table(
+            dest_table_name,
+            alt_name=alias,
+            data=dict(
+                type='installed',
+                proto_vid=proto_vid))
+
+        # Link the table name and the alias
+        self.install_table_alias(
+            dest_table_name,
+            alias,
+            proto_vid=proto_vid)
+
+        self.library.database.mark_table_installed(
+            p.get_table(source_table_name).vid,
+            itn)
+
+        assert self.augmented_table_name(
+            p.identity,
+            source_table_name)[0] == itn
+
+        w_table.data['source_partition'] = p.identity.dict
+
+        # Set the altname of the column, which is the name the column is generallt know by
+        # in the warehouse.
+
+        for c in w_table.columns:
+            c.altname = c.fq_name
+
+        return w_table.name
+
+    def install_partitions(self, installs, download_workers=None, load_workers=None):
+        """Install a list of (p_vid, tables) partitions, overlapping the downloads with the loads.
+
+        A pool of download_workers threads fetches the partition files from the remote stack into
+        the cache, in the order of the list. The partitions are prepared ( library records and table
+        creation ) in this thread, in order, and their tables are loaded by a pool of load_workers
+        threads, or in this thread if load_workers is 1, so writes to Sqlite are serialized. The
+        library records for the tables are written in this thread, in order, as the loads finish.
+
+        """
+        from multiprocessing.pool import ThreadPool
+        from sqlalchemy.exc import OperationalError
+        from ckcache.multi import AltReadCache
+        from ..dbexceptions import NotFoundError
+
+        download_workers = download_workers or self.download_workers
+        load_workers = load_workers or self.load_workers
+
+        installed_partitions = []
+        installed_tables = []
+
+        arc = AltReadCache(self.elibrary.cache, self.elibrary.remote_stack)
+
+        def prefetch(p_vid):
+            # Failures are reported when the partition is installed, which gets it again.
             try:
-                # Copy the data to the destination table
+                if p_vid in cache_keys:
+                    arc.get(cache_keys[p_vid])
+            except Exception as e:
+                return e
 
-                self.elibrary.get(p.vid)  # ensure it is local
-                itn = self.load_local(
-                    p,
-                    source_table_name,
-                    dest_table_name,
-                    where)
+        # Resolve in this thread, since the threads can't share the library's session.
+        cache_keys = {}
+        for p_vid, _ in installs:
+            try:
+                cache_keys[p_vid] = self.elibrary.resolve(p_vid).partition.cache_key
+            except Exception:
+                pass
 
-                t_vid = p.get_table(source_table_name).vid
-                w_table = self.library.table(t_vid)
+        download_pool = ThreadPool(download_workers)
+        load_pool = ThreadPool(load_workers) if load_workers > 1 else None
 
-                # Create a table entry for the name of the table with the partition in it,
-                # and link it to the main table record.
-                proto_vid = w_table.vid
-                self.install_table(
-                    dest_table_name,
-                    alt_name=alias,
-                    data=dict(
-                        type='installed',
-                        proto_vid=proto_vid))
+        pending = []  # Partitions with loads in progress, in order.
 
-                # Link the table name and the alias
-                self.install_table_alias(
-                    dest_table_name,
-                    alias,
-                    proto_vid=proto_vid)
+        def finish(p_vid, p, jobs):
+            tables = []
+            for result, source_table_name, dest_table_name, alias in jobs:
+                try:
+                    itn = result()
+                    tables.append(self._register_table(p, source_table_name, dest_table_name, alias, itn))
+                except OperationalError as e:
+                    self.logger.error(
+                        "Failed to install table '{}': {}".format(
+                            source_table_name,
+                            e))
+                    raise
 
-                self.library.database.mark_table_installed(
-                    p.get_table(source_table_name).vid,
-                    itn)
+            self.library.database.mark_partition_installed(p_vid)
 
-                assert self.augmented_table_name(
-                    p.identity,
-                    source_table_name)[0] == itn
+            installed_tables.extend(tables)
+            installed_partitions.append(p)
 
-                w_table.data['source_partition'] = p.identity.dict
+        try:
+            fetches = [download_pool.apply_async(prefetch, (p_vid,)) for p_vid, _ in installs]
 
-                # Set the altname of the column, which is the name the column is generallt know by
-                # in the warehouse.
+            for (p_vid, tables), fetch in zip(installs, fetches):
 
-                for c in w_table.columns:
-                    c.altname = c.fq_name
+                fetch.wait()
 
-                installed_tables.append(w_table.name)
+                try:
+                    p, loads = self._prepare_partition(p_vid, tables)
+                except NotFoundError as e:
+                    self.logger.error(
+                        "Failed to install partition {}: {}".format(
+                            p_vid,
+                            e))
+                    continue
 
-            except OperationalError as e:
-                self.logger.error(
-                    "Failed to install table '{}': {}".format(
-                        source_table_name,
-                        e))
-                raise
+                jobs = []
+                for source_table_name, dest_table_name, alias, where in loads:
+                    args = (p, source_table_name, dest_table_name, where)
 
-        self.library.database.mark_partition_installed(p_vid)
+                    if load_pool:
+                        result = load_pool.apply_async(self.load_local, args).get
+                    else:
+                        itn = self.load_local(*args)
+                        result = lambda itn=itn: itn
 
-        return installed_tables, p
+                    jobs.append((result, source_table_name, dest_table_name, alias))
+
+                pending.append((p_vid, p, jobs))
+
+                # Keep only as many partitions in flight as there are loaders
+                while len(pending) > load_workers:
+                    finish(*pending.pop(0))
+
+            while pending:
+                finish(*pending.pop(0))
+
+        finally:
+            download_pool.terminate()
+            if load_pool:
+                load_pool.close()
+                load_pool.join()
+
+        return installed_partitions, installed_tables
 
     def build_sample(self, t):
 
@@ -1021,47 +1174,201 @@ class Warehouse(object):
         # Update the documentation files in the library
 
     def install_material_view(self, name, sql, clean=False, data=None):
-        from pysqlite2.dbapi2 import OperationalError
+        """Install or refresh a single materialized view. Returns True if the view was refreshed."""
 
-        import time
+        return bool(self.install_material_views([(name, sql, data, clean)]))
 
-        if not (clean or self.mview_needs_update(name, sql)):
-            self.logger.info(
-                'Skipping materialized view {}: update not required'.format(name))
-            return False, False
-        else:
-            self.logger.info('Installing materialized view {}'.format(name))
+    def install_material_views(self, mviews, workers=None):
+        """Install or refresh a set of (name, sql, data, force) materialized views, returning the
+        names of the ones that were refreshed.
 
-            if not self.orm_table_by_name(name):
-                self.logger.info('mview_remove {}'.format(name))
-                drop = True
-            else:
-                drop = False
+        The views are ordered by the dependencies in the tc_names in their data, so they don't
+        have to be listed in dependency order, and a refresh of one view refreshes all of the
+        views that depend on it. The views in each level of the dependency graph are independent,
+        and are refreshed by a pool of mview_workers threads, each with its own connection.
 
-        data = data if data else {}
+        """
+        from multiprocessing.pool import ThreadPool
+        from ..util import toposort
 
-        data['sql'] = sql
-        data['type'] = 'mview'
-        data['updated'] = time.time()
+        if not mviews:
+            return []
 
-        if drop:
-            self.database.connection.execute(
-                'DROP TABLE IF EXISTS "{}"'.format(name))
+        workers = workers or self.mview_workers
 
-        if not data:
-            return False
+        by_name = {name: (sql, data if data else {}, force) for name, sql, data, force in mviews}
+
+        deps = {name: set(n for n in data.get('tc_names') or [] if n in by_name and n != name)
+                for name, (sql, data, force) in by_name.items()}
+
+        refreshed = {}  # name -> refresh mode
 
-        sql = """CREATE TABLE {name} AS {sql}""".format(name=name, sql=sql)
+        pool = ThreadPool(workers) if workers > 1 else None
 
         try:
-            self.database.connection.execute(sql)
+            for level in toposort(deps):
 
-        except OperationalError as e:
-            if 'exists' not in str(e).lower():
-                raise
+                plans = []
+
+                for name in sorted(level):
+                    sql, data, force = by_name[name]
+
+                    # Views that only gained rows are handled by the upstream state, in _mview_plan()
+                    rebuilt = any(refreshed.get(n) == 'full' for n in deps[name])
+
+                    mode, upstream = self._mview_plan(name, sql, force or rebuilt, data=data)
+
+                    if not mode:
+                        self.logger.info(
+                            'Skipping materialized view {}: update not required'.format(name))
+                        continue
+
+                    self.logger.info('Installing materialized view {} ({})'.format(name, mode[0]))
+
+                    plans.append((name, sql, mode, upstream))
+
+                if pool and len(plans) > 1:
+                    states = pool.map(self._refresh_mview_worker, plans)
+                else:
+                    states = [self._refresh_mview(self.database.connection, *plan) for plan in plans]
+
+                for (name, sql, mode, upstream), state in zip(plans, states):
+                    self._record_mview(name, sql, by_name[name][1], state)
+
+                    if mode[0] == 'full':
+                        self.mview_installed(name)
+
+                    refreshed[name] = mode[0]
+
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        return [name for name, _ in mviews if name in refreshed]
+
+    def mview_installed(self, name):
+        """Called after a materialized view is created, for dialect specific cleanup."""
+        pass
+
+    # Statements that stop a view from being refreshed by appending the results for the new rows
+    # of its upstream table.
+    _non_incremental_re = re.compile(
+        r'\b(group\s+by|distinct|join|limit|offset|union|except|intersect|over|with|having|'
+        r'count|sum|avg|min|max|total|group_concat|string_agg|array_agg)\b', re.IGNORECASE)
+
+    def _mview_upstream(self, sql, data):
+        """Return the name of the one table or view a materialized view selects from, if the
+        view can be refreshed incrementally, or None."""
+
+        if self._non_incremental_re.search(sql):
+            return None
+
+        upstream = [t for t in (self.orm_table_by_name(n) for n in set(data.get('tc_names') or [])) if t]
+
+        if len(upstream) != 1 or 'id' not in [c.name for c in upstream[0].columns]:
+            return None
+
+        name = upstream[0].name
+
+        # The incremental refresh shadows the upstream with a CTE of the same name, which only
+        # works if the view refers to it by its bare name. A schema qualified reference would
+        # read the whole table.
+        refs = [m.start() for m in re.finditer(
+            r'(?<![\w$"])"?{}"?(?![\w$"])'.format(re.escape(name)), sql, re.IGNORECASE)]
+
+        if not refs or any(re.search(r'\.\s*$', sql[:i]) for i in refs):
+            return None
+
+        return name
+
+    def _mview_plan(self, name, sql, force=False, data=None):
+        """Decide how to refresh a materialized view. Returns a tuple of the mode and the name of
+        the upstream table. The mode is None if the view is up to date, ('full', ) for a rebuild,
+        or ('incremental', max_id) to append the results for the upstream rows after max_id.
+
+        The upstream is found from the tc_names in data, the view's data from the manifest, or
+        from the data recorded for the view if data is None.
+
+        The upstream is taken to have only gained rows if the number of rows up to the max id
+        of the last refresh is unchanged and there are rows after it."""
+
+        t = self.orm_table_by_name(name)
+
+        if data is None:
+            data = t.data if t else {}
+
+        upstream = self._mview_upstream(sql, data)
+
+        if force or not t or t.data.get('sql') != sql:
+            return ('full',), upstream
+
+        needs_update = self.mview_needs_update(name, sql)
+
+        recorded = t.data.get('upstream_state')
+
+        if not upstream or not recorded or recorded[0] != upstream:
+            return ('full',) if needs_update else None, upstream
+
+        _, count, max_id = recorded
+
+        try:
+            n_new, new_max = self.database.connection.execute(
+                'SELECT count(*), max(id) FROM "{}"'.format(upstream)).fetchone()
+
+            n_old, = self.database.connection.execute(
+                'SELECT count(*) FROM "{}" WHERE id <= {}'.format(upstream, int(max_id or 0))).fetchone()
+
+        except Exception as e:
+            self.logger.error("Failed to get the state of {}: {}".format(upstream, e))
+            return ('full',), upstream
+
+        if (n_new, new_max) == (count, max_id):
+            return ('full',) if needs_update else None, upstream
 
-            self.logger.info('mview_exists {}'.format(name))
-            # Ignore if it already exists.
+        if n_old == count and new_max > max_id:
+            # The upstream has only gained rows
+            return ('incremental', max_id), upstream
+
+        return ('full',), upstream
+
+    def _refresh_mview(self, connection, name, sql, mode, upstream):
+        """Run the SQL for a refresh, and return the (upstream, count, max_id) state of the
+        upstream table, if there is one."""
+
+        if mode[0] == 'incremental':
+            # The CTE shadows the upstream for the view's query. The upstream is referenced
+            # with the schema in the CTE, so the reference isn't recursive.
+            connection.execute(
+                'INSERT INTO "{name}" WITH "{up}" AS (SELECT * FROM {schema}."{up}" WHERE id > {max_id}) {sql}'
+                .format(name=name, up=upstream, schema=self.table_schema, max_id=int(mode[1]), sql=sql))
+
+        else:
+            connection.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+
+            connection.execute("""CREATE TABLE {name} AS {sql}""".format(name=name, sql=sql))
+
+        if not upstream:
+            return None
+
+        count, max_id = connection.execute(
+            'SELECT count(*), max(id) FROM "{}"'.format(upstream)).fetchone()
+
+        return [upstream, count, max_id]
+
+    def _refresh_mview_worker(self, args):
+        with self.database.engine.begin() as connection:
+            return self._refresh_mview(connection, *args)
+
+    def _record_mview(self, name, sql, data, state):
+        import time
+
+        data = dict(data)
+
+        data['sql'] = sql
+        data['type'] = 'mview'
+        data['updated'] = time.time()
+        data['upstream_state'] = state
 
         t = self.install_table(name, data=data)
 
@@ -1573,50 +1880,54 @@ class Warehouse(object):
     # Extracts
     ###
 
-    def extract_all(self, force=False):
+    def extract_all(self, force=False, workers=None):
         """Generate the extracts and return a struture listing the extracted
-        files."""
-        from contextlib import closing
+        files.
 
-        from .extractors import new_extractor
-        import time
+        The extracts are independent, so with more than one worker, they are
+        run in a pool of processes, each with its own read-only connection to
+        the warehouse. The md5 and size of each extract are computed as it is
+        written, and the file records are updated in one commit at the end.
+
+        """
+        from .extractors import run_extracts
         from ..util import md5_for_file
 
-        # Get the URL to the root. The public_utl arg only affects S3, and
-        # gives a URL without a signature.
-        root = self.cache.path('', missing_ok=True, public_url=True)
+        if workers is None:
+            workers = self.extract_workers
 
-        extracts = []
+        files = self.library.files.query.group('manifest').type('extract').all
 
-        # Generate the file etracts
+        jobs = []
 
-        for f in self.library.files.query.group('manifest').type('extract').all:
+        for f in files:
 
             t = self.orm_table_by_name(f.data['table'])
 
-            if (t and t.data.get('updated') and
-                f.modified and
-                    int(t.data.get('updated')) > f.modified) or (not f.modified):
-                force = True
+            update_time = t.data.get('updated') if t else None
+
+            f_force = force or not f.modified or bool(
+                update_time and f.modified and int(update_time) > f.modified)
 
-            ex = new_extractor(
-                f.data.get('format'),
-                self,
-                self.cache,
-                force=force)
+            jobs.append((f.data.get('format'), f.data['table'], f.path, update_time, f_force))
 
-            e = ex.extract(f.data['table'], self.cache, f.path)
+        extracts = run_extracts(self, self.cache, jobs, workers=workers)
 
-            extracts.append(e)
+        for f, e in zip(files, extracts):
 
             if e.time:
                 f.modified = e.time
 
-                if os.path.exists(e.abs_path):
+                if e.hash:
+                    f.hash = e.hash
+                    f.size = e.size
+                elif os.path.exists(e.abs_path):
                     f.hash = md5_for_file(e.abs_path)
                     f.size = os.path.getsize(e.abs_path)
 
-                self.library.files.merge(f)
+                self.library.files.merge(f, commit=False)
+
+        self.library.database.commit()
 
         return extracts
 
@@ -6,6 +6,7 @@ the Revised BSD License, included in this distribution as LICENSE.txt
 """
 
 import ogr
+from contextlib import contextmanager
 
 
 class ExtractError(Exception):
@@ -20,6 +21,8 @@ class ExtractEntry(object):
         self.abs_path = abs_path
         self.data = data
         self.time = None
+        self.hash = None  # md5 and size of the extract, if computed as it was written
+        self.size = None
 
     def __str__(self):
         return 'extracted={} rel={} abs={} data={}'.format(
@@ -44,10 +47,90 @@ def get_extractors(t):
     return [format for format, ex in extractors.items() if ex.can_extract(t)]
 
 
+def run_extract(warehouse, cache, format, table, rel_path, update_time=None, force=False):
+    """Run one extract, returning its ExtractEntry"""
+
+    return new_extractor(format, warehouse, cache, force=force).extract(table, rel_path, update_time)
+
+
+# The warehouse and cache for the extract worker processes, which inherit them when the
+# pool forks.
+_worker_warehouse = None
+_worker_cache = None
+
+
+def _on_connect_sqlite_read_only(dbapi_con, con_record):
+    dbapi_con.execute('PRAGMA query_only = ON')
+
+
+def _on_connect_postgres_read_only(dbapi_con, con_record):
+    cur = dbapi_con.cursor()
+    cur.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+    cur.close()
+
+    # Commit, so the rollback when the connection is returned to the pool doesn't undo the SET
+    dbapi_con.commit()
+
+
+def _init_extract_worker():
+    """Give a worker process its own engine for the warehouse database, rather than using the
+    one it inherited from the parent, with every connection it makes set to read-only. The
+    extractors read through raw connections from the engine, not db.connection, so the setting
+    is made when each connection is created."""
+    from sqlalchemy import event
+
+    db = _worker_warehouse.database
+
+    db._engine = None
+    db._connection = None
+    db._session = None
+
+    if db.driver in ('sqlite', 'spatialite'):
+        event.listen(db.engine, 'connect', _on_connect_sqlite_read_only)
+    else:
+        event.listen(db.engine, 'connect', _on_connect_postgres_read_only)
+
+
+def _extract_worker(args):
+    return run_extract(_worker_warehouse, _worker_cache, *args)
+
+
+def run_extracts(warehouse, cache, extracts, workers=1):
+    """Run a list of extracts, each a tuple of the arguments to run_extract() after the cache,
+    on a pool of worker processes. Returns the ExtractEntry for each, in order."""
+    from multiprocessing import Pool
+
+    global _worker_warehouse, _worker_cache
+
+    if workers <= 1 or len(extracts) <= 1:
+        return [run_extract(warehouse, cache, *args) for args in extracts]
+
+    _worker_warehouse, _worker_cache = warehouse, cache
+
+    # Don't let the workers inherit an open connection
+    warehouse.database.close()
+
+    pool = Pool(min(workers, len(extracts)), _init_extract_worker)
+
+    try:
+        return pool.map(_extract_worker, extracts, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+        _worker_warehouse = _worker_cache = None
+
+
 class Extractor(object):
 
     is_geo = False
 
+    batch_size = 10000  # Rows fetched from the warehouse at a time
+    buffer_size = 1024 * 1024  # Bytes of output collected before each write to the cache
+
+    gzip = False
+    compresslevel = 6
+
     def __init__(self, warehouse, cache, force=False):
 
         self.warehouse = warehouse
@@ -55,10 +138,89 @@ class Extractor(object):
         self.cache = cache
         self.force = force
         self.hash = None
+        self.size = None
 
     def mangle_path(self, rel_path):
+        if self.gzip and not rel_path.endswith('.gz'):
+            rel_path += '.gz'
+
         return rel_path
 
+    @property
+    def text_is_bytes(self):
+        """True if iter_batches() returns text as UTF-8 bytes rather than unicode"""
+        return self.database.driver in ('sqlite', 'spatialite')
+
+    def iter_batches(self, table, select='*'):
+        """Yield the column names of a table, then lists of its rows, as DBAPI tuples,
+        batch_size rows at a time. The select argument is the column list for the query.
+
+        The rows come from a raw DBAPI cursor, bypassing the SqlAlchemy row proxies. For Sqlite,
+        text is returned as UTF-8 bytes, so it can be written without decoding and re-encoding
+        it. For Postgres, the cursor is a server-side cursor, so the table is not fetched all at
+        once.
+
+        """
+
+        raw = self.database.engine.raw_connection()
+
+        sqlite = self.text_is_bytes
+
+        if sqlite:
+            text_factory = raw.connection.text_factory
+            raw.connection.text_factory = str
+            cursor = raw.cursor()
+        elif self.database.driver in ('postgres', 'postgis'):
+            cursor = raw.connection.cursor('ambry_extract')
+        else:
+            cursor = raw.cursor()
+
+        try:
+            cursor.execute("SELECT {} FROM {}".format(select, table))
+
+            # A server-side cursor has no description until the first fetch
+            rows = cursor.fetchmany(self.batch_size)
+
+            yield [d[0] for d in cursor.description]
+
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(self.batch_size)
+
+        finally:
+            cursor.close()
+
+            if sqlite:
+                raw.connection.text_factory = text_factory
+
+            raw.close()
+
+    def put_stream(self, rel_path, metadata=None):
+        """Return a stream for writing the extract to the cache, which records the md5 and
+        size of the extract as it is written."""
+        from ..util.flo import HashingFlo
+
+        self._stream = HashingFlo(self.cache.put_stream(rel_path, metadata=metadata))
+
+        return self._stream
+
+    @contextmanager
+    def output(self, rel_path, metadata=None):
+        """Like put_stream(), but compressed with gzip when the gzip flag is set"""
+        from gzip import GzipFile
+
+        with self.put_stream(rel_path, metadata=metadata) as stream:
+            if not self.gzip:
+                yield stream
+                return
+
+            gz = GzipFile(filename='', mode='wb', fileobj=stream, compresslevel=self.compresslevel)
+
+            try:
+                yield gz
+            finally:
+                gz.close()
+
     def extract(self, table, rel_path, update_time=None):
         import time
 
@@ -90,14 +252,28 @@ class Extractor(object):
             'time': time.time()
         }
 
+        self._stream = None
+
         self._extract(table, rel_path, md)
         e.time = time.time()
         e.extracted = True
+
+        if self._stream:
+            self.hash = e.hash = self._stream.md5
+            self.size = e.size = self._stream.size
+
         return e
 
 
 class CsvExtractor(Extractor):
 
+    """Extract a table to CSV.
+
+    The rows are fetched batch_size at a time, and each batch is written to a buffer by the
+    csv module, which is written to the cache when it holds buffer_size bytes.
+
+    """
+
     mime = 'text/csv'
 
     def __init__(self, warehouse, cache, force=False):
@@ -107,29 +283,70 @@ class CsvExtractor(Extractor):
     def can_extract(cls, t):
         return True
 
-    def _extract(self, table, rel_path, metadata):
+    def row_encoder(self):
+        """Return a function to convert a batch of rows to rows the csv module can write, or
+        None if the rows can be written as they are."""
+
+        if self.text_is_bytes:
+            return None
 
-        import unicodecsv
+        def encode(rows):
+            return [[v.encode('utf-8') if isinstance(v, unicode) else v for v in row] for row in rows]
+
+        return encode
+
+    def _extract(self, table, rel_path, metadata):
+        import csv
+        from cStringIO import StringIO
 
         rel_path = self.mangle_path(rel_path)
 
-        row_gen = self.warehouse.database.connection.execute(
-            "SELECT * FROM {}".format(table))
+        batches = self.iter_batches(table)
+        encode = self.row_encoder()
+
+        try:
+            names = next(batches)
+
+            with self.output(rel_path, metadata=metadata) as stream:
+                buf = StringIO()
+                w = csv.writer(buf)
+
+                w.writerow([n.encode('utf-8') if isinstance(n, unicode) else n for n in names])
 
-        with self.cache.put_stream(rel_path, metadata=metadata) as stream:
-            w = unicodecsv.writer(stream)
+                for rows in batches:
+                    w.writerows(encode(rows) if encode else rows)
 
-            for i, row in enumerate(row_gen):
-                if i == 0:
-                    w.writerow(row.keys())
+                    if buf.tell() >= self.buffer_size:
+                        stream.write(buf.getvalue())
+                        buf = StringIO()
+                        w = csv.writer(buf)
 
-                w.writerow(row)
+                stream.write(buf.getvalue())
+
+        finally:
+            batches.close()
 
         return True, self.cache.path(rel_path)
 
 
+class CsvGzExtractor(CsvExtractor):
+
+    mime = 'application/gzip'
+
+    gzip = True
+
+
 class JsonExtractor(Extractor):
 
+    """Extract a table to a JSON object with the column names in 'header' and lists of row
+    values in 'rows'.
+
+    The rows are fetched batch_size at a time, and encoded with one encoder for the whole
+    table. The encoded rows are collected until there are buffer_size bytes, then written to
+    the cache at once.
+
+    """
+
     mime = 'application/json'
 
     def __init__(self, warehouse, cache, force=False):
@@ -144,27 +361,276 @@ class JsonExtractor(Extractor):
 
         rel_path = self.mangle_path(rel_path)
 
-        row_gen = self.warehouse.database.connection.execute(
-            "SELECT * FROM {}".format(table))
-
         # A template to ensure the JSON head and tail are properly formatted
         head, mid, tail = json.dumps(
             {'header': [0], 'rows': [[0]]}).split('[0]')
 
-        with self.cache.put_stream(rel_path, metadata=metadata) as stream:
+        encode = json.JSONEncoder().encode
 
-            stream.write(head)
+        batches = self.iter_batches(table)
 
-            for i, row in enumerate(row_gen):
-                if i == 0:
-                    stream.write(json.dumps(row.keys()))
-                    stream.write(mid)
+        try:
+            names = next(batches)
+
+            with self.output(rel_path, metadata=metadata) as stream:
+
+                parts = [head, encode(names), mid]
+                size = 0
+                sep = ''
+
+                for rows in batches:
+                    chunk = sep + ',\n'.join(map(encode, rows))
+                    sep = ',\n'
+
+                    parts.append(chunk)
+                    size += len(chunk)
+
+                    if size >= self.buffer_size:
+                        stream.write(''.join(parts))
+                        parts = []
+                        size = 0
+
+                parts.append(tail)
+
+                stream.write(''.join(parts))
+
+        finally:
+            batches.close()
+
+        return True, self.cache.path(rel_path)
+
+
+class JsonGzExtractor(JsonExtractor):
+
+    mime = 'application/gzip'
+
+    gzip = True
+
+
+class ParquetExtractor(Extractor):
+
+    """Extract a table to a compressed Parquet file, with pyarrow.
+
+    The rows are read batch_size at a time with iter_batches(), and each batch is written as a
+    row group, so the table is never held in memory. The column types come from the datatypes of
+    the table's orm.Column records, and values are converted to those types with converter();
+    columns that aren't in the schema are typed from the first batch by untyped_array().
+
+    """
+
+    mime = 'application/octet-stream'
+
+    batch_size = 50000
+    compression = 'snappy'
+
+    def __init__(self, warehouse, cache, force=False):
+        super(ParquetExtractor, self).__init__(warehouse, cache, force=force)
+
+    @classmethod
+    def can_extract(cls, t):
+        return True
+
+    @staticmethod
+    def arrow_type(datatype):
+        import pyarrow as pa
+        from ..orm import Column
+
+        if datatype in (Column.DATATYPE_INTEGER, Column.DATATYPE_INTEGER64):
+            return pa.int64()
+        elif datatype in (Column.DATATYPE_REAL, Column.DATATYPE_FLOAT, Column.DATATYPE_NUMERIC):
+            return pa.float64()
+        elif datatype == Column.DATATYPE_DATE:
+            return pa.date32()
+        elif datatype == Column.DATATYPE_TIME:
+            return pa.time64('us')
+        elif datatype in (Column.DATATYPE_TIMESTAMP, Column.DATATYPE_DATETIME):
+            return pa.timestamp('us')
+        elif datatype in (Column.DATATYPE_TEXT, Column.DATATYPE_VARCHAR, Column.DATATYPE_CHAR):
+            return pa.string()
+        elif datatype is not None:  # Blobs and geometries
+            return pa.binary()
+        else:
+            return None
+
+    @staticmethod
+    def converter(arrow_type):
+        """Return a function to convert the values the database returns for a column to ones
+        pyarrow accepts for the column's type, or None if they need no conversion. Sqlite
+        returns dates and times as ISO text, and Postgres returns numerics as Decimals."""
+        import pyarrow as pa
+        from datetime import date, datetime, time
+        from decimal import Decimal
+
+        def parse_datetime(v):
+            if isinstance(v, datetime):
+                return v
+
+            if isinstance(v, date):
+                return datetime(v.year, v.month, v.day)
+
+            v = v.strip().replace('T', ' ')
+
+            for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+                try:
+                    return datetime.strptime(v, fmt)
+                except ValueError:
+                    pass
+
+            raise ValueError("Not an ISO date or datetime: '{}'".format(v))
+
+        def to_date(v):
+            if isinstance(v, date) and not isinstance(v, datetime):
+                return v
+
+            return parse_datetime(v).date()
+
+        def to_time(v):
+            if isinstance(v, time):
+                return v
+
+            v = v.strip()
+
+            for fmt in ('%H:%M:%S.%f', '%H:%M:%S', '%H:%M'):
+                try:
+                    return datetime.strptime(v, fmt).time()
+                except ValueError:
+                    pass
+
+            raise ValueError("Not an ISO time: '{}'".format(v))
+
+        def to_float(v):
+            return float(v) if isinstance(v, (Decimal, basestring)) else v
+
+        def to_int(v):
+            return int(v) if isinstance(v, (Decimal, basestring)) else v
+
+        def to_bytes(v):
+            return str(v) if isinstance(v, buffer) else v
+
+        if arrow_type is None:
+            return None
+        elif arrow_type == pa.date32():
+            return to_date
+        elif arrow_type == pa.timestamp('us'):
+            return parse_datetime
+        elif arrow_type == pa.time64('us'):
+            return to_time
+        elif arrow_type == pa.float64():
+            return to_float
+        elif arrow_type == pa.int64():
+            return to_int
+        elif arrow_type == pa.binary():
+            return to_bytes
+        else:
+            return None
+
+    @staticmethod
+    def to_text(v):
+        """Converter for the columns that are typed as text because their first batch was all
+        NULL, so later values of other types don't fail."""
+        return v if isinstance(v, basestring) else unicode(v)
+
+    def untyped_array(self, values):
+        """Build the array for a column that has no type in the schema, inferring the type from
+        the values. Text from Sqlite is UTF-8 bytes, and blobs are buffers, so bytes are text.
+        A column with no values is text."""
+        import pyarrow as pa
+
+        if any(isinstance(v, buffer) for v in values):
+            return pa.array([str(v) if v is not None else None for v in values], type=pa.binary())
+
+        a = pa.array(values)
+
+        if a.type == pa.null():
+            return a.cast(pa.string())
+        elif a.type == pa.binary() and self.text_is_bytes:
+            return pa.array(values, type=pa.string())
+        else:
+            return a
+
+    def column_types(self, table):
+        """Map column names to the datatypes from the orm.Column records for the table"""
+
+        t = self.warehouse.orm_table(table) or self.warehouse.orm_table_by_name(table)
+
+        if not t:
+            return {}
+
+        return {c.name: c.datatype for c in t.columns}
+
+    def _arrays(self, names, types, rows, converters=None):
+        import pyarrow as pa
+
+        arrays = []
+
+        for name, values in zip(names, zip(*rows)):
+            try:
+                convert = converters.get(name) if converters else None
+
+                if convert:
+                    values = [convert(v) if v is not None else None for v in values]
+
+                if types.get(name) is None:
+                    arrays.append(self.untyped_array(values))
                 else:
-                    stream.write(',\n')
+                    arrays.append(pa.array(values, type=types.get(name)))
+            except (pa.ArrowException, TypeError, ValueError) as e:
+                raise ExtractError("Failed to convert column '{}' to {}: {}".format(name, types.get(name), e))
 
-                stream.write(json.dumps(list(row)))
+        return arrays
 
-            stream.write(tail)
+    def _extract(self, table, rel_path, metadata):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            from ..dbexceptions import DependencyError
+            raise DependencyError("The parquet extractor requires pyarrow")
+
+        rel_path = self.mangle_path(rel_path)
+
+        batches = self.iter_batches(table)
+
+        try:
+            names = next(batches)
+
+            datatypes = self.column_types(table)
+            types = {name: self.arrow_type(datatypes.get(name)) for name in names}
+            converters = {name: self.converter(types[name]) for name in names}
+
+            writer = None
+
+            with self.put_stream(rel_path, metadata=metadata) as stream:
+
+                try:
+                    for rows in batches:
+
+                        arrays = self._arrays(names, types, rows, converters)
+
+                        if writer is None:
+                            # Fix the types of untyped columns from the first batch
+                            for name, a in zip(names, arrays):
+                                if types[name] is None:
+                                    converters[name] = (self.to_text if a.null_count == len(a)
+                                                        else self.converter(a.type))
+
+                            types = {name: a.type for name, a in zip(names, arrays)}
+                            schema = pa.schema([pa.field(name, types[name]) for name in names])
+
+                            writer = pq.ParquetWriter(stream, schema, compression=self.compression)
+
+                        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+                    if writer is None:  # No rows, so write just the schema
+                        schema = pa.schema([pa.field(name, types[name] or pa.string()) for name in names])
+                        writer = pq.ParquetWriter(stream, schema, compression=self.compression)
+
+                finally:
+                    if writer is not None:
+                        writer.close()
+
+        finally:
+            batches.close()
 
         return True, self.cache.path(rel_path)
 
@@ -322,10 +788,32 @@ class OgrExtractor(Extractor):
                 name,
                 self.mangled_names.values()))
 
+    def field_map(self, layer, names, skip):
+        """Return (column position, field index) pairs for the columns of a query that have a
+        field in the layer"""
+
+        defn = layer.GetLayerDefn()
+
+        fields = []
+
+        for i, name in enumerate(names):
+            if name.lower() in skip:
+                continue
+
+            idx = defn.GetFieldIndex(self.mangle_name(str(name)))
+
+            if idx >= 0:
+                fields.append((i, idx))
+
+        return fields
+
     def _extract_shapes(self, abs_dest, table):
+        """Write the rows of a table to a new OGR data source.
 
-        import ogr
-        import os
+        The rows are read batch_size at a time, with the geometries as WKB, and the features for
+        each batch are created in one layer transaction.
+
+        """
 
         t, cd, geo_col = self.geometry_type(self.database, table)
 
@@ -333,46 +821,58 @@ class OgrExtractor(Extractor):
 
         self.create_schema(self.database, table, layer)
 
-        # TODO AsTest, etc, will have to change to ST_AsText for Postgis
-        q = "SELECT *, AsText(Transform({}, {} )) AS _wkt FROM {}".format(
-            geo_col,
-            self.epsg,
-            table)
+        defn = layer.GetLayerDefn()
 
-        for i, row in enumerate(self.database.connection.execute(q)):
+        # TODO AsBinary, etc, will have to change to ST_AsBinary for Postgis
+        batches = self.iter_batches(table, "*, AsBinary(Transform({}, {})) AS _wkb".format(geo_col, self.epsg))
 
-            feature = ogr.Feature(layer.GetLayerDefn())
+        try:
+            names = next(batches)
 
-            for name, value in row.items():
-                if name.lower() in (geo_col, 'geometry', 'wkt', 'wkb', '_wkt'):
-                    continue
+            wkb_pos = names.index('_wkb')
+            fields = self.field_map(layer, names, (geo_col, 'geometry', 'wkt', 'wkb', '_wkb'))
+            encode = not self.text_is_bytes
 
-                if value:
-                    try:
-                        if isinstance(value, unicode):
-                            value = str(value)
+            for rows in batches:
 
-                        name = self.mangle_name(str(name))
+                layer.StartTransaction()
 
-                        feature.SetField(name, value)
-                    except Exception as e:
-                        print 'Failed for {}={} ({})'.format(name, value, type(value))
-                        raise
-                    except NotImplementedError as e:
-                        print e
-                        raise
+                try:
+                    for row in rows:
 
-            geometry = ogr.CreateGeometryFromWkt(row['_wkt'])
+                        feature = ogr.Feature(defn)
 
-            feature.SetGeometryDirectly(geometry)
-            if layer.CreateFeature(feature) != 0:
-                import gdal
-                raise Exception(
-                    'Failed to add feature: {}: geometry={}'.format(
-                        gdal.GetLastErrorMsg(),
-                        geometry.ExportToWkt()))
+                        for i, idx in fields:
+                            value = row[i]
 
-            feature.Destroy()
+                            if value is not None:
+                                if encode and isinstance(value, unicode):
+                                    value = value.encode('utf-8')
+
+                                feature.SetField(idx, value)
+
+                        wkb = row[wkb_pos]
+
+                        if wkb is not None:
+                            feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(str(wkb)))
+
+                        if layer.CreateFeature(feature) != 0:
+                            import gdal
+                            raise ExtractError(
+                                'Failed to add feature: {}: row={}'.format(
+                                    gdal.GetLastErrorMsg(),
+                                    row[:wkb_pos]))
+
+                        feature.Destroy()
+
+                except:
+                    layer.RollbackTransaction()
+                    raise
+
+                layer.CommitTransaction()
+
+        finally:
+            batches.close()
 
         ds.SyncToDisk()
         ds.Release()
@@ -423,11 +923,8 @@ class ShapeExtractor(OgrExtractor):
 
         self.zip_dir(table, shapefile_dir, zf)
 
-        copy_file_or_flo(
-            zf,
-            self.cache.put_stream(
-                rel_path,
-                metadata=metadata))
+        with self.put_stream(rel_path, metadata=metadata) as stream:
+            copy_file_or_flo(zf, stream)
 
         shutil.rmtree(shapefile_dir)
         os.remove(zf)
@@ -457,11 +954,8 @@ class GeoJsonExtractor(OgrExtractor):
 
         self._extract_shapes(tf, table)
 
-        copy_file_or_flo(
-            tf,
-            self.cache.put_stream(
-                rel_path,
-                metadata=metadata))
+        with self.put_stream(rel_path, metadata=metadata) as stream:
+            copy_file_or_flo(tf, stream)
 
         os.remove(tf)
 
@@ -487,11 +981,8 @@ class KmlExtractor(OgrExtractor):
 
         self._extract_shapes(tf, table)
 
-        copy_file_or_flo(
-            tf,
-            self.cache.put_stream(
-                rel_path,
-                metadata=metadata))
+        with self.put_stream(rel_path, metadata=metadata) as stream:
+            copy_file_or_flo(tf, stream)
 
         os.remove(tf)
 
@@ -501,15 +992,19 @@ class KmlExtractor(OgrExtractor):
 extractors = dict(
     csv=CsvExtractor,
     json=JsonExtractor,
+    parquet=ParquetExtractor,
     shapefile=ShapeExtractor,
     geojson=GeoJsonExtractor,
     kml=KmlExtractor
 )
 
+extractors['csv.gz'] = CsvGzExtractor
+extractors['json.gz'] = JsonGzExtractor
+
 
 def geo_extractors():
-    return [f for f, e in extractors if e.is_geo]
+    return [f for f, e in extractors.items() if e.is_geo]
 
 
 def table_extractors():
-    return [f for f, e in extractors if not e.is_geo]
+    return [f for f, e in extractors.items() if not e.is_geo]
@@ -14,6 +14,12 @@ class PostgresWarehouse(Warehouse):
 
     drop_view_sql = 'DROP VIEW  IF EXISTS "{name}" CASCADE'
 
+    # Each loader and mview refresh runs on its own connection
+    load_workers = 4
+    mview_workers = 4
+
+    table_schema = 'public'
+
     def create(self):
         self.database.create()
         self.database.connection.execute(
@@ -34,6 +40,131 @@ class PostgresWarehouse(Warehouse):
 
         return super(PostgresWarehouse, self).table_meta(identity, table_name)
 
+    def load_local(
+            self,
+            partition,
+            source_table_name,
+            dest_table_name,
+            where=None):
+        return self.load_copy(
+            partition,
+            source_table_name,
+            dest_table_name,
+            where=where)
+
+    def load_copy(
+            self,
+            partition,
+            source_table_name,
+            dest_table_name,
+            where=None,
+            chunk_size=5000):
+        """Load a partition table with COPY ... FROM STDIN.
+
+        The rows are read from the Sqlite partition a chunk at a time, written as CSV, and streamed
+        to the server through psycopg2's copy_expert(), so the partition is never held in memory.
+        The NULL conversions, the geometry to EWKT and BYTEA to hex escapes are all done in the
+        Sqlite select, so the rows can go directly to the CSV writer.
+
+        Because NULL is written as \\N, a text value that is the two characters \\N will be
+        loaded as a NULL.
+
+        """
+        from sqlalchemy import Table, MetaData
+        from sqlalchemy.dialects.postgresql.base import BYTEA
+        from ..util.flo import FileLikeFromIter
+        import csv
+        from cStringIO import StringIO
+
+        self.logger.info('load_copy {}'.format(partition.identity.vname))
+
+        dest_table = Table(
+            dest_table_name,
+            MetaData(),
+            autoload=True,
+            autoload_with=self.database.engine)
+
+        source_table = Table(
+            source_table_name,
+            MetaData(),
+            autoload=True,
+            autoload_with=partition.database.engine)
+
+        cols = []
+        for sc, dc in zip(source_table.columns, dest_table.columns):
+
+            if sc.name == 'geometry':
+                # PostGIS takes EWKT as the text form of a geometry. Plain WKB or WKT would load
+                # with SRID 0, which a column with a SRID rejects
+                expr = "'SRID=' || SRID(geometry) || ';' || AsText(geometry)"
+            elif isinstance(dc.type, BYTEA):
+                expr = "'\\x' || Hex(\"{}\")".format(sc.name)
+            else:
+                expr = '"{}"'.format(sc.name)
+
+            # Hex() returns an empty string for NULL, so test the column, not the expression
+            cols.append(("CASE WHEN \"{}\" IS NULL THEN '\\N' ELSE {} END".format(sc.name, expr), dc.name))
+
+        select_statement = "SELECT {} FROM \"{}\"".format(
+            ','.join(expr for expr, _ in cols),
+            source_table.name)
+
+        if where:
+            select_statement += " WHERE " + where
+
+        copy_statement = "COPY \"{}\" ({}) FROM STDIN WITH CSV NULL E'\\\\N'".format(
+            dest_table.name,
+            ','.join('"{}"'.format(name) for _, name in cols))
+
+        # Use the raw Sqlite connection, returning UTF-8 bytes rather than unicode, so the rows don't
+        # have to be encoded before writing the CSV
+        src_conn = partition.database.engine.raw_connection()
+        text_factory = src_conn.connection.text_factory
+        src_conn.connection.text_factory = str
+
+        def csv_chunks(src_cur):
+            n = 0
+
+            while True:
+                rows = src_cur.fetchmany(chunk_size)
+
+                if not rows:
+                    break
+
+                buf = StringIO()
+                csv.writer(buf, lineterminator='\n').writerows(rows)
+
+                n += len(rows)
+                self.logger.progress('copy_rows', source_table_name, n)
+
+                yield buf.getvalue()
+
+            self.logger.info('copied {} rows'.format(n))
+
+        conn = self.database.engine.raw_connection()
+
+        try:
+            src_cur = src_conn.cursor()
+            src_cur.execute(select_statement)
+
+            with conn.cursor() as cur:
+                cur.copy_expert(copy_statement, FileLikeFromIter(csv_chunks(src_cur)), size=128 * 1024)
+
+            conn.commit()
+
+        except:
+            conn.rollback()
+            raise
+
+        finally:
+            src_conn.connection.text_factory = text_factory
+            src_conn.close()
+            conn.close()
+
+        self.logger.info('done {}'.format(partition.identity.vname))
+
+        return dest_table_name
+
     def _ogr_args(self, partition):
 
         db = self.database
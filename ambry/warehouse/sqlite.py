@@ -87,21 +87,15 @@ class SqliteWarehouse(Warehouse):
 
 class SpatialiteWarehouse(SqliteWarehouse):
 
-    def install_material_view(self, name, sql, clean=False, data=None):
+    def mview_installed(self, name):
         """After installing thematerial view, look for geometry columns and add
         them to the spatial system.
 
         :param name:
-        :param sql:
-        :param clean:
-        :param data:
         :return:
 
         """
 
-        if not super(SpatialiteWarehouse, self).install_material_view(name, sql, clean=clean, data=data):
-            return False
-
         # Clean up the geometry
 
         ce = self.database.connection.execute
@@ -125,5 +119,3 @@ class SpatialiteWarehouse(SqliteWarehouse):
 
                 ce("SELECT RecoverGeometryColumn('{}', '{}', 4326, '{}', '{}');".format(
                     name, col, t, cd))
-
-        return True
@@ -501,6 +501,38 @@ class Test(TestBase):
 
         b.set_value('test', 'uuid', uv2)
 
+    def test_insert_many(self):
+
+        bundle = Bundle()
+        bundle.clean()
+        bundle = Bundle()
+        bundle.exit_on_fatal = False
+        bundle.pre_prepare()
+        bundle.prepare()
+        bundle.post_prepare()
+
+        p = bundle.partitions.find_or_new_db(table='tthree')
+
+        field_gen = bundle.fields3
+
+        with p.inserter() as ins:
+            rows = [{f[0]: f[1]() for f in field_gen} for i in range(1000)]
+            errors = ins.insert_many(rows)
+            self.assertEquals([], errors)
+
+            header = [f[0] for f in field_gen]
+            ins.insert_many([[f[1]() for f in field_gen] for i in range(500)], header=header)
+
+            ins.insert_columns({'text': ['chocolate', 'vanilla'], 'integer': ['1', '2'], 'float': [1.0, 2.5]})
+
+            self.assertEquals(len('strawberry'), ins.max_lengths['text'])
+
+        self.assertEquals(1502, p.database.query("SELECT count(*) FROM tthree").fetchone()[0])
+
+        row = p.database.query("SELECT * FROM tthree WHERE id = 1502").fetchone()
+        self.assertEquals(2, row['integer'])
+        self.assertEquals(2.5, row['float'])
+
 
 
 
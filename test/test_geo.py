@@ -222,6 +222,36 @@ class Test(TestBase):
             print "{:6s} {}".format(str(r['confidence']) if r else '', k)
             pprint.pprint(r)
 
+    def test_kernel_density(self):
+        import numpy as np
+        from ambry.geo import Point
+        from ambry.geo.kernel import GaussianKernel, DistanceKernel, ConstantKernel
+        from ambry.geo.array import apply_copy, add
+
+        rs = np.random.RandomState(0)
+
+        a = rs.rand(40, 37) * (rs.rand(40, 37) > .8)
+        a[0, 0], a[39, 36], a[0, 36], a[39, 0] = 2, 3, 1, 5  # Points on the corners
+
+        for k in (GaussianKernel(9, 3), DistanceKernel(7), ConstantKernel(5), ConstantKernel(3, 2.0)):
+            k.matrix = k.matrix.astype(float)
+
+            for nodata in (0, None, 2.0):
+
+                # One cell at a time, as apply_copy() does for other funcs
+                o = np.zeros_like(a)
+                cells = np.ndindex(a.shape) if nodata is None else zip(*np.nonzero(a != nodata))
+
+                for row, col in cells:
+                    k.apply(o, Point(col, row), f=add, v=a[row, col])
+
+                self.assertTrue(np.allclose(o, apply_copy(k, a, nodata=nodata), rtol=1e-12, atol=1e-12))
+
+        # Integer arrays, and other funcs, are applied one cell at a time
+        o = apply_copy(ConstantKernel(3, 2), (a > 0).astype(int), nodata=0)
+        self.assertEquals(int, o.dtype)
+        self.assertEquals(2 * int((a[:3, :3] > 0).sum()), o[1, 1])
+
 
 def suite():
     suite = unittest.TestSuite()
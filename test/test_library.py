@@ -202,6 +202,89 @@ class Test(TestBase):
 
       
 
+    def test_resolver_cache(self):
+
+        l = self.get_library()
+
+        l.put_bundle(self.bundle)
+
+        rc = l.database.resolver_cache
+        rc.clear()
+
+        vid = self.bundle.identity.vid
+
+        a = l.resolve(vid)
+        b = l.resolve(vid)
+
+        self.assertEquals(1, rc.misses)
+        self.assertEquals(1, rc.hits)
+        self.assertEquals(a.vname, b.vname)
+        self.assertIsNot(a, b)
+
+        # Updates to another dataset don't drop the entry
+        from ambry.identity import DatasetNumber
+        rc.invalidate(str(DatasetNumber(revision=1)))
+        l.resolve(vid)
+        self.assertEquals(2, rc.hits)
+
+        l.mark_updated(vid=vid)
+        self.assertEquals(a.vname, l.resolve(vid).vname)
+        self.assertEquals(2, rc.misses)
+
+    def test_sync_library(self):
+        from ambry.library import sqlite_user_version
+        from ambry.database.sqlite import SqliteDatabase
+
+        l = self.get_library()
+
+        l.put_bundle(self.bundle)
+
+        for partition in self.bundle.partitions:
+            l.put_partition(self.bundle, partition)
+
+        self.assertEquals(SqliteDatabase.SCHEMA_VERSION,
+                          sqlite_user_version(self.bundle.database.path))
+        self.assertIsNone(sqlite_user_version(__file__))
+
+        # Rebuild the library from the files in the cache
+        l.database.clean()
+
+        bundles = l.sync_library()
+
+        self.assertEquals([self.bundle.identity.vid], [b.identity.vid for b in bundles])
+
+        b = l.get(self.bundle.identity.vid)
+        self.assertEquals(self.bundle.identity.vname, b.identity.vname)
+
+        for partition in self.bundle.partitions:
+            self.assertTrue(bool(l.get(partition.identity.vid)))
+
+        # Everything is known now, so there is nothing to install
+        self.assertEquals([], l.sync_library())
+
+    def test_index_library(self):
+
+        l = self.get_library()
+
+        l.put_bundle(self.bundle)
+
+        for partition in self.bundle.partitions:
+            l.put_partition(self.bundle, partition)
+
+        l.search.reset()
+
+        self.assertEquals([self.bundle.identity.vid], l.search.index_library(procs=1))
+
+        self.assertIn(self.bundle.identity.vid, list(l.search.search_datasets(self.bundle.identity.name)))
+
+        for partition in self.bundle.partitions:
+            self.assertIn(partition.identity.vid, l.search.all_partitions)
+
+        # Nothing has changed, so nothing is reindexed
+        self.assertEquals([], l.search.index_library(procs=1))
+
+        self.assertEquals([self.bundle.identity.vid], l.search.index_library(force=True, procs=1))
+
     def test_library_install(self):
         '''Install the bundle and partitions, and check that they are
         correctly installed. Check that installation is idempotent'''
@@ -351,6 +434,15 @@ source/dataset-subset-variation-0.0.1/tthree.db:
 
         self.assertIsNotNone(b)
 
+        # The remote records are the sync checkpoint, so another sync is a no-op
+        from ambry.orm import Dataset
+        n_remote = len(l.files.query.type(Dataset.LOCATION.REMOTE).all)
+        self.assertTrue(n_remote > 0)
+
+        l.sync_remotes()
+
+        self.assertEquals(n_remote, len(l.files.query.type(Dataset.LOCATION.REMOTE).all))
+
         print b.identity
 
         for p in b.partitions:
@@ -837,6 +929,112 @@ source/dataset-subset-variation-0.0.1/tthree.db:
             print r
 
 
+    def test_doc_cache(self):
+        from ambry.library.doccache import BoundedCache
+
+        c = BoundedCache(max_entries=2, policy='lru')
+        c.put('a', 1)
+        c.put('b', 2)
+        c.get('a')
+        c.put('c', 3)
+        self.assertEquals(['a', 'c'], c.keys())
+
+        c = BoundedCache(max_entries=10, max_bytes=25)
+        c.put('a', 'x' * 10)
+        c.put('b', 'y' * 10)
+        self.assertEquals(['b'], c.keys())
+        self.assertEquals(1, c.evictions)
+
+        l = self.get_library()
+        dc = l.doc_cache
+
+        self.assertIs(dc, l.doc_cache)
+
+        calls = []
+
+        def f():
+            calls.append(1)
+            return {'a': 1}
+
+        self.assertEquals({'a': 1}, dc.cache(f, _key='library_info'))
+        self.assertEquals({'a': 1}, dc.cache(f, _key='library_info'))
+        self.assertEquals(1, len(calls))
+
+        r = dc.report()
+        self.assertEquals(0.5, r['kinds']['library_info']['hit_rate'])
+
+    def test_doc_cache_invalidate(self):
+        from ambry.identity import DatasetNumber
+
+        l = self.get_library()
+        dc = l.doc_cache
+
+        other = str(DatasetNumber(revision=1))
+        vid = self.bundle.identity.vid
+
+        dc.cache(lambda vid: {'vid': vid}, other, _kind='bundle')
+        dc.cache(lambda vid: {'vid': vid}, vid, _kind='bundle')
+        dc.cache(lambda: {}, _key='library_info', _deps=[dc.ALL])
+
+        l.put_bundle(self.bundle)
+
+        keys = dc._memory.keys()
+
+        # Only the pushed bundle and the library-wide entries are invalidated
+        self.assertIn(dc._munge_key(other)[0], keys)
+        self.assertNotIn(dc._munge_key(vid)[0], keys)
+        self.assertNotIn(dc._munge_key(_key='library_info')[0], keys)
+
+        # Evicted entries don't keep their dependencies
+        from ambry.library.doccache import DocCache
+
+        dc = DocCache(l, max_entries=2)
+
+        for i in range(10):
+            dc.cache(lambda vid: {'vid': vid}, str(DatasetNumber(revision=1)), _kind='bundle')
+
+        self.assertEquals(2, len(dc._deps))
+        self.assertEquals(set(dc._memory.keys()), set(dc._key_deps))
+
+        # Evicted entries stay in the persistent cache, and are still invalidated
+        dc = DocCache(l, max_entries=1)
+
+        tvid = self.bundle.schema.tables[0].vid
+        tkey = dc._munge_key(tvid)[0]
+
+        dc.cache(lambda vid: {'vid': vid}, tvid, _kind='table', _deps=dc._with_dataset(tvid))
+        dc.cache(lambda vid: {'vid': vid}, other, _kind='bundle')
+
+        self.assertNotIn(tkey, dc._memory.keys())
+        self.assertIn(tkey, dc._cache)
+
+        self.assertIn(tkey, dc.invalidate(vid))
+        self.assertNotIn(tkey, dc._cache)
+        self.assertIn(dc._munge_key(other)[0], dc._cache)
+
+    def test_doc_cache_copies(self):
+        """Cached documents can be modified by the caller, as Renderer.table() does"""
+
+        l = self.get_library()
+        l.put_bundle(self.bundle)
+        dc = l.doc_cache
+
+        bvid = self.bundle.identity.vid
+        tvid = self.bundle.schema.tables[0].vid
+
+        for i in range(2):
+            b = dc.bundle(bvid)
+
+            del b['partitions']
+            del b['tables']
+
+            t = dc.table(tvid)
+            t['columns'] = None
+
+        self.assertIn('partitions', dc.bundle(bvid))
+        self.assertIsNotNone(dc.table(tvid)['columns'])
+        self.assertEquals(2, dc.report()['kinds']['table']['hits'])
+
     def test_search_parse(self):
 
         from ambry.library.search import SearchTermParser
@@ -845,6 +1043,54 @@ source/dataset-subset-variation-0.0.1/tthree.db:
 
         print stp.parse('source mother')
 
+    def test_identifier_lookup(self):
+        import tempfile
+        import shutil
+        from ambry.library.search import IdentifierLookup
+
+        d = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(d, 'identifiers.idx')
+
+            IdentifierLookup.write(path, [('0E06', u'California'),
+                                          ('0O0601', u'San Diego County, California'),
+                                          ('0O0602', u'San Bernardino County, California')])
+
+            l = IdentifierLookup(path)
+
+            self.assertEquals(u'0E06', l.search('California')[0][1])
+            self.assertEquals([u'0O0601'], [x[1] for x in l.search('san diego')])
+            self.assertEquals([u'0O0601', u'0O0602'], sorted(x[1] for x in l.search('san')))
+            self.assertEquals(1, len(l.search('california', limit=1)))
+            self.assertEquals([], l.search('nevada'))
+
+            r = l.search_many(['san diego', 'nevada'])
+            self.assertEquals(u'San Diego County, California', r['san diego'][0][2])
+            self.assertEquals([], r['nevada'])
+
+            l.close()
+
+            # Terms only match whole words, so shorter names that start with the term don't win
+            IdentifierLookup.write(path, [('0O0641', u'Marin County, California'),
+                                          ('0P0645778', u'Marina city, California'),
+                                          ('0O0659', u'Orange County, California'),
+                                          ('0P0653980', u'Orange city, California'),
+                                          ('0P0654092', u'Orangevale CDP, California')])
+
+            l = IdentifierLookup(path)
+
+            self.assertEquals([u'0O0641'], [x[1] for x in l.search('marin')])
+            self.assertEquals([u'0P0645778'], [x[1] for x in l.search('marina')])
+            self.assertEquals([u'0O0659', u'0P0653980'], sorted(x[1] for x in l.search('orange')))
+            self.assertEquals([u'0O0659'], [x[1] for x in l.search('orange county')])
+            self.assertEquals([], l.search('mari'))
+
+            l.close()
+
+        finally:
+            shutil.rmtree(d)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Test))
@@ -44,6 +44,105 @@ class Test(TestBase):
 
         intuit.dump()
 
+    def test_intuit_batch(self):
+        import os
+        from ambry.util.intuit import Intuiter, Column
+        from ambry.bundle.rowgen import DelimitedRowGenerator
+
+        csvf = os.path.join(os.path.dirname(__file__), 'support', 'types.csv')
+
+        rg = DelimitedRowGenerator(csvf)
+
+        intuit = Intuiter()
+        intuit.iterate(rg, chunk_size=7)
+
+        header = rg.header
+        rows = list(DelimitedRowGenerator(csvf))
+
+        for i, col in enumerate(intuit.columns):
+            c = Column()
+            for row in rows:
+                c.test(row[i])
+
+            self.assertEquals(header[i], col.name)
+            self.assertEquals(c.type_counts, col.type_counts)
+            self.assertEquals(c.length, col.length)
+            self.assertEquals(c.resolved_type(), col.resolved_type())
+
+        intuit = Intuiter()
+        intuit.iterate(DelimitedRowGenerator(csvf), sample=5)
+
+        for d in intuit.dump():
+            self.assertEquals(5, d['count'])
+
+        # A value that can't be tested loses only itself, not the rest of the chunk
+        intuit = Intuiter()
+        intuit.test_rows(['a', 'b'], ['a', 'b'], [['1', 'x'], ['2', 'y'], [u'\xe4', 'z'], ['4', 'w']])
+
+        a, b = list(intuit.columns)
+        self.assertEquals(3, a.type_counts[int])
+        self.assertEquals(0, a.type_counts[str])
+        self.assertEquals(4, b.type_counts[str])
+
+    def test_colstats(self):
+        import random
+        import numpy as np
+        from collections import Counter
+        from ambry.util.colstats import ColumnStats, DistinctCounter
+
+        # Fewer values than the sketch's k, so the quantiles and histogram are exact
+        values = [random.randint(0, 1000) if random.random() > .1 else None for i in range(1500)]
+
+        cs = ColumnStats('x', numeric=True)
+        for i in range(0, len(values), 500):
+            cs.update(values[i:i + 500])
+
+        a = np.array([v for v in values if v is not None], dtype=float)
+        d = cs.dict
+
+        self.assertEquals(len(a), d['count'])
+        self.assertAlmostEqual(a.mean(), d['mean'])
+        self.assertAlmostEqual(a.std(ddof=1), d['std'])
+        self.assertEquals(np.percentile(a, 25), d['p25'])
+        self.assertEquals(a.max(), d['max'])
+        self.assertEquals(len(set(a)), d['nuniques'])
+        self.assertEquals(list(np.histogram(a)[0]), [c for e, c in d['hist']['values']])
+
+        # Many more values than k, so the sketch has compacted, and the quantiles and histogram
+        # counts are estimates
+        values = [random.randint(0, 1000) for i in range(50000)]
+
+        cs = ColumnStats('x', numeric=True)
+        for i in range(0, len(values), 1000):
+            cs.update(values[i:i + 1000])
+
+        a = np.array(values, dtype=float)
+        d = cs.dict
+
+        self.assertFalse(cs.sketch.is_exact)
+        self.assertEquals(len(a), d['count'])
+        self.assertAlmostEqual(a.mean(), d['mean'])
+        self.assertEquals(a.max(), d['max'])
+        self.assertLess(abs(np.percentile(a, 25) - d['p25']), 1000 * .02)
+
+        for expected, (e, c) in zip(np.histogram(a)[0], d['hist']['values']):
+            self.assertLess(abs(expected - c), len(a) * .02)
+
+        words = [random.choice(['chocolate', 'strawberry', 'vanilla']) for i in range(5000)]
+
+        cs = ColumnStats('t', text=True)
+        for i in range(0, len(words), 1000):
+            cs.update(words[i:i + 1000])
+
+        self.assertEquals(dict(Counter(words)), cs.dict['uvalues'])
+        self.assertEquals(3, cs.dict['nuniques'])
+
+        dc = DistinctCounter(max_exact=1000)
+        for i in range(0, 100000, 10000):
+            dc.update(range(i, i + 10000))
+
+        self.assertTrue(abs(dc.count - 100000) < 5000)
+
     def test_expand_to_years(self):
 
         from ambry.util.datestimes import expand_to_years, compress_years
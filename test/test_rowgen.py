@@ -49,3 +49,52 @@ class Test(TestBase):
         for row in rg:
             print row
 
+    def test_byte_ranges(self):
+        from test import support
+        from os.path import join, dirname
+
+        fn = lambda x: join(dirname(support.__file__), x)
+
+        for file_name in ('rowgen_basic.csv', 'rowgen_multiheader.csv', 'types.csv'):
+
+            rg = DelimitedRowGenerator(fn(file_name))
+
+            rows = list(rg)
+
+            for n in (1, 2, 3, 7):
+                ranges = rg.byte_ranges(n)
+
+                self.assertTrue(len(ranges) <= n)
+
+                range_rows = []
+                for start, end, first_line in ranges:
+                    range_rows.extend(DelimitedRowGenerator(fn(file_name)).iter_range(start, end, first_line))
+
+                self.assertEquals(rows, range_rows)
+
+    def test_byte_ranges_stray_quote(self):
+        import tempfile
+        import os
+
+        # A quote in an unquoted field throws off the quote parity, so the file must not be split
+        rows = ['a,b,c'] + ['{0},"multi\nline, field",{0}'.format(i) if i % 7 == 0 else '{0},plain,{0}'.format(i)
+                            for i in range(400)]
+        rows[50] = '49,ab"c,49'
+
+        fd, file_name = tempfile.mkstemp(suffix='.csv')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write('\n'.join(rows) + '\n')
+
+            rg = DelimitedRowGenerator(file_name)
+
+            ranges = rg.byte_ranges(7)
+
+            self.assertEquals([(0, os.path.getsize(file_name), 0)], ranges)
+
+            self.assertEquals(list(DelimitedRowGenerator(file_name)),
+                              list(DelimitedRowGenerator(file_name).iter_range(*ranges[0])))
+
+        finally:
+            os.remove(file_name)
@@ -125,6 +125,34 @@ class Test(TestBase):
         row, errors = ctb({'int': '.', 'float': 'a', 'str': '3', 'ni1': 0, 'ni2': 3 },
                           codify_cast_errors=True)
 
+        #
+        # Positional rows
+        #
+
+        ctb = CasterTransformBuilder()
+
+        ctb.append('id', int)
+        ctb.append('int', int)
+        ctb.append('float', float)
+        ctb.append('str', str)
+
+        lc = ctb.list_caster(['Str', 'int', 'float', 'extra'])
+
+        row, errors = lc(['3', '1', '2', 'x'])
+
+        self.assertEquals((None, 1, 2.0, '3'), row)
+        self.assertTrue(isinstance(row[3], unicode))
+        self.assertEquals({}, errors)
+
+        row, errors = lc(['3', 'a', '2', 'x'])
+
+        self.assertEquals((None, None, 2.0, '3'), row)
+        self.assertEquals({'int': 'a'}, errors)
+
+        # Without a header, rows are in column order
+        row, errors = ctb([None, '1', '2', '3'])
+        self.assertEquals((None, 1, 2.0, '3'), row)
+
         
     def test_intuit(self):
         import pprint
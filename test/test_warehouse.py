@@ -144,6 +144,60 @@ class Test(TestBase):
     def test_local_postgres_install(self):
         self._test_local_install('postgres1')
 
+    def test_postgres_load_copy(self):
+        """Round trip text, NULLs, blobs and geometries through the COPY loader"""
+        from ambry.database.spatialite import SpatialiteDatabase
+
+        l = self.get_library()
+
+        try:
+            w = self.get_warehouse(l, 'postgres1')
+        except Exception as e:
+            self.skipTest("Postgres warehouse is not reachable: {}".format(e))
+
+        path = '/tmp/ambry/test-warehouse/copy_test.db'
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        db = SpatialiteDatabase(path)
+        db.create()
+
+        db.connection.execute('CREATE TABLE copy_test (id INTEGER PRIMARY KEY, name TEXT, n INTEGER, data BLOB)')
+        db.connection.execute("SELECT AddGeometryColumn('copy_test', 'geometry', 4326, 'POINT', 2)")
+
+        rows = [
+            (1, u'with "quotes", and commas', 1, '\x00\x01\xff', 'POINT(1 2)'),
+            (2, u'a line\nbreak, and a back\\slash', None, None, None),
+            (3, None, 0, '', 'POINT(-117.1 32.7)'),
+            (4, u'\xfcnicode', 4, '\\x00', None),
+        ]
+
+        for id_, name, n, data, wkt in rows:
+            db.connection.execute(
+                'INSERT INTO copy_test VALUES (?, ?, ?, ?, GeomFromText(?, 4326))',
+                (id_, name, n, buffer(data) if data is not None else None, wkt))
+
+        w.database.connection.execute('DROP TABLE IF EXISTS copy_test')
+        w.database.connection.execute(
+            'CREATE TABLE copy_test (id INTEGER PRIMARY KEY, name TEXT, n INTEGER, data BYTEA, '
+            'geometry geometry(POINT, 4326))')
+
+        class Partition(object):
+            class identity(object):
+                vname = 'copy_test'
+
+            database = db
+
+        w.load_copy(Partition(), 'copy_test', 'copy_test')
+
+        loaded = [
+            (row[0], row[1], row[2], str(row[3]) if row[3] is not None else None, row[4])
+            for row in w.database.connection.execute(
+                'SELECT id, name, n, data, ST_AsText(geometry) FROM copy_test ORDER BY id')]
+
+        self.assertEquals(rows, loaded)
+
 
     def _test_remote_install(self, name):
 
@@ -214,6 +268,150 @@ class Test(TestBase):
         from ambry.util import print_yaml
         print_yaml(extracts)
 
+    def _compare_extracts(self, n_rows, batch_size=None, buffer_size=None):
+        """Extract a table of n_rows with the batched CSV and JSON extractors, and check that the output is the
+        same as from the old row at a time versions. Returns the rows per second for each, by format."""
+        import json
+        import time
+        import gzip
+        import unicodecsv
+        from ambry.warehouse.extractors import new_extractor
+
+        l = self.get_library()
+        w = self.get_warehouse(l, 'sqlite')
+
+        w.database.connection.execute(
+            'CREATE TABLE bench (id INTEGER PRIMARY KEY, name TEXT, v REAL, n INTEGER, extra TEXT)')
+
+        w.database.connection.execute(
+            'INSERT INTO bench VALUES (?, ?, ?, ?, ?)',
+            [(i, u'n\xe4me {}'.format(i), i * .5, i * 3, None if i % 3 else u'x,"y"') for i in range(n_rows)])
+
+        def legacy_csv(f):
+            w_ = unicodecsv.writer(f)
+            for i, row in enumerate(w.database.connection.execute('SELECT * FROM bench')):
+                if i == 0:
+                    w_.writerow(row.keys())
+                w_.writerow(row)
+
+        def legacy_json(f):
+            head, mid, tail = json.dumps({'header': [0], 'rows': [[0]]}).split('[0]')
+            f.write(head)
+            for i, row in enumerate(w.database.connection.execute('SELECT * FROM bench')):
+                if i == 0:
+                    f.write(json.dumps(row.keys()))
+                    f.write(mid)
+                else:
+                    f.write(',\n')
+                f.write(json.dumps(list(row)))
+            f.write(tail)
+
+        def extractor(fmt):
+            e = new_extractor(fmt, w, cache, force=True)
+
+            if batch_size:
+                e.batch_size = batch_size
+
+            if buffer_size:
+                e.buffer_size = buffer_size
+
+            return e
+
+        cache = self.get_fs_cache('bench')
+
+        rates = {}
+
+        for fmt, legacy in (('csv', legacy_csv), ('json', legacy_json)):
+
+            legacy_path = cache.path('legacy.' + fmt, missing_ok=True)
+
+            t0 = time.time()
+            with open(legacy_path, 'wb') as f:
+                legacy(f)
+            t1 = time.time()
+            e = extractor(fmt).extract('bench', 'bench.' + fmt)
+            t2 = time.time()
+            ez = extractor(fmt + '.gz').extract('bench', 'bench.' + fmt)
+            t3 = time.time()
+
+            rates[fmt] = (n_rows / (t1 - t0), n_rows / (t2 - t1), n_rows / (t3 - t2))
+
+            with open(legacy_path) as f:
+                legacy_data = f.read()
+
+            with open(e.abs_path) as f:
+                self.assertEquals(legacy_data, f.read())
+
+            self.assertTrue(ez.abs_path.endswith('.gz'))
+            self.assertEquals(legacy_data, gzip.open(ez.abs_path).read())
+
+        return rates
+
+    def test_extract_batched(self):
+        """The batched CSV and JSON extractors write the same bytes as the old row at a time versions"""
+
+        # Small batches and buffers, so the output is written across several of each
+        self._compare_extracts(500, batch_size=7, buffer_size=1000)
+
+    @unittest.skipUnless(os.environ.get('AMBRY_BENCHMARK'), "Set AMBRY_BENCHMARK to run benchmarks")
+    def test_extract_throughput(self):
+        """Compare the speed of the batched CSV and JSON extractors to the old row at a time versions"""
+
+        for fmt, (before, after, gz) in sorted(self._compare_extracts(100000).items()):
+            print '{}: before {:.0f} rows/sec, after {:.0f} rows/sec, gzip {:.0f} rows/sec'.format(
+                fmt, before, after, gz)
+
+    def test_extract_parquet_types(self):
+        """Temporal and numeric columns are converted to the types of the Parquet schema"""
+        import datetime
+        from ambry.warehouse.extractors import ParquetExtractor
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        l = self.get_library()
+        w = self.get_warehouse(l, 'sqlite')
+
+        datatypes = dict(d='date', ts='datetime', tm='time', n='integer', num='numeric')
+
+        class TypedParquetExtractor(ParquetExtractor):
+            batch_size = 2
+
+            def column_types(self, table):
+                return datatypes
+
+        # The x column has no datatype, and is all NULL in the first batch
+        w.database.connection.execute(
+            'CREATE TABLE typed (d DATE, ts DATETIME, tm TIME, n INTEGER, num NUMERIC, x)')
+
+        w.database.connection.execute(
+            'INSERT INTO typed VALUES (?, ?, ?, ?, ?, ?)',
+            [('2014-01-02', '2014-01-02 03:04:05', '03:04:05', 1, 1.5, None),
+             ('2014-01-03', '2014-01-02T03:04:05.250000', '03:04', '2', 2, None),
+             (None, None, None, None, None, 3)])
+
+        cache = self.get_fs_cache('parquet')
+
+        e = TypedParquetExtractor(w, cache, force=True).extract('typed', 'typed.parquet')
+
+        t = pq.read_table(e.abs_path)
+
+        self.assertEquals([pa.date32(), pa.timestamp('us'), pa.time64('us'), pa.int64(), pa.float64(), pa.string()],
+                          [t.schema.field(name).type for name in ('d', 'ts', 'tm', 'n', 'num', 'x')])
+
+        data = t.to_pydict()
+
+        self.assertEquals([datetime.date(2014, 1, 2), datetime.date(2014, 1, 3), None], data['d'])
+        self.assertEquals([datetime.datetime(2014, 1, 2, 3, 4, 5),
+                           datetime.datetime(2014, 1, 2, 3, 4, 5, 250000), None], data['ts'])
+        self.assertEquals([datetime.time(3, 4, 5), datetime.time(3, 4), None], data['tm'])
+        self.assertEquals([1, 2, None], data['n'])
+        self.assertEquals([1.5, 2.0, None], data['num'])
+        self.assertEquals([None, None, u'3'], data['x'])
+
 
 
     def test_manifest_parser(self):